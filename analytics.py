@@ -0,0 +1,364 @@
+# analytics.py
+#
+# Stage metrics over the EventStore of a SupplyChainManager, computed with
+# NumPy and pandas from the store's columns instead of product histories:
+#
+#     analytics = Analytics(scm)
+#     analytics.update()  # Again whenever new blocks arrive
+#     analytics.lead_times(), analytics.bottlenecks()
+#
+# A transition is a pair of consecutive events of a product, e.g.
+# Manufactured -> In Transit; its lead time is the time between them and is
+# also the dwell time of the entity holding the product meanwhile. update()
+# folds only the rows added since the last call, in chunks, keeping the last
+# event of every product so transitions spanning two calls are counted once.
+#
+# export_events and export_chain stream the events and the chain's
+# transactions to Arrow IPC or Parquet files one record batch at a time.
+
+import argparse
+import logging
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import config
+from block_store import read_blocks
+from event_store import parse_date, valid_date
+from supply_chain import lifecycle
+
+logger = logging.getLogger(__name__)
+
+Bottlenecks = namedtuple('Bottlenecks', ['stages', 'entities'])
+
+event_schema = pa.schema([
+    ('row', pa.int64()),
+    ('product_id', pa.string()),
+    ('origin', pa.dictionary(pa.int32(), pa.string())),
+    ('status', pa.dictionary(pa.int32(), pa.string())),
+    ('entity', pa.dictionary(pa.int32(), pa.string())),
+    ('date', pa.timestamp('s')),
+])
+
+chain_schema = pa.schema([
+    ('height', pa.int64()),
+    ('block_hash', pa.string()),
+    ('block_timestamp', pa.timestamp('s')),
+    ('product_id', pa.string()),
+    ('event', pa.string()),
+    ('date', pa.timestamp('s')),
+    ('author', pa.string()),
+    ('entity', pa.string()),
+    ('scheme', pa.string()),
+])
+
+def _writer(path, schema, format=None):
+    format = format or ('parquet' if path.endswith('.parquet') else 'arrow')
+    if format == 'parquet':
+        return pq.ParquetWriter(path, schema)
+    return pa.ipc.new_file(path, schema)
+
+def _dictionary_array(indices, values, missing):
+    # Values of None, e.g. the origin of a product restored from the chain,
+    # become nulls since Parquet does not allow them in the dictionary
+    mask = indices == missing if missing is not None else None
+    return pa.DictionaryArray.from_arrays(pa.array(indices, mask=mask), values)
+
+def export_events(store, path, start=0, stop=None, format=None, batch_rows=config.analytics_export_rows):
+    """Write the event rows start to stop of an EventStore to path, as Parquet
+    or Arrow IPC (default from the extension, .parquet or otherwise Arrow).
+    Passing the previous stop as start exports only newer rows. Returns the
+    number of rows written."""
+    stop = len(store) if stop is None else stop
+    # Values interned by then cover every row before stop
+    product_ids = pa.array(store.product_ids[:])
+    origins = store.product_origins()
+    interners = (store.origins, store.statuses, store.entities)
+    dictionaries = [pa.array(['' if value is None else value for value in interner.values[:]], pa.string())
+                    for interner in interners]
+    missing = [interner.ids.get(None) for interner in interners]
+    with _writer(path, event_schema, format) as writer:
+        for lo in range(start, stop, batch_rows):
+            hi = min(lo + batch_rows, stop)
+            columns = store.columns(lo, hi)
+            product = columns['product']
+            writer.write_batch(pa.record_batch([
+                pa.array(np.arange(lo, hi, dtype=np.int64)),
+                product_ids.take(pa.array(product)),
+                _dictionary_array(origins[product], dictionaries[0], missing[0]),
+                _dictionary_array(columns['status'], dictionaries[1], missing[1]),
+                _dictionary_array(columns['entity'], dictionaries[2], missing[2]),
+                pa.array(columns['date'].astype('datetime64[s]')),
+            ], schema=event_schema))
+    return max(stop - start, 0)
+
+def _blocks(blockchain, start, stop):
+    if blockchain.store is None:
+        return (blockchain.chain[height] for height in range(start, stop))
+    blockchain.store.flush()
+    return read_blocks(blockchain.store.directory, start, stop)
+
+def _seconds(dates):
+    # Malformed dates of transactions signed elsewhere become nulls
+    return np.array([parse_date(date) if valid_date(date) else 'NaT' for date in dates],
+                    dtype='datetime64[s]')
+
+def export_chain(blockchain, path, start=1, stop=None, format=None, entity_authors=None,
+                 batch_blocks=config.analytics_export_blocks):
+    """Write one row per transaction of the blocks start to stop to path, as
+    export_events does. Authors are given as entity names too where
+    entity_authors knows them. Returns the number of rows written."""
+    stop = len(blockchain.chain) if stop is None else stop
+    entity_authors = entity_authors or {}
+    rows = 0
+    with _writer(path, chain_schema, format) as writer:
+        blocks = _blocks(blockchain, start, stop)
+        for lo in range(start, stop, batch_blocks):
+            columns = {name: [] for name in chain_schema.names}
+            for _, block in zip(range(lo, min(lo + batch_blocks, stop)), blocks):
+                block_hash = block.hash()
+                for t in block.transactions:
+                    columns['height'].append(block.index)
+                    columns['block_hash'].append(block_hash)
+                    columns['block_timestamp'].append(block.timestamp)
+                    columns['product_id'].append(t.product_id)
+                    columns['event'].append(t.event)
+                    columns['date'].append(t.date)
+                    columns['author'].append(t.author)
+                    columns['entity'].append(entity_authors.get(t.author))
+                    columns['scheme'].append(t.scheme)
+            columns['block_timestamp'] = _seconds(columns['block_timestamp'])
+            columns['date'] = _seconds(columns['date'])
+            writer.write_batch(pa.record_batch([pa.array(columns[name], field.type)
+                                                for name, field in zip(chain_schema.names, chain_schema)],
+                                               schema=chain_schema))
+            rows += len(columns['height'])
+    return rows
+
+def _summarize(keys, seconds):
+    # count, sum, min and max of seconds per distinct row of the key columns
+    frame = pd.DataFrame(dict(keys, seconds=seconds))
+    return frame.groupby(list(keys), sort=False)['seconds'].agg(['count', 'sum', 'min', 'max'])
+
+def _combine(summary, part):
+    if summary is None:
+        return part
+    merged = pd.concat([summary, part])
+    return merged.groupby(level=list(range(merged.index.nlevels)), sort=False).agg(
+        {'count': 'sum', 'sum': 'sum', 'min': 'min', 'max': 'max'})
+
+def _grow(values, size, fill):
+    if len(values) >= size:
+        return values
+    grown = np.full(max(size, 2 * len(values)), fill, dtype=values.dtype)
+    grown[:len(values)] = values
+    return grown
+
+class Analytics(object):
+    """Lead times, dwell times, throughput and bottlenecks of the products of
+    a SupplyChainManager, kept up to date by update(). Products reaching
+    final_status count as completed; throughput is counted per period
+    seconds."""
+
+    def __init__(self, scm, final_status=lifecycle[-1][0], period=config.analytics_period,
+                 chunk_rows=config.analytics_chunk_rows):
+        self.scm = scm
+        self.final_status = final_status
+        self.period = period
+        self.chunk_rows = chunk_rows
+        self.reset()
+
+    def reset(self):
+        self.store = self.scm.events
+        self.watermark = 0  # Rows of the store folded so far
+        self.latest = None  # Latest event date, epoch seconds
+        self._products = 0
+        # Last event and creation date of every product, by product number
+        self._status = np.empty(0, dtype=np.int32)
+        self._entity = np.empty(0, dtype=np.int32)
+        self._date = np.empty(0, dtype=np.int64)
+        self._created = np.empty(0, dtype=np.int64)
+        self._leads = None  # By (from status, to status)
+        self._dwells = None  # By (entity, status)
+        self._completions = None  # By (origin, period start)
+
+    def update(self):
+        """Fold the rows appended to the store since the last update into the
+        metrics. A store replaced by SupplyChainManager.restore is folded
+        from the start. Returns the number of rows folded."""
+        if self.scm.events is not self.store:
+            self.reset()
+        start, stop = self.watermark, len(self.store)
+        for lo in range(start, stop, self.chunk_rows):
+            self._fold(self.store.columns(lo, min(lo + self.chunk_rows, stop)))
+        self.watermark = stop
+        return stop - start
+
+    def _fold(self, columns):
+        product, status, entity, date = (columns['product'], columns['status'],
+                                         columns['entity'], columns['date'])
+        n = len(product)
+        index = np.arange(n)
+        following = index + columns['next']
+        linked = (columns['next'] > 0) & (following < n)
+        # Heads are the first rows of their product in the chunk; they follow
+        # the product's last event before the chunk, if it was created before
+        head = np.ones(n, dtype=bool)
+        head[following[linked]] = False
+        heads = index[head]
+        products = self._products
+        self._products = max(products, int(product.max()) + 1)
+        for name, fill in (('_status', -1), ('_entity', -1), ('_date', 0), ('_created', 0)):
+            setattr(self, name, _grow(getattr(self, name), self._products, fill))
+        created = heads[product[heads] >= products]
+        self._created[product[created]] = date[created]
+        earlier = heads[product[heads] < products]
+
+        previous = product[earlier]
+        before = index[linked]
+        after = np.concatenate([following[linked], earlier])
+        from_status = np.concatenate([status[before], self._status[previous]])
+        holder = np.concatenate([entity[before], self._entity[previous]])
+        seconds = date[after] - np.concatenate([date[before], self._date[previous]])
+        to_status = status[after]
+        if len(after):
+            self._leads = _combine(self._leads, _summarize(
+                {'from_status': from_status, 'to_status': to_status}, seconds))
+            self._dwells = _combine(self._dwells, _summarize(
+                {'entity': holder, 'status': from_status}, seconds))
+
+        final = self.store.statuses.ids.get(self.final_status)
+        if final is not None:
+            done = index[status == final]
+            if len(done):
+                done_products = product[done]
+                origins = self.store.product_origins()[done_products]
+                self._completions = _combine(self._completions, _summarize(
+                    {'origin': origins, 'period': date[done] // self.period * self.period},
+                    date[done] - self._created[done_products]))
+
+        # Last rows of their product in the chunk become the products' last events
+        tails = index[~linked]
+        self._status[product[tails]] = status[tails]
+        self._entity[product[tails]] = entity[tails]
+        self._date[product[tails]] = date[tails]
+        latest = int(date.max())
+        self.latest = latest if self.latest is None else max(self.latest, latest)
+
+    def _table(self, summary, names):
+        # Summary with ids replaced by names and mean seconds added
+        if summary is None:
+            return pd.DataFrame(columns=list(names) + ['count', 'mean', 'min', 'max', 'total'])
+        table = summary.reset_index()
+        for column, values in names.items():
+            table[column] = np.asarray(values, dtype=object)[table[column].to_numpy()]
+        table = table.rename(columns={'sum': 'total'})
+        table['mean'] = table['total'] / table['count']
+        return table[list(names) + ['count', 'mean', 'min', 'max', 'total']]
+
+    def lead_times(self):
+        """Seconds between consecutive statuses of a product, per transition,
+        with the role setting the later status."""
+        statuses = self.store.statuses.values
+        table = self._table(self._leads, {'from_status': statuses, 'to_status': statuses})
+        table.insert(2, 'role', [self.scm.get_role_for_status(status) for status in table['to_status']])
+        return table.sort_values(['from_status', 'to_status'], key=self._lifecycle_order,
+                                 ignore_index=True)
+
+    def dwell_times(self):
+        """Seconds products stay with an entity after it sets a status."""
+        table = self._table(self._dwells, {'entity': self.store.entities.values,
+                                           'status': self.store.statuses.values})
+        return table.sort_values(['entity', 'status'], ignore_index=True)
+
+    def throughput(self):
+        """Products reaching the final status per origin and period, with the
+        mean seconds from their creation."""
+        table = self._table(self._completions, {'origin': self.store.origins.values})
+        if self._completions is not None:
+            table.insert(1, 'period', pd.to_datetime(
+                self._completions.index.get_level_values('period').to_numpy(), unit='s'))
+        else:
+            table.insert(1, 'period', pd.Series(dtype='datetime64[s]'))
+        table = table.rename(columns={'count': 'completed'}).drop(columns=['total'])
+        return table.sort_values(['period', 'origin'], ignore_index=True)
+
+    def work_in_progress(self, now=None):
+        """Products per status that have not reached the final status, with
+        the mean and largest seconds since their last event. now defaults to
+        the latest event date."""
+        now = self.latest if now is None else now
+        statuses = self.store.statuses.values
+        status = self._status[:self._products]
+        waiting = status != self.store.statuses.ids.get(self.final_status, -1)
+        frame = pd.DataFrame({'status': status[waiting], 'age': now - self._date[:self._products][waiting]})
+        table = frame.groupby('status')['age'].agg(['count', 'mean', 'max']).reset_index()
+        table['status'] = np.asarray(statuses, dtype=object)[table['status'].to_numpy()]
+        table = table.rename(columns={'count': 'products', 'mean': 'mean_age', 'max': 'max_age'})
+        return table.sort_values('status', key=self._lifecycle_order, ignore_index=True)
+
+    def bottlenecks(self, factor=config.analytics_bottleneck_factor,
+                    min_events=config.analytics_bottleneck_min_events):
+        """Transitions by their share of all lead time, largest first, and
+        entities whose mean dwell in a status is at least factor times the
+        median of the entities in that status."""
+        stages = self.lead_times()
+        stages['share'] = stages['total'] / stages['total'].sum() if len(stages) else []
+        stages = stages.sort_values('total', ascending=False, ignore_index=True)
+        dwells = self.dwell_times()
+        dwells = dwells[dwells['count'] >= min_events].copy()
+        dwells['median'] = dwells.groupby('status')['mean'].transform('median')
+        dwells['ratio'] = dwells['mean'] / dwells['median']
+        slow = dwells[dwells['ratio'] >= factor]
+        return Bottlenecks(stages, slow.sort_values('ratio', ascending=False, ignore_index=True))
+
+    @staticmethod
+    def _lifecycle_order(column):
+        order = {status: i for i, (status, _) in enumerate(lifecycle)}
+        return column.map(lambda status: order.get(status, len(order)))
+
+    def report(self):
+        """All metrics, as a dict of DataFrames."""
+        bottlenecks = self.bottlenecks()
+        return {
+            'lead_times': self.lead_times(),
+            'dwell_times': self.dwell_times(),
+            'throughput': self.throughput(),
+            'work_in_progress': self.work_in_progress(),
+            'bottleneck_stages': bottlenecks.stages,
+            'bottleneck_entities': bottlenecks.entities,
+        }
+
+if __name__ == "__main__":
+    from blockchain import Blockchain
+    from simulation import run_simulation
+    from snapshot import SnapshotStore
+    from supply_chain import SupplyChainManager
+
+    parser = argparse.ArgumentParser(description="Supply chain stage metrics and exports")
+    parser.add_argument('--store', help="Block store directory to restore products from")
+    parser.add_argument('--snapshots', help="Product state snapshot directory")
+    parser.add_argument('--products', type=int, default=1000, help="Products to simulate without --store")
+    parser.add_argument('--events', help="Export the product events to this .parquet or .arrow file")
+    parser.add_argument('--chain', help="Export the chain's transactions to this .parquet or .arrow file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    if args.store:
+        blockchain = Blockchain.open(args.store)
+        scm = SupplyChainManager(blockchain, SnapshotStore(args.snapshots) if args.snapshots else None)
+        scm.restore()
+    else:
+        scm = run_simulation(num_products=args.products, seed=0)
+    analytics = Analytics(scm)
+    analytics.update()
+    with pd.option_context('display.width', 160, 'display.max_columns', 20):
+        for name, table in analytics.report().items():
+            print(f"\n{name}\n{table.head(20)}")
+    if args.events:
+        logger.info("Exported %d events", export_events(scm.events, args.events))
+    if args.chain:
+        logger.info("Exported %d transactions", export_chain(scm.blockchain, args.chain,
+                                                            entity_authors=scm.entity_authors))
+    scm.blockchain.close()
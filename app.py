@@ -1,178 +1,138 @@
 # app.py
 
-import plotly.graph_objects as go
-from dash import Dash, dcc, html
-from simulation import run_simulation
-import networkx as nx  # For network visualizations
-
-def visualize_blockchain(blockchain):
-    G = nx.DiGraph()
-    labels = {}
-
-    # Add nodes and edges
-    for block in blockchain.chain:
-        index = block.index
-        G.add_node(index)
-        labels[index] = f"Block {index}\nHash: {block.hash()[:6]}..."
-        if index > 0:
-            G.add_edge(index - 1, index)
-
-    # Layout
-    pos = nx.spring_layout(G)
-
-    # Edges
-    edge_x = []
-    edge_y = []
-    for edge in G.edges():
-        x0, y0 = pos[edge[0]]
-        x1, y1 = pos[edge[1]]
-        edge_x.extend([x0, x1, None])
-        edge_y.extend([y0, y1, None])
-
-    edge_trace = go.Scatter(
-        x=edge_x, y=edge_y,
-        line=dict(width=2, color='gray'),
-        hoverinfo='none',
-        mode='lines')
-
-    # Nodes
-    node_x = []
-    node_y = []
-    node_text = []
-    for node in G.nodes():
-        x, y = pos[node]
-        node_x.append(x)
-        node_y.append(y)
-        node_text.append(labels[node])
-
-    node_trace = go.Scatter(
-        x=node_x, y=node_y,
-        mode='markers+text',
-        text=node_text,
-        textposition="bottom center",
-        hoverinfo='text',
-        marker=dict(
-            color='skyblue',
-            size=50,
-            line_width=2))
-
-    # Figure
-    fig = go.Figure(data=[edge_trace, node_trace],
-                    layout=go.Layout(
-                        title='Blockchain Structure',
-                        showlegend=False,
-                        hovermode='closest'))
-    return fig
-
-def visualize_entity_network(products):
-    G = nx.MultiDiGraph()
-    for product in products.values():
-        history = product.get_history()
-        for i in range(len(history) - 1):
-            source = history[i]['updated_by']
-            target = history[i+1]['updated_by']
-            G.add_edge(source, target, product=product.product_id)
-
-    pos = nx.spring_layout(G)
-
-    # Edges
-    edge_traces = []
-    for edge in G.edges(data=True):
-        x0, y0 = pos[edge[0]]
-        x1, y1 = pos[edge[1]]
-        edge_traces.append(go.Scatter(
-            x=[x0, x1, None], y=[y0, y1, None],
-            line=dict(width=1, color='gray'),
-            hoverinfo='text',
-            mode='lines',
-            text=f"Product: {edge[2]['product']}"))
-
-    # Nodes
-    node_x = []
-    node_y = []
-    node_text = []
-    for node in G.nodes():
-        x, y = pos[node]
-        node_x.append(x)
-        node_y.append(y)
-        node_text.append(node)
-
-    node_trace = go.Scatter(
-        x=node_x, y=node_y,
-        mode='markers+text',
-        text=node_text,
-        textposition="top center",
-        hoverinfo='text',
-        marker=dict(
-            color='lightgreen',
-            size=10,
-            line_width=2))
-
-    # Figure
-    fig = go.Figure(data=edge_traces + [node_trace],
-                    layout=go.Layout(
-                        title='Network of Entities',
-                        showlegend=False,
-                        hovermode='closest'))
-    return fig
+import threading
+import time
+from dash import Dash, dcc, html, Input, Output, State, no_update
+import config
+from simulation import EventSimulation
+from visualization import (aggregate_handoffs, blockchain_extension, product_flow_figure,
+                           visualize_blockchain, visualize_entity_network)
 
 def visualize_product_flow(products):
-    sources = []
-    targets = []
-    values = []
-    label_list = []
-
-    for product in products.values():
-        history = product.get_history()
-        for i in range(len(history) - 1):
-            source = history[i]['updated_by']
-            target = history[i+1]['updated_by']
-            if source not in label_list:
-                label_list.append(source)
-            if target not in label_list:
-                label_list.append(target)
-            sources.append(label_list.index(source))
-            targets.append(label_list.index(target))
-            values.append(1)
-
-    fig = go.Figure(data=[go.Sankey(
-        node=dict(
-            pad=15,
-            thickness=20,
-            label=label_list,
-            color="blue"),
-        link=dict(
-            source=sources,
-            target=targets,
-            value=values,
-            color="lightblue"))])
-
-    fig.update_layout(title_text="Product Flow Through Entities", font_size=10)
-    return fig
-
-# Run the simulation and get data
-scm = run_simulation()
-products = scm.products
-blockchain = scm.blockchain
-
-# Initialize the Dash app
-app = Dash(__name__)
-
-# Define the layout with tabs
-app.layout = html.Div([
-    html.H1("Supply Chain Simulation Dashboard"),
-    dcc.Tabs([
-        dcc.Tab(label='Product Flow', children=[
-            dcc.Graph(figure=visualize_product_flow(products))
-        ]),
-        dcc.Tab(label='Blockchain Structure', children=[
-            dcc.Graph(figure=visualize_blockchain(blockchain))
-        ]),
-        dcc.Tab(label='Network of Entities', children=[
-            dcc.Graph(figure=visualize_entity_network(products))
+    return product_flow_figure(aggregate_handoffs(products))
+
+class LiveSimulation(object):
+    """An EventSimulation run in a background thread, a few events at a
+    time. Readers hold lock while they look at the manager's state."""
+
+    def __init__(self, num_products=config.dashboard_products, step_events=config.dashboard_step_events,
+                 step_delay=config.dashboard_step_delay, **kwargs):
+        self.simulation = EventSimulation(num_products=num_products, **kwargs)
+        self.scm = self.simulation.scm
+        self.step_events = step_events
+        self.step_delay = step_delay
+        self.lock = threading.RLock()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='live-simulation', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                self.simulation.run(max_events=self.step_events, progress_every=0)
+                if self.simulation.done:
+                    break
+            time.sleep(self.step_delay)
+
+    def version(self):
+        # Changes whenever the products or the chain do
+        return len(self.scm.blockchain.chain), self.simulation.events
+
+class FigureCache(object):
+    """Figures built at most once per version of the data they show and
+    shared by all viewers; a viewer asking while a figure is being rebuilt
+    waits for it."""
+
+    def __init__(self, live):
+        self.live = live
+        self._figures = {}
+        self._locks = {}
+
+    def get(self, name, build, version=None):
+        """Return (version, figure dict), version defaulting to live.version."""
+        version = version or self.live.version
+        lock = self._locks.setdefault(name, threading.Lock())
+        with lock:
+            cached = self._figures.get(name)
+            if cached is not None and cached[0] == version():
+                return cached
+            with self.live.lock:
+                cached = self._figures[name] = (version(), build().to_dict())
+            return cached
+
+def create_app(live=None):
+    """The dashboard of live, a new LiveSimulation by default, which is
+    started here; serve create_app().server with a WSGI server."""
+    live = live if live is not None else LiveSimulation()
+    app = Dash(__name__)
+    cache = FigureCache(live)
+    scm = live.scm
+
+    def flow_figure():
+        return cache.get('flow', lambda: visualize_product_flow(scm.products))
+
+    def network_figure():
+        return cache.get('network', lambda: visualize_entity_network(scm.products))
+
+    def chain_figure():
+        return cache.get('chain', lambda: visualize_blockchain(scm.blockchain, config.dashboard_max_blocks),
+                         lambda: len(scm.blockchain.chain))
+
+    def serve_layout():
+        # Built per page load from whatever the simulation has reached, so the
+        # first render never waits for it
+        flow_version, flow = flow_figure()
+        network_version, network = network_figure()
+        height, chain = chain_figure()
+        return html.Div([
+            html.H1("Supply Chain Simulation Dashboard"),
+            dcc.Interval(id='refresh', interval=config.dashboard_refresh_ms),
+            dcc.Store(id='flow-version', data=flow_version),
+            dcc.Store(id='network-version', data=network_version),
+            dcc.Store(id='chain-height', data=height),
+            dcc.Tabs([
+                dcc.Tab(label='Product Flow', children=[
+                    dcc.Graph(id='product-flow', figure=flow)
+                ]),
+                dcc.Tab(label='Blockchain Structure', children=[
+                    dcc.Graph(id='blockchain', figure=chain)
+                ]),
+                dcc.Tab(label='Network of Entities', children=[
+                    dcc.Graph(id='entity-network', figure=network)
+                ])
+            ])
         ])
-    ])
-])
+
+    app.layout = serve_layout
+
+    def refresh_callback(graph, store, figure):
+        # Sends the cached figure only to viewers that have an older version
+        @app.callback(Output(graph, 'figure'), Output(store, 'data'),
+                      Input('refresh', 'n_intervals'), State(store, 'data'))
+        def refresh(_, seen):
+            version, fig = figure()
+            if seen is not None and tuple(seen) == version:
+                return no_update, no_update
+            return fig, version
+
+    refresh_callback('product-flow', 'flow-version', flow_figure)
+    refresh_callback('entity-network', 'network-version', network_figure)
+
+    @app.callback(Output('blockchain', 'extendData'), Output('chain-height', 'data'),
+                  Input('refresh', 'n_intervals'), State('chain-height', 'data'))
+    def extend_chain(_, height):
+        # Only the blocks this viewer has not seen yet are sent
+        with live.lock:
+            extension = blockchain_extension(scm.blockchain, height, config.dashboard_max_blocks)
+            if extension is None:
+                return no_update, no_update
+            return extension, len(scm.blockchain.chain)
+
+    live.start()
+    return app
 
 if __name__ == '__main__':
-    app.run_server(debug=True)
\ No newline at end of file
+    create_app().run(debug=True, use_reloader=False)
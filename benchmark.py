@@ -0,0 +1,304 @@
+# benchmark.py
+#
+# Throughput benchmarks for mining, signing, the mempool, chain validation,
+# the simulation, encryption and analytics. Run everything with
+#
+#     python benchmark.py --output results.json
+#
+# and compare against an earlier run with --compare baseline.json, which
+# exits with status 1 if any metric regressed by more than --threshold.
+# Metrics ending in _per_sec are better when higher, _seconds and _bytes
+# when lower.
+
+import argparse
+import io
+import json
+import os
+import tempfile
+import logging
+import platform
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+import config
+import analytics
+from block import Block
+from blockchain import Blockchain
+import encrypt_data
+from event_store import format_date
+from miner import Miner
+from signing import backends, get_backend
+from simulation import run_simulation
+from supply_chain import SupplyChainManager, lifecycle
+from transaction import Transaction
+
+def _rate(count, elapsed):
+    return count / elapsed if elapsed > 0 else float('inf')
+
+def _signed_transactions(n, private_key=None, prefix="PROD"):
+    private_key = private_key or get_backend(config.signature_scheme).generate()
+    transactions = []
+    for i in range(n):
+        t = Transaction(f"{prefix}{i}", "ProductCreated", date=f"2024-01-01 00:{i // 60 % 60:02d}:{i % 60:02d}")
+        t.sign(private_key)
+        transactions.append(t)
+    return transactions
+
+def _build_chain(length, transactions_per_block=config.blocksize):
+    blockchain = Blockchain()
+    private_key = get_backend('ed25519').generate()
+    for height in range(length):
+        for t in _signed_transactions(transactions_per_block, private_key, prefix=f"B{height}P"):
+            blockchain.add_transaction(t)
+        block = blockchain.new_block()
+        block.mine()
+        blockchain.extend_chain(block, verify=False)
+    return blockchain
+
+def bench_mining(difficulties=(16, 256, 4096, 65536), rounds=3):
+    """Hashes/sec of the nonce search at several difficulties."""
+    block = Block().next(_signed_transactions(config.blocksize))
+    miner = Miner(workers=1)
+    results = {}
+    for difficulty in difficulties:
+        hashes = 0
+        elapsed = 0.0
+        for r in range(rounds):
+            block.nonce = r * 10 ** 7
+            block.difficulty = difficulty
+            result = miner.mine(block)
+            hashes += result.hashes
+            elapsed += result.elapsed
+        results[f"difficulty_{difficulty}_hashes_per_sec"] = _rate(hashes, elapsed)
+    return results
+
+def bench_signing(n=500):
+    """Sign and verify ops/sec of each signature backend."""
+    results = {}
+    for name, backend in backends.items():
+        private_key = backend.generate()
+        transactions = [Transaction(f"PROD{i}", "ProductCreated") for i in range(n)]
+        started = time.perf_counter()
+        for t in transactions:
+            t.sign(private_key)
+        sign_elapsed = time.perf_counter() - started
+        started = time.perf_counter()
+        for t in transactions:
+            t.verify()
+        verify_elapsed = time.perf_counter() - started
+        results[f"{name}_sign_per_sec"] = _rate(n, sign_elapsed)
+        results[f"{name}_verify_per_sec"] = _rate(n, verify_elapsed)
+    return results
+
+def bench_mempool(sizes=(1000, 10000), blocks=100):
+    """add_transaction and new_block throughput against mempool size."""
+    private_key = get_backend('ed25519').generate()
+    results = {}
+    for size in sizes:
+        transactions = _signed_transactions(size, private_key)
+        blockchain = Blockchain()
+        started = time.perf_counter()
+        for t in transactions:
+            blockchain.add_transaction(t)
+        results[f"mempool_{size}_add_per_sec"] = _rate(size, time.perf_counter() - started)
+        count = min(blocks, size // config.blocksize)
+        started = time.perf_counter()
+        for _ in range(count):
+            blockchain.new_block()
+        results[f"mempool_{size}_new_block_per_sec"] = _rate(count, time.perf_counter() - started)
+    return results
+
+def bench_validity(lengths=(50, 200)):
+    """validity() time from scratch and after appending one block."""
+    results = {}
+    for length in lengths:
+        blockchain = _build_chain(length)
+        started = time.perf_counter()
+        blockchain.validity(full=True)
+        results[f"chain_{length}_full_validity_seconds"] = time.perf_counter() - started
+        fresh = Blockchain()
+        fresh.chain = list(blockchain.chain)
+        started = time.perf_counter()
+        fresh.validity()
+        results[f"chain_{length}_validity_seconds"] = time.perf_counter() - started
+        for t in _signed_transactions(config.blocksize, prefix="TIP"):
+            blockchain.add_transaction(t)
+        block = blockchain.new_block()
+        block.mine()
+        blockchain.extend_chain(block, verify=False)
+        started = time.perf_counter()
+        blockchain.validity()
+        results[f"chain_{length}_incremental_validity_seconds"] = time.perf_counter() - started
+    return results
+
+def bench_simulation(num_products=200):
+    """SupplyChainManager events/sec through run_simulation, mining included."""
+    started = time.perf_counter()
+    scm = run_simulation(num_products=num_products, seed=0)
+    elapsed = time.perf_counter() - started
+    events = sum(len(p.get_history()) for p in scm.products.values())
+    return {'simulation_events_per_sec': _rate(events, elapsed)}
+
+def bench_memory(n=20000):
+    """Peak traced memory of n signed transactions, scaled to 1M."""
+    private_key = get_backend('ed25519').generate()
+    tracemalloc.start()
+    transactions = _signed_transactions(n, private_key)
+    for t in transactions:
+        t.hash()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'peak_bytes_per_1m_transactions': peak * (1000000 / n)}
+
+def bench_encryption(payloads=5000, payload_size=1024, stream_mib=32, keys=1000):
+    """Key derivation, payload encrypt/decrypt, streaming and key store throughput."""
+    results = {}
+    encrypt_data._derived.clear()
+    started = time.perf_counter()
+    key = encrypt_data.generate_private_key("benchmark")
+    results['key_derivation_seconds'] = time.perf_counter() - started
+    started = time.perf_counter()
+    for _ in range(1000):
+        encrypt_data.generate_private_key("benchmark")
+    results['cached_key_derivation_per_sec'] = _rate(1000, time.perf_counter() - started)
+
+    data = [os.urandom(payload_size) for _ in range(payloads)]
+    started = time.perf_counter()
+    tokens = [encrypt_data.encrypt(d, key) for d in data]
+    results['encrypt_per_sec'] = _rate(payloads, time.perf_counter() - started)
+    started = time.perf_counter()
+    for token in tokens:
+        encrypt_data.decrypt(token, key)
+    results['decrypt_per_sec'] = _rate(payloads, time.perf_counter() - started)
+
+    plain = io.BytesIO(os.urandom(stream_mib * 2 ** 20))
+    encrypted = io.BytesIO()
+    started = time.perf_counter()
+    encrypt_data.encrypt_stream(plain, encrypted, key)
+    results['stream_encrypt_bytes_per_sec'] = _rate(stream_mib * 2 ** 20, time.perf_counter() - started)
+    encrypted.seek(0)
+    started = time.perf_counter()
+    encrypt_data.decrypt_stream(encrypted, io.BytesIO(), key)
+    results['stream_decrypt_bytes_per_sec'] = _rate(stream_mib * 2 ** 20, time.perf_counter() - started)
+
+    backend = get_backend('ed25519')
+    entity_keys = {f"Entity{i}": backend.generate() for i in range(keys)}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'keys.enc')
+        started = time.perf_counter()
+        encrypt_data.save_keys(path, entity_keys, "benchmark")
+        results[f'key_store_{keys}_save_seconds'] = time.perf_counter() - started
+        started = time.perf_counter()
+        encrypt_data.load_keys(path, "benchmark")
+        results[f'key_store_{keys}_load_seconds'] = time.perf_counter() - started
+    return results
+
+def bench_analytics(products=200000, updates=10):
+    """Analytics.update events/sec, folding new events after each of updates
+    steps and then all of them at once, and Parquet export rows/sec. Events
+    are recorded straight into the store."""
+    scm = SupplyChainManager()
+    store = scm.events
+    incremental = analytics.Analytics(scm)
+    elapsed = 0
+    for i in range(products):
+        date = 1700000000 + i * 60
+        number = store.add_product(f"PROD{i}", "Created", f"Supplier{i % 7}", format_date(date),
+                                   f"Origin{i % 5}")
+        for stage, (status, _) in enumerate(lifecycle[1:], 1):
+            store.append(number, status, f"Entity{(i + stage) % 11}",
+                         format_date(date + stage * 3600 + i % 97))
+        if (i + 1) % (products // updates) == 0:
+            started = time.perf_counter()
+            incremental.update()
+            elapsed += time.perf_counter() - started
+    results = {'incremental_update_events_per_sec': _rate(incremental.watermark, elapsed)}
+    started = time.perf_counter()
+    analytics.Analytics(scm).update()
+    results['update_events_per_sec'] = _rate(len(store), time.perf_counter() - started)
+    with tempfile.TemporaryDirectory() as directory:
+        started = time.perf_counter()
+        analytics.export_events(store, os.path.join(directory, 'events.parquet'))
+        results['parquet_export_rows_per_sec'] = _rate(len(store), time.perf_counter() - started)
+    return results
+
+benchmarks = {
+    'mining': bench_mining,
+    'signing': bench_signing,
+    'mempool': bench_mempool,
+    'validity': bench_validity,
+    'simulation': bench_simulation,
+    'memory': bench_memory,
+    'encryption': bench_encryption,
+    'analytics': bench_analytics,
+}
+
+quick_arguments = {
+    'mining': {'difficulties': (16, 256, 4096), 'rounds': 1},
+    'signing': {'n': 100},
+    'mempool': {'sizes': (1000,), 'blocks': 20},
+    'validity': {'lengths': (20,)},
+    'simulation': {'num_products': 20},
+    'memory': {'n': 2000},
+    'encryption': {'payloads': 500, 'stream_mib': 4, 'keys': 100},
+    'analytics': {'products': 20000},
+}
+
+def run(names=None, quick=False):
+    results = {}
+    for name in names or benchmarks:
+        arguments = quick_arguments[name] if quick else {}
+        started = time.perf_counter()
+        results[name] = benchmarks[name](**arguments)
+        logging.info("%s done in %.1fs", name, time.perf_counter() - started)
+    return {
+        'meta': {
+            'date': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'quick': quick,
+        },
+        'results': results,
+    }
+
+def compare(current, baseline, threshold=0.1):
+    """Return (group, metric, baseline, current, change) for regressed metrics."""
+    regressions = []
+    for group, metrics in current['results'].items():
+        for metric, value in metrics.items():
+            old = baseline.get('results', {}).get(group, {}).get(metric)
+            if not old:
+                continue
+            change = (value - old) / old
+            if metric.endswith('_per_sec'):
+                regressed = change < -threshold
+            else:
+                regressed = change > threshold
+            if regressed:
+                regressions.append((group, metric, old, value, change))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the supply chain benchmarks")
+    parser.add_argument('--only', help="Comma separated benchmarks: " + ','.join(benchmarks))
+    parser.add_argument('--quick', action='store_true', help="Small problem sizes")
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    parser.add_argument('--compare', help="Baseline JSON results to compare against")
+    parser.add_argument('--threshold', type=float, default=0.1, help="Allowed relative regression")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    report = run(args.only.split(',') if args.only else None, quick=args.quick)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        for group, metric, old, new, change in regressions:
+            print(f"REGRESSION {group}.{metric}: {old:.4g} -> {new:.4g} ({change:+.1%})")
+        sys.exit(1 if regressions else 0)
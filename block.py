@@ -4,12 +4,19 @@ import hashlib
 import json
 from datetime import datetime
 from transaction import Transaction
+from miner import Miner, target_for
+from verification import verify_many
+from merkle import merkle_root, merkle_proof, verify_merkle_proof
 import config
+import metrics
 
 class InvalidBlock(Exception):
     pass
 
 class Block(object):
+    __slots__ = ('index', 'timestamp', 'transactions', 'previous_hash', 'nonce', 'difficulty',
+                 'miner', 'merkle_root', '_hash')
+
     def __init__(self, data=None):
         if data is None:
             self.index = 0
@@ -17,7 +24,10 @@ class Block(object):
             self.transactions = []
             self.previous_hash = '0' * 64
             self.nonce = 0
+            self.difficulty = config.default_difficulty
             self.miner = None
+            self.merkle_root = merkle_root([])
+            self._hash = None
         else:
             try:
                 self.index = data['index']
@@ -27,49 +37,118 @@ class Block(object):
                 ]
                 self.previous_hash = data['previous_hash']
                 self.nonce = data['nonce']
+                self.difficulty = data.get('difficulty', config.default_difficulty)
                 self.miner = data.get('miner', None)
+                self.merkle_root = data.get('merkle_root') or self.compute_merkle_root()
+                self._hash = None
             except KeyError as e:
                 raise InvalidBlock(f"Missing field {e}")
 
-    def next(self, transactions):
+    def next(self, transactions, difficulty=None):
+        # Never before the parent, whose clock may run ahead of ours
+        timestamp = max(datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'), self.timestamp)
         data = {
             'index': self.index + 1,
-            'timestamp': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
-            'transactions': [t.data for t in transactions],
+            'timestamp': timestamp,
+            'transactions': list(transactions),
             'previous_hash': self.hash(),
-            'nonce': 0
+            'nonce': 0,
+            'difficulty': difficulty or self.difficulty
         }
         return Block(data)
 
     def hash(self):
-        block_string = json.dumps(self.to_dict(), sort_keys=True)
+        if self._hash is not None:
+            return self._hash
+        block_string = json.dumps(self.header(), sort_keys=True)
         return hashlib.sha256(block_string.encode()).hexdigest()
 
+    def seal(self):
+        # Called once the block is on a chain: from then on it is treated as
+        # immutable and its hash is computed only once.
+        self._hash = None
+        self._hash = self.hash()
+
+    def header(self):
+        # Fixed-size part of the block covered by the proof of work; the
+        # transactions are committed to through the Merkle root.
+        return {
+            'index': self.index,
+            'timestamp': self.timestamp,
+            'previous_hash': self.previous_hash,
+            'merkle_root': self.merkle_root,
+            'nonce': self.nonce,
+            'difficulty': self.difficulty
+        }
+
     def to_dict(self):
         return {
             'index': self.index,
             'timestamp': self.timestamp,
             'transactions': [t.data for t in self.transactions],
             'previous_hash': self.previous_hash,
-            'nonce': self.nonce
+            'merkle_root': self.merkle_root,
+            'nonce': self.nonce,
+            'difficulty': self.difficulty
         }
 
+    def transaction_hashes(self):
+        return [t.hash() for t in self.transactions]
+
+    def compute_merkle_root(self):
+        return merkle_root(self.transaction_hashes())
+
+    def merkle_proof(self, transaction):
+        """Inclusion proof for a transaction, given as an object or a position."""
+        hashes = self.transaction_hashes()
+        if isinstance(transaction, int):
+            index = transaction
+        else:
+            try:
+                index = hashes.index(transaction.hash())
+            except ValueError:
+                raise InvalidBlock("Transaction not in block")
+        return merkle_proof(hashes, index)
+
+    @staticmethod
+    def verify_merkle_proof(transaction_hash, proof, root):
+        return verify_merkle_proof(transaction_hash, proof, root)
+
     def __str__(self):
         return f"Block #{self.index} [Prev Hash: {self.previous_hash}, Hash: {self.hash()}]"
 
-    def valid_proof(self, difficulty=config.default_difficulty):
+    def valid_proof(self):
         if self.index == 0:
             return True
-        return self.hash().startswith('0' * difficulty)
+        return int(self.hash(), 16) < target_for(self.difficulty)
 
-    def mine(self, difficulty=config.default_difficulty):
-        while not self.valid_proof(difficulty):
-            self.nonce += 1
+    @metrics.timed('block_mine')
+    def mine(self, difficulty=None, workers=config.mining_workers):
+        # Mines at the header difficulty unless another one is given
+        if self.index == 0:
+            return None
+        if difficulty is not None:
+            self.difficulty = difficulty
+        result = Miner(workers=workers).mine(self)
+        if metrics.enabled:
+            metrics.registry.set_gauge('mining_hashrate', result.hashrate)
+            metrics.registry.observe('nonces_per_block', result.hashes, metrics.count_buckets)
+        return result
 
-    def validity(self):
+    def work(self):
+        # Expected number of hashes needed to find the proof of work
+        if self.index == 0:
+            return 0
+        return self.difficulty
+
+    def validity(self, verify_signatures=False):
         if self.index == 0:
             return True
-        if not self.valid_proof():
+        if self.difficulty < config.min_difficulty or not self.valid_proof():
+            return False
+        if self.merkle_root != self.compute_merkle_root():
+            return False
+        if verify_signatures and not all(verify_many(self.transactions)):
             return False
         return True
 
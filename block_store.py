@@ -0,0 +1,649 @@
+# block_store.py
+
+import bisect
+import hashlib
+import heapq
+import json
+import mmap
+import os
+import struct
+from collections import OrderedDict
+from functools import lru_cache
+from codec import encode_block, decode_block
+import config
+
+# Index record per height: segment number, offset and length of the block
+# record, cumulative transaction count after the block, and the block hash.
+_INDEX_RECORD = struct.Struct('<IQIQ32s')
+_LENGTH = struct.Struct('<I')
+_TX_HASH_SIZE = 32
+# Hash index entry: hash and its position in the indexed log
+_HASH_ENTRY = struct.Struct('<32sQ')
+_MERGE_CHUNK = 4096  # Entries read at a time when merging runs
+_NO_LIMIT = 2 ** 64 - 1  # Limit of a run the log was not cut below
+
+class CorruptStore(Exception):
+    pass
+
+def _entries(run):
+    # Entries of a run, in order, that the log still holds
+    _, data, count, limit = run
+    for start in range(0, count, _MERGE_CHUNK):
+        stop = min(start + _MERGE_CHUNK, count)
+        for entry in _HASH_ENTRY.iter_unpack(data[start * _HASH_ENTRY.size:stop * _HASH_ENTRY.size]):
+            if entry[1] < limit:
+                yield entry
+
+def _lower_bound(data, count, key):
+    # Index of the first entry not below key. Interpolation search: hashes
+    # are uniformly distributed, so the index is estimated from the leading
+    # bytes in a few probes. Falls back to bisection if the estimates do not
+    # converge, as for keys that are not hashes.
+    size = _HASH_ENTRY.size
+    target = int.from_bytes(key[:8], 'big')
+    lo, hi = 0, count
+    probes = 0
+    while lo < hi:
+        middle = (lo + hi) // 2
+        if probes < 8:
+            low = int.from_bytes(data[lo * size:lo * size + 8], 'big')
+            high = int.from_bytes(data[(hi - 1) * size:(hi - 1) * size + 8], 'big')
+            if high > low:
+                offset = min(max(target - low, 0), high - low)
+                middle = lo + offset * (hi - 1 - lo) // (high - low)
+        probes += 1
+        if data[middle * size:middle * size + 32] < key:
+            lo = middle + 1
+        else:
+            hi = middle
+    return lo
+
+def _scan(run, low, high):
+    # Entries of a run with keys from low to high that the log still holds
+    _, data, count, limit = run
+    size = _HASH_ENTRY.size
+    i = _lower_bound(data, count, low)
+    while i < count:
+        key, position = _HASH_ENTRY.unpack_from(data, i * size)
+        if key > high:
+            break
+        if position < limit:
+            yield key, position
+        i += 1
+
+class HashIndex(object):
+    """Positions of the 32-byte keys of an append-only log, e.g. block
+    hashes by height, in sorted, memory-mapped run files. Unless unique, a
+    position may have several keys and a key several positions, e.g. the
+    transactions of each product.
+
+    The newest entries are kept in memory until checkpoint() writes them as
+    a run, once there are buffer_size of them; runs of similar size are then
+    merged, so there are about log2(n / buffer_size) runs. The meta file
+    records how much of the log the runs cover: the keys after that are read
+    again from source(start, stop), one tuple per position, on open. Cutting
+    the log below the runs lowers their limits instead of rewriting them;
+    entries at or past the limit of their run are ignored, and dropped when
+    it is merged.
+    """
+
+    def __init__(self, directory, name, source, length, unique=True,
+                 buffer_size=config.store_index_buffer):
+        self.directory = directory
+        self.name = name
+        self.source = source
+        self.unique = unique
+        self.buffer_size = buffer_size
+        self._meta_path = os.path.join(directory, f'{name}.meta')
+        self._runs = []  # (file name, mmap, entries, limit), oldest first
+        self._buffer = {}  # Key -> position, or list of positions unless unique
+        self._buffered = 0
+        self._sequence = 0
+        self.covered = 0
+        self.length = 0
+        self._load(length)
+
+    def _path(self, run_name):
+        return os.path.join(self.directory, run_name)
+
+    def _load(self, length):
+        meta = {'covered': 0, 'runs': [], 'sequence': 0}
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                meta = json.load(f)
+        names = [run_name for run_name, _ in meta['runs']]
+        if not all(os.path.exists(self._path(n)) for n in names):
+            meta = {'covered': 0, 'runs': [], 'sequence': meta['sequence']}
+            names = []
+        for run_name in os.listdir(self.directory):
+            # Runs of an unfinished write or merge
+            if run_name.startswith(self.name + '-') and run_name not in names:
+                os.remove(self._path(run_name))
+        self._sequence = meta['sequence']
+        self._runs = [self._map(run_name, limit) for run_name, limit in meta['runs']]
+        self.covered = meta['covered']
+        # The log may have been cut after the runs were written
+        if length < self.covered:
+            self._limit(length)
+        self.length = self.covered
+        self._extend(length)
+
+    def _map(self, run_name, limit):
+        path = self._path(run_name)
+        if not os.path.getsize(path):
+            return run_name, b'', 0, limit
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return run_name, data, len(data) // _HASH_ENTRY.size, limit
+
+    def _extend(self, length):
+        # Index the log from self.length to length, writing runs as we go
+        for keys in self.source(self.length, length):
+            self.append(*keys)
+            if self._buffered >= self.buffer_size:
+                self.checkpoint()
+
+    def append(self, *keys):
+        """Index keys at the next position of the log."""
+        if self.unique:
+            for key in keys:
+                self._buffer[key] = self.length
+        else:
+            for key in keys:
+                self._buffer.setdefault(key, []).append(self.length)
+        self._buffered += len(keys)
+        self.length += 1
+
+    def get(self, key):
+        """Position of key in a unique index, or None."""
+        position = self._buffer.get(key)
+        if position is not None:
+            return position
+        for run in reversed(self._runs):
+            for _, position in _scan(run, key, key):
+                return position
+        return None
+
+    def positions(self, key):
+        """Positions of key, in log order."""
+        found = [position for run in self._runs for _, position in _scan(run, key, key)]
+        return found + list(self._buffer.get(key, ()))
+
+    def between(self, low, high):
+        """(key, position) entries with keys from low to high, in order."""
+        found = [entry for run in self._runs for entry in _scan(run, low, high)]
+        found += [(key, position) for key, positions in self._buffer.items() if low <= key <= high
+                  for position in positions]
+        found.sort()
+        return found
+
+    def __len__(self):
+        return self.length
+
+    def _write(self, entries):
+        self._sequence += 1
+        run_name = f'{self.name}-{self._sequence:08d}.idx'
+        with open(self._path(run_name) + '.tmp', 'wb') as f:
+            batch = []
+            for entry in entries:
+                batch.append(_HASH_ENTRY.pack(*entry))
+                if len(batch) >= _MERGE_CHUNK:
+                    f.write(b''.join(batch))
+                    batch = []
+            f.write(b''.join(batch))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self._path(run_name) + '.tmp', self._path(run_name))
+        return self._map(run_name, _NO_LIMIT)
+
+    def _save(self):
+        meta = {'covered': self.covered, 'runs': [[run[0], run[3]] for run in self._runs],
+                'sequence': self._sequence}
+        with open(self._meta_path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self._meta_path + '.tmp', self._meta_path)
+
+    def checkpoint(self, force=False):
+        """Write the buffered entries as a run if there are buffer_size of
+        them, or any with force. The log must be on disk up to self.length."""
+        if self._buffered < self.buffer_size and not (force and self._buffered):
+            return
+        if self.unique:
+            entries = sorted(self._buffer.items())
+        else:
+            entries = sorted((key, position) for key, positions in self._buffer.items()
+                             for position in positions)
+        self._runs.append(self._write(entries))
+        self._buffer = {}
+        self._buffered = 0
+        merged = []
+        while len(self._runs) > 1 and self._runs[-2][2] <= 2 * self._runs[-1][2]:
+            newer = self._runs.pop()
+            older = self._runs.pop()
+            self._runs.append(self._write(heapq.merge(_entries(older), _entries(newer))))
+            merged += [older, newer]
+        self.covered = self.length
+        self._save()
+        for run in merged:
+            _close(run)
+            os.remove(self._path(run[0]))
+
+    def _limit(self, length):
+        self.covered = length
+        self._runs = [(run_name, data, count, min(limit, length)) for run_name, data, count, limit in self._runs]
+        self._save()
+
+    def truncate(self, length):
+        """Drop the entries from position length on, after the log was cut."""
+        if self.unique:
+            self._buffer = {key: position for key, position in self._buffer.items() if position < length}
+            self._buffered = len(self._buffer)
+        else:
+            buffer = {}
+            for key, positions in self._buffer.items():
+                kept = positions[:bisect.bisect_left(positions, length)]
+                if kept:
+                    buffer[key] = kept
+            self._buffer = buffer
+            self._buffered = sum(map(len, buffer.values()))
+        self.length = length
+        if length < self.covered:
+            self._limit(length)
+
+    def close(self):
+        for run in self._runs:
+            _close(run)
+
+def _close(run):
+    data = run[1]
+    if isinstance(data, mmap.mmap) and not data.closed:
+        data.close()
+
+class BlockStore(object):
+    """Append-only block storage in segment files with a memory-mapped index.
+
+    Blocks are written as length-prefixed records to blocks-NNNNN.dat. The
+    fixed-size records of index.dat locate each block by height, and
+    txhashes.dat holds the hashes of all stored transactions in chain order.
+    Blocks and transactions by hash, and transactions by product, author,
+    event and date, are looked up through HashIndexes on disk, so opening a
+    store does not read its whole history. Writes are fsynced
+    in batches of sync_every blocks; on open, anything past the last
+    complete index record is discarded.
+    """
+
+    def __init__(self, directory, segment_size=config.store_segment_size,
+                 sync_every=config.store_sync_every):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync_every = sync_every
+        os.makedirs(directory, exist_ok=True)
+        self._index_path = os.path.join(directory, 'index.dat')
+        self._tx_path = os.path.join(directory, 'txhashes.dat')
+        self._readers = {}
+        self._unsynced = 0
+        self._index_map = None
+        self._recover()
+        self._index_file = open(self._index_path, 'ab')
+        self._tx_file = open(self._tx_path, 'ab')
+        self._map_index()
+        self._pending = []  # Index records not yet covered by the mmap
+        self._open_segment()
+        self._block_index = HashIndex(directory, 'blockindex', self._block_keys, len(self))
+        self._tx_index = HashIndex(directory, 'txindex', self._transaction_keys, self._tx_count)
+        # Transactions by product, author and event, and by date
+        self._field_index = HashIndex(directory, 'fieldindex', self._field_keys, self._tx_count,
+                                      unique=False)
+        self._date_index = HashIndex(directory, 'dateindex', self._date_keys, self._tx_count,
+                                     unique=False)
+        self._indexes = (self._block_index, self._tx_index, self._field_index, self._date_index)
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, f'blocks-{segment:05d}.dat')
+
+    def _recover(self):
+        # Drop torn index records and records pointing past the data written
+        # before a crash, then trim the segment and transaction files to match.
+        if not os.path.exists(self._index_path):
+            open(self._index_path, 'wb').close()
+        size = os.path.getsize(self._index_path)
+        count = size // _INDEX_RECORD.size
+        with open(self._index_path, 'r+b') as f:
+            while count:
+                f.seek((count - 1) * _INDEX_RECORD.size)
+                segment, offset, length, tx_end, _ = _INDEX_RECORD.unpack(f.read(_INDEX_RECORD.size))
+                path = self._segment_path(segment)
+                if os.path.exists(path) and os.path.getsize(path) >= offset + _LENGTH.size + length:
+                    break
+                count -= 1
+            f.truncate(count * _INDEX_RECORD.size)
+        if count:
+            with open(self._segment_path(segment), 'r+b') as f:
+                f.truncate(offset + _LENGTH.size + length)
+        else:
+            segment, tx_end = 0, 0
+            path = self._segment_path(0)
+            if os.path.exists(path):
+                os.truncate(path, 0)
+        for name in os.listdir(self.directory):
+            if name.startswith('blocks-') and int(name[7:-4]) > segment:
+                os.remove(os.path.join(self.directory, name))
+        if os.path.exists(self._tx_path):
+            if os.path.getsize(self._tx_path) < tx_end * _TX_HASH_SIZE:
+                raise CorruptStore("Transaction hash file is shorter than the index")
+            os.truncate(self._tx_path, tx_end * _TX_HASH_SIZE)
+        elif tx_end:
+            raise CorruptStore("Transaction hash file is missing")
+        self._segment = segment
+        self._tx_count = tx_end
+
+    def _map_index(self):
+        size = os.path.getsize(self._index_path)
+        if self._index_map is not None:
+            self._index_map.close()
+            self._index_map = None
+        if size:
+            with open(self._index_path, 'rb') as f:
+                self._index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mapped = size // _INDEX_RECORD.size
+
+    def _open_segment(self):
+        self._segment_file = open(self._segment_path(self._segment), 'ab')
+
+    def __len__(self):
+        return self._mapped + len(self._pending)
+
+    def _record(self, height):
+        if height < 0:
+            height += len(self)
+        if not 0 <= height < len(self):
+            raise IndexError("Block height out of range")
+        if height < self._mapped:
+            return _INDEX_RECORD.unpack_from(self._index_map, height * _INDEX_RECORD.size)
+        return self._pending[height - self._mapped]
+
+    def hash_at(self, height):
+        return self._record(height)[4].hex()
+
+    def _block_keys(self, start, stop):
+        for height in range(start, stop):
+            yield (self._record(height)[4],)
+
+    def _transaction_hashes(self, start, stop):
+        self._tx_file.flush()
+        with open(self._tx_path, 'rb') as f:
+            f.seek(start * _TX_HASH_SIZE)
+            for position in range(start, stop, _MERGE_CHUNK):
+                data = f.read(min(_MERGE_CHUNK, stop - position) * _TX_HASH_SIZE)
+                for i in range(0, len(data), _TX_HASH_SIZE):
+                    yield data[i:i + _TX_HASH_SIZE]
+
+    def _transaction_keys(self, start, stop):
+        for tx_hash in self._transaction_hashes(start, stop):
+            yield (tx_hash,)
+
+    def _transactions(self, start, stop):
+        # Transactions from position start to stop in chain order
+        if start >= stop:
+            return
+        height, position = self.locate(start)
+        while start < stop:
+            transactions = self.read(height).transactions[position:position + stop - start]
+            yield from transactions
+            start += len(transactions)
+            height, position = height + 1, 0
+
+    def _field_keys(self, start, stop):
+        for t in self._transactions(start, stop):
+            yield _field_keys(t)
+
+    def _date_keys(self, start, stop):
+        for t in self._transactions(start, stop):
+            yield (_date_key(t.date),)
+
+    def locate(self, number):
+        """Height of the block holding the transaction at position number
+        in chain order, and its position in the block."""
+        height = bisect.bisect_right(range(len(self)), number, key=lambda h: self._record(h)[3])
+        return height, number - (self._record(height - 1)[3] if height else 0)
+
+    def transactions_with(self, field, value):
+        """Locations (height, position) of the transactions whose field,
+        'product', 'author' or 'event', is value, in chain order."""
+        positions = self._field_index.positions(_field_key(field, value))
+        return [self.locate(number) for number in positions]
+
+    def transactions_dated(self, start=None, end=None):
+        """Locations of the transactions dated in [start, end], in date order."""
+        low = _date_key(start) if start is not None else bytes(32)
+        high = _date_key(end) if end is not None else b'\xff' * 32
+        return [self.locate(number) for _, number in self._date_index.between(low, high)]
+
+    def height_of(self, block_hash):
+        key = _hash_key(block_hash)
+        return self._block_index.get(key) if key is not None else None
+
+    def has_transaction(self, tx_hash):
+        key = _hash_key(tx_hash)
+        return key is not None and self._tx_index.get(key) is not None
+
+    @property
+    def transaction_count(self):
+        return self._tx_count
+
+    def read(self, height):
+        segment, offset, length, _, _ = self._record(height)
+        if segment == self._segment:
+            self._segment_file.flush()
+        reader = self._readers.get(segment)
+        if reader is None:
+            reader = self._readers[segment] = open(self._segment_path(segment), 'rb')
+        reader.seek(offset + _LENGTH.size)
+        return decode_block(reader.read(length))
+
+    def append(self, block):
+        payload = encode_block(block)
+        if self._segment_file.tell() >= self.segment_size:
+            self.flush()
+            self._segment_file.close()
+            self._segment += 1
+            self._open_segment()
+        offset = self._segment_file.tell()
+        self._segment_file.write(_LENGTH.pack(len(payload)) + payload)
+        tx_hashes = [bytes.fromhex(h) for h in block.transaction_hashes()]
+        self._tx_file.write(b''.join(tx_hashes))
+        self._tx_count += len(tx_hashes)
+        for tx_hash, t in zip(tx_hashes, block.transactions):
+            self._tx_index.append(tx_hash)
+            self._field_index.append(*_field_keys(t))
+            self._date_index.append(_date_key(t.date))
+        block_hash = bytes.fromhex(block.hash())
+        self._pending.append((self._segment, offset, len(payload), self._tx_count, block_hash))
+        self._block_index.append(block_hash)
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every:
+            self.flush()
+
+    def truncate(self, length):
+        """Drop every block at a height of length or above."""
+        if not 1 <= length <= len(self):
+            raise IndexError("Cannot truncate to an empty or longer chain")
+        if length == len(self):
+            return
+        self.flush()
+        segment, offset, size, tx_end, _ = self._record(length - 1)
+        for f in [self._segment_file] + list(self._readers.values()):
+            f.close()
+        self._readers = {}
+        self._index_map.close()
+        self._index_map = None
+        os.truncate(self._index_path, length * _INDEX_RECORD.size)
+        os.truncate(self._segment_path(segment), offset + _LENGTH.size + size)
+        for later in range(segment + 1, self._segment + 1):
+            if os.path.exists(self._segment_path(later)):
+                os.remove(self._segment_path(later))
+        os.truncate(self._tx_path, tx_end * _TX_HASH_SIZE)
+        self._segment = segment
+        self._tx_count = tx_end
+        self._map_index()
+        self._open_segment()
+        self._block_index.truncate(length)
+        for index in self._indexes[1:]:
+            index.truncate(tx_end)
+
+    def transaction_ends(self):
+        """Cumulative transaction count after each block, by height."""
+        mapped = self._index_map[:self._mapped * _INDEX_RECORD.size] if self._mapped else b''
+        return ([r[3] for r in _INDEX_RECORD.iter_unpack(mapped)] +
+                [r[3] for r in self._pending])
+
+    def transaction_index(self):
+        return TransactionIndex(self)
+
+    def flush(self):
+        # Data and transaction hashes reach the disk before the index records
+        # that refer to them.
+        for f in (self._segment_file, self._tx_file):
+            f.flush()
+            os.fsync(f.fileno())
+        if self._pending:
+            self._index_file.write(b''.join(_INDEX_RECORD.pack(*r) for r in self._pending))
+            self._index_file.flush()
+            os.fsync(self._index_file.fileno())
+            self._pending = []
+            self._map_index()
+        self._unsynced = 0
+        # Everything indexed so far is on disk now
+        for index in self._indexes:
+            index.checkpoint()
+
+    def close(self):
+        self.flush()
+        # Spare the next open reading the log back into the buffers
+        for index in self._indexes:
+            index.checkpoint(force=True)
+        for f in [self._segment_file, self._tx_file, self._index_file] + list(self._readers.values()):
+            f.close()
+        self._readers = {}
+        if self._index_map is not None:
+            self._index_map.close()
+            self._index_map = None
+        for index in self._indexes:
+            index.close()
+
+def _hash_key(hex_hash):
+    # Hashes from peers may be malformed
+    try:
+        key = bytes.fromhex(hex_hash)
+    except (TypeError, ValueError):
+        return None
+    return key if len(key) == 32 else None
+
+@lru_cache(maxsize=16384)
+def _field_key(field, value):
+    return hashlib.sha256(f'{field}:{value}'.encode()).digest()
+
+def _field_keys(t):
+    return (_field_key('product', t.product_id), _field_key('author', t.author),
+            _field_key('event', t.event))
+
+def _date_key(date):
+    # Dates sort as strings, like in ChainIndex
+    return str(date).encode()[:32].ljust(32, b'\0')
+
+class TransactionIndex(object):
+    """Set-like view of the transaction hashes of a BlockStore, used as a
+    stored chain's transaction_index. The store adds and drops hashes as
+    blocks are appended and truncated, so update and difference_update have
+    nothing to do."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __contains__(self, tx_hash):
+        return self.store.has_transaction(tx_hash)
+
+    def __len__(self):
+        return self.store.transaction_count
+
+    def __iter__(self):
+        for key in self.store._transaction_hashes(0, self.store.transaction_count):
+            yield key.hex()
+
+    def isdisjoint(self, tx_hashes):
+        return not any(tx_hash in self for tx_hash in tx_hashes)
+
+    def update(self, tx_hashes):
+        pass
+
+    def difference_update(self, tx_hashes):
+        pass
+
+def read_blocks(directory, start, stop):
+    """Decode the blocks at heights start..stop - 1 of a flushed store
+    directly from its files, e.g. from another process. The store is not
+    opened for writing, so no recovery is run."""
+    with open(os.path.join(directory, 'index.dat'), 'rb') as f:
+        f.seek(start * _INDEX_RECORD.size)
+        records = f.read((stop - start) * _INDEX_RECORD.size)
+    if len(records) != (stop - start) * _INDEX_RECORD.size:
+        raise IndexError("Block height out of range")
+    readers = {}
+    try:
+        for segment, offset, length, _, _ in _INDEX_RECORD.iter_unpack(records):
+            reader = readers.get(segment)
+            if reader is None:
+                reader = readers[segment] = open(os.path.join(directory, f'blocks-{segment:05d}.dat'), 'rb')
+            reader.seek(offset + _LENGTH.size)
+            yield decode_block(reader.read(length))
+    finally:
+        for reader in readers.values():
+            reader.close()
+
+class LazyChain(object):
+    """List-like view of a BlockStore that loads blocks on first access."""
+
+    def __init__(self, store, cache_size=config.store_cache_size):
+        self.store = store
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, height):
+        if isinstance(height, slice):
+            return [self[h] for h in range(*height.indices(len(self)))]
+        if height < 0:
+            height += len(self)
+        block = self._cache.get(height)
+        if block is None:
+            # Stored blocks were validated before they were appended
+            block = self.store.read(height)
+            block.seal()
+            self._cache[height] = block
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(height)
+        return block
+
+    def __iter__(self):
+        for height in range(len(self)):
+            yield self[height]
+
+    def append(self, block):
+        self.store.append(block)
+        self._cache[len(self) - 1] = block
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def truncate(self, length):
+        self.store.truncate(length)
+        for height in [h for h in self._cache if h >= length]:
+            del self._cache[height]
+
+    def copy(self):
+        return list(self)
@@ -1,70 +1,367 @@
 # blockchain.py
 
+import time
 import config
+import metrics
 from block import Block, InvalidBlock
-from transaction import Transaction
+from event_store import InvalidDate, parse_date
+from verification import verify_many
+from mempool import Mempool
+from block_store import BlockStore, LazyChain
+from chain_index import ChainIndex, StoredChainIndex
+
+def _seconds_between(earlier, later):
+    return parse_date(later.timestamp) - parse_date(earlier.timestamp)
+
+def valid_timestamp(block, parent):
+    """Whether the block's timestamp is a date no earlier than its parent's
+    and at most config.max_block_drift seconds ahead of our clock. Retargets
+    read these timestamps, so a block could otherwise skew the difficulty or
+    stop the chain at the next retarget height."""
+    try:
+        seconds = parse_date(block.timestamp)
+        parent_seconds = parse_date(parent.timestamp)
+    except InvalidDate:
+        return False
+    return parent_seconds <= seconds <= time.time() + config.max_block_drift
+
+def expected_difficulty(chain, height):
+    """Difficulty the block at height must carry, given the blocks below it.
+
+    Every retarget_interval blocks the parent's difficulty is scaled by how
+    far the last interval's block times were from target_block_interval, by
+    at most retarget_max_factor either way. The genesis timestamp is never
+    used, since it says nothing about mining speed.
+    """
+    parent = chain[height - 1]
+    interval = config.retarget_interval
+    if not interval or height % interval or height - interval - 1 < 1:
+        return parent.difficulty
+    expected = interval * config.target_block_interval
+    factor = config.retarget_max_factor
+    span = _seconds_between(chain[height - interval - 1], parent)
+    span = min(max(span, -(-expected // factor)), expected * factor)
+    return max(config.min_difficulty, parent.difficulty * expected // span)
+
+def valid_size(block):
+    # A single oversized transaction still fits in a block of its own
+    if len(block.transactions) > max(config.blocksize, config.max_blocksize):
+        return False
+    if len(block.transactions) > 1:
+        return sum(t.size() for t in block.transactions) <= config.block_byte_budget
+    return True
 
 class Blockchain(object):
-    def __init__(self):
-        self.chain = [Block()]
-        self.mempool = []
+    def __init__(self, store=None, genesis=None):
+        # Nodes that sync with each other must share the same genesis block
+        self.store = store
+        if store is None:
+            self.chain = [genesis or Block()]
+        else:
+            self.chain = LazyChain(store)
+            if not len(self.chain):
+                self.chain.append(genesis or Block())
+        self.mempool = Mempool()
+        self.chain[0].seal()
+        self._reset_validation()
+        if store is not None:
+            # Stored blocks were validated before they were appended, so only
+            # the transaction index has to be loaded, and only when needed.
+            self._validated_height = len(store) - 1
+            self._validated_hash = store.hash_at(-1)
+            self._transaction_index = None
+
+    @classmethod
+    def open(cls, directory, **kwargs):
+        """Open (or create) a chain persisted in a block store directory."""
+        return cls(BlockStore(directory, **kwargs))
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+
+    @property
+    def transaction_index(self):
+        if self._transaction_index is None:
+            self._transaction_index = self.store.transaction_index()
+        return self._transaction_index
+
+    @transaction_index.setter
+    def transaction_index(self, value):
+        self._transaction_index = value
+
+    def _reset_validation(self):
+        # Blocks up to the validated height have been checked and are assumed
+        # immutable; transaction_index holds the hashes of their transactions.
+        self._validated_height = 0
+        self._validated_hash = self.chain[0].hash()
+        self.transaction_index = set()
+        self.index = ChainIndex() if self.store is None else StoredChainIndex(self.store)
+
+    def _mark_validated(self, height, tx_hashes):
+        block = self.chain[height]
+        block.seal()
+        self.transaction_index.update(tx_hashes)
+        self._validated_height = height
+        self._validated_hash = block.hash()
+        if self.index.height == height - 1:
+            self.index.add_block(block, height)
+
+    def _check_transactions(self, tx_hashes):
+        if len(set(tx_hashes)) != len(tx_hashes):
+            return False
+        return self.transaction_index.isdisjoint(tx_hashes)
 
     @property
     def last_block(self):
         return self.chain[-1]
 
+    @metrics.timed('blockchain_add_transaction')
     def add_transaction(self, transaction):
-        if transaction.verify() and transaction not in self.mempool:
-            self.mempool.append(transaction)
-            return True
-        else:
+        if transaction in self.mempool or transaction.hash() in self.transaction_index:
             return False
+        if not transaction.verify():
+            return False
+        added = self.mempool.add(transaction)
+        if metrics.enabled:
+            metrics.registry.set_gauge('mempool_depth', len(self.mempool))
+        return added
+
+    def add_transactions(self, transactions, verify=True):
+        # Signatures are checked as one batch, in parallel for large batches;
+        # verify=False trusts transactions that were just signed locally.
+        # Returns whether each transaction was added, in order.
+        index = self.transaction_index
+        fresh = [t.hash() not in index for t in transactions]
+        candidates = [t for t, new in zip(transactions, fresh) if new]
+        valid = iter(verify_many(candidates) if verify else [True] * len(candidates))
+        added = []
+        for transaction, new in zip(transactions, fresh):
+            added.append(new and next(valid) and self.mempool.add(transaction))
+        return added
+
+    def next_difficulty(self):
+        return expected_difficulty(self.chain, len(self.chain))
+
+    def block_size(self):
+        """Transactions to put in the next block: config.blocksize, growing
+        with the mempool backlog up to config.max_blocksize."""
+        return max(config.blocksize, min(len(self.mempool) // config.blocksize_pressure,
+                                         config.max_blocksize))
 
     def new_block(self, block=None):
         if block is None:
             block = self.last_block
-        transactions = self.mempool[:config.blocksize]
-        self.mempool = self.mempool[config.blocksize:]
-        new_block = block.next(transactions)
+        transactions = self.mempool.pop(self.block_size(), config.block_byte_budget)
+        new_block = block.next(transactions, expected_difficulty(self.chain, block.index + 1))
         return new_block
 
-    def extend_chain(self, block):
+    @metrics.timed('blockchain_extend_chain')
+    def extend_chain(self, block, verify=True):
+        # verify=False for blocks mined here from the mempool, whose
+        # transactions were verified when they were added to it
         if block.previous_hash != self.last_block.hash():
             raise InvalidBlock("Invalid previous hash")
         if block.index != self.last_block.index + 1:
             raise InvalidBlock("Invalid index")
+        if block.difficulty != self.next_difficulty():
+            raise InvalidBlock("Invalid difficulty")
+        if not valid_size(block):
+            raise InvalidBlock("Block too large")
         if not block.validity():
             raise InvalidBlock("Invalid block")
+        if not valid_timestamp(block, self.last_block):
+            raise InvalidBlock("Invalid timestamp")
+        if verify:
+            # Transactions still in our mempool were verified on arrival
+            unverified = [t for t in block.transactions if t not in self.mempool]
+            if not all(verify_many(unverified)):
+                raise InvalidBlock("Invalid transaction signature")
+        tx_hashes = block.transaction_hashes()
+        at_tip = self._validated_height == self.last_block.index
+        if at_tip and not self._check_transactions(tx_hashes):
+            raise InvalidBlock("Duplicate transaction")
         self.chain.append(block)
+        if at_tip:
+            self._mark_validated(len(self.chain) - 1, tx_hashes)
+        # Transactions of a block mined elsewhere may still be pending here
+        for tx_hash in tx_hashes:
+            self.mempool.discard(tx_hash)
+        if metrics.enabled:
+            fill_ratio = len(block.transactions) / max(config.blocksize, config.max_blocksize)
+            metrics.registry.set_gauge('chain_height', len(self.chain) - 1)
+            metrics.registry.set_gauge('mempool_depth', len(self.mempool))
+            metrics.registry.set_gauge('last_block_fill_ratio', fill_ratio)
+            metrics.registry.observe('block_fill_ratio', fill_ratio, metrics.ratio_buckets)
 
     def __str__(self):
         return f"Blockchain: {len(self.chain)} blocks"
 
-    def validity(self):
+    def validity(self, full=False):
+        """Check the chain; with full=True revalidate it from genesis and
+        re-verify every transaction signature in parallel."""
         if self.chain[0].index != 0:
             return False
-        used_transactions = set()
-        for i in range(1, len(self.chain)):
+        # Only blocks above the validated height need checking, unless the
+        # chain was replaced underneath us.
+        height = self._validated_height
+        if full or height >= len(self.chain) or self.chain[height].hash() != self._validated_hash:
+            self._reset_validation()
+        if full:
+            transactions = [t for block in self.chain for t in block.transactions]
+            if not all(verify_many(transactions)):
+                return False
+        for i in range(self._validated_height + 1, len(self.chain)):
             block = self.chain[i]
             prev_block = self.chain[i - 1]
-            if block.previous_hash != prev_block.hash():
+            if block.previous_hash != prev_block.hash() or not valid_timestamp(block, prev_block):
+                return False
+            if block.difficulty != expected_difficulty(self.chain, i) or not valid_size(block):
                 return False
             if not block.validity():
                 return False
-            for t in block.transactions:
-                tx_hash = t.hash()
-                if tx_hash in used_transactions:
-                    return False
-                used_transactions.add(tx_hash)
+            tx_hashes = block.transaction_hashes()
+            if not self._check_transactions(tx_hashes):
+                return False
+            self._mark_validated(i, tx_hashes)
         return True
 
+    def _update_index(self):
+        # Index blocks validated since the last query; a store indexes its own
+        for height in range(self.index.height + 1, self._validated_height + 1):
+            self.index.add_block(self.chain[height], height)
+
+    def height_of(self, block_hash):
+        """Height of a validated block on this chain, or None."""
+        if block_hash == self.chain[0].hash():
+            return 0
+        if self.store is not None:
+            height = self.store.height_of(block_hash)
+            return height if height is not None and height <= self._validated_height else None
+        self._update_index()
+        return self.index.blocks.get(block_hash)
+
+    def _locate(self, locations, verify):
+        self._update_index()
+        # A store also indexes blocks appended beyond the validated height
+        transactions = [self.chain[height].transactions[position] for height, position in locations()
+                        if height <= self._validated_height]
+        if verify and not all(verify_many(transactions)):
+            raise InvalidBlock("Invalid transaction signature on chain")
+        return transactions
+
+    def product_transactions(self, product_id, verify=True):
+        """Validated on-chain transactions for a product, in chain order."""
+        return self._locate(lambda: self.index.product(product_id), verify)
+
+    def author_transactions(self, author, verify=True):
+        return self._locate(lambda: self.index.author(author), verify)
+
+    def event_transactions(self, event, verify=True):
+        return self._locate(lambda: self.index.event(event), verify)
+
+    def transactions_between(self, start=None, end=None, verify=True):
+        """Transactions dated between start and end (inclusive), in date order."""
+        return self._locate(lambda: self.index.date_range(start, end), verify)
+
     def __len__(self):
         return len(self.chain)
 
+    def block_hash(self, height):
+        # Stored chains answer from the index, without decoding the block
+        if self.store is not None:
+            return self.store.hash_at(height)
+        return self.chain[height].hash()
+
+    def transaction_counts(self):
+        """Number of transactions in each block, by height."""
+        if self.store is not None:
+            ends = self.store.transaction_ends()
+            return [end - start for start, end in zip([0] + ends[:-1], ends)]
+        return [len(block.transactions) for block in self.chain]
+
+    def _common_ancestor(self, other):
+        # Heights where both chains hold the same block form a prefix, so the
+        # last shared height is found by binary search; -1 if none is shared.
+        lo, hi = -1, min(len(self.chain), len(other.chain)) - 1
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self.chain[mid].hash() == other.chain[mid].hash():
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+    def _valid_fork(self, ancestor, ours, theirs, chain):
+        orphaned = {h for block in ours for h in block.transaction_hashes()}
+        seen = set()
+        transactions = []
+        prev_block = self.chain[ancestor] if ancestor >= 0 else None
+        for height, block in enumerate(theirs, ancestor + 1):
+            if block.index != height:
+                return False
+            if height > 0:
+                if block.previous_hash != prev_block.hash() or not block.validity():
+                    return False
+                if not valid_timestamp(block, prev_block):
+                    return False
+                if block.difficulty != expected_difficulty(chain, height) or not valid_size(block):
+                    return False
+                for tx_hash in block.transaction_hashes():
+                    if tx_hash in seen or (tx_hash in self.transaction_index and tx_hash not in orphaned):
+                        return False
+                    seen.add(tx_hash)
+                transactions.extend(block.transactions)
+            prev_block = block
+        return all(verify_many(transactions))
+
+    def _switch_fork(self, ancestor, ours, theirs):
+        for height in reversed(range(ancestor + 1, ancestor + 1 + len(ours))):
+            block = ours[height - ancestor - 1]
+            self.transaction_index.difference_update(block.transaction_hashes())
+            if self.index.height == height:
+                self.index.remove_block(block, height)
+        if ancestor < 0:
+            self.chain = [theirs[0]]
+            theirs = theirs[1:]
+            self._reset_validation()
+        elif isinstance(self.chain, list):
+            del self.chain[ancestor + 1:]
+        else:
+            self.chain.truncate(ancestor + 1)
+        self._validated_height = ancestor if ancestor >= 0 else 0
+        self._validated_hash = self.last_block.hash()
+        # Signatures were checked by _valid_fork
+        for block in theirs:
+            self.extend_chain(block, verify=False)
+        # Transactions only in the abandoned blocks go back to the mempool
+        self.add_transactions([t for block in ours for t in block.transactions
+                               if t.hash() not in self.transaction_index])
+
     def merge(self, other):
-        if len(other.chain) > len(self.chain) and other.validity():
-            self.chain = other.chain.copy()
-            self.mempool = other.mempool.copy()
+        """Sync with another node's chain.
+
+        Only the blocks after the last common block are validated. The other
+        fork is adopted if it carries more cumulative work than ours, and the
+        transactions of our abandoned blocks return to the mempool. The other
+        node's pending transactions are merged into ours either way. Returns
+        True if the chain was switched. A stored chain never adopts a chain
+        with another genesis block, since its store cannot replace it.
+        """
+        # Bring the validated height and transaction index up to our tip
+        self.validity()
+        ancestor = self._common_ancestor(other)
+        ours = self.chain[ancestor + 1:]
+        theirs = other.chain[ancestor + 1:]
+        switched = False
+        if (not (ancestor < 0 and self.store is not None)
+                and sum(block.work() for block in theirs) > sum(block.work() for block in ours)
+                and self._valid_fork(ancestor, ours, theirs, other.chain)):
+            self._switch_fork(ancestor, ours, theirs)
+            switched = True
+        self.add_transactions([t for t in other.mempool
+                               if t not in self.mempool and t.hash() not in self.transaction_index])
+        return switched
 
     def log(self):
         print(self)
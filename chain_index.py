@@ -0,0 +1,100 @@
+# chain_index.py
+
+import bisect
+from collections import defaultdict
+
+class ChainIndex(object):
+    """Secondary indexes over the transactions on a chain.
+
+    Every entry is a (block height, position in block) location, and blocks
+    can also be looked up by hash. Blocks must be added in height order;
+    dates are kept sorted for range lookups, which is cheap since blocks are
+    drained from the mempool in date order.
+    """
+
+    def __init__(self):
+        self.height = 0  # Highest indexed block
+        self.blocks = {}  # Block hash -> height
+        self.by_product = defaultdict(list)
+        self.by_author = defaultdict(list)
+        self.by_event = defaultdict(list)
+        self._dates = []  # (date, height, position), sorted
+
+    def add_block(self, block, height):
+        if height != self.height + 1:
+            raise ValueError(f"Expected block {self.height + 1}, got {height}")
+        self.blocks[block.hash()] = height
+        for position, t in enumerate(block.transactions):
+            location = (height, position)
+            self.by_product[t.product_id].append(location)
+            self.by_author[t.author].append(location)
+            self.by_event[t.event].append(location)
+            entry = (t.date, height, position)
+            if not self._dates or self._dates[-1] <= entry:
+                self._dates.append(entry)
+            else:
+                bisect.insort(self._dates, entry)
+        self.height = height
+
+    def remove_block(self, block, height):
+        """Undo add_block for the highest indexed block, e.g. on a fork switch."""
+        if height != self.height:
+            raise ValueError(f"Can only remove block {self.height}, got {height}")
+        self.blocks.pop(block.hash(), None)
+        for position in reversed(range(len(block.transactions))):
+            t = block.transactions[position]
+            for index, key in ((self.by_product, t.product_id), (self.by_author, t.author),
+                               (self.by_event, t.event)):
+                locations = index[key]
+                locations.pop()
+                if not locations:
+                    del index[key]
+            entry = (t.date, height, position)
+            del self._dates[bisect.bisect_left(self._dates, entry)]
+        self.height = height - 1
+
+    def product(self, product_id):
+        return self.by_product.get(product_id, [])
+
+    def author(self, author):
+        return self.by_author.get(author, [])
+
+    def event(self, event):
+        return self.by_event.get(event, [])
+
+    def date_range(self, start=None, end=None):
+        """Locations of transactions dated in [start, end], in date order."""
+        lo = 0 if start is None else bisect.bisect_left(self._dates, (start,))
+        hi = len(self._dates) if end is None else bisect.bisect_right(self._dates, (end, float('inf')))
+        return [(height, position) for _, height, position in self._dates[lo:hi]]
+
+class StoredChainIndex(object):
+    """ChainIndex queries answered from the on-disk indexes of a BlockStore,
+    so a reopened chain does not decode its blocks to index them. The store
+    indexes blocks as they are appended and truncated, so add_block and
+    remove_block have nothing to do."""
+
+    def __init__(self, store):
+        self.store = store
+
+    @property
+    def height(self):
+        return len(self.store) - 1
+
+    def add_block(self, block, height):
+        pass
+
+    def remove_block(self, block, height):
+        pass
+
+    def product(self, product_id):
+        return self.store.transactions_with('product', product_id)
+
+    def author(self, author):
+        return self.store.transactions_with('author', author)
+
+    def event(self, event):
+        return self.store.transactions_with('event', event)
+
+    def date_range(self, start=None, end=None):
+        return self.store.transactions_dated(start, end)
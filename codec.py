@@ -0,0 +1,116 @@
+# codec.py
+#
+# Compact binary encoding of transactions and blocks. Strings are written
+# with a 16-bit length prefix (0xFFFF stands for None) and hex digests and
+# signatures as raw bytes, so decoding gives back exactly the JSON form as
+# long as hex fields are lowercase, as produced by Transaction.sign.
+
+import struct
+from transaction import Transaction
+from block import Block
+
+_NONE = 0xFFFF
+_U16 = struct.Struct('<H')
+_U32 = struct.Struct('<I')
+_BLOCK_HEADER = struct.Struct('<QQQ32s32s')  # index, nonce, difficulty, previous_hash, merkle_root
+
+class DecodeError(Exception):
+    pass
+
+def _pack_bytes(value):
+    if value is None:
+        return _U16.pack(_NONE)
+    if len(value) >= _NONE:
+        raise ValueError("Field too long to encode")
+    return _U16.pack(len(value)) + value
+
+def _pack_str(value):
+    return _pack_bytes(None if value is None else value.encode())
+
+def _pack_hex(value):
+    return _pack_bytes(None if value is None else bytes.fromhex(value))
+
+class _Reader(object):
+    def __init__(self, data, offset=0):
+        self.data = data
+        self.offset = offset
+
+    def take(self, size):
+        end = self.offset + size
+        if end > len(self.data):
+            raise DecodeError("Truncated record")
+        value = self.data[self.offset:end]
+        self.offset = end
+        return value
+
+    def unpack(self, fmt):
+        return fmt.unpack(self.take(fmt.size))
+
+    def bytes(self):
+        (length,) = self.unpack(_U16)
+        return None if length == _NONE else bytes(self.take(length))
+
+    def str(self):
+        value = self.bytes()
+        try:
+            return None if value is None else value.decode()
+        except UnicodeDecodeError:
+            raise DecodeError("Invalid UTF-8 string") from None
+
+    def hex(self):
+        value = self.bytes()
+        return None if value is None else value.hex()
+
+def encode_transaction(transaction):
+    return b''.join((
+        _pack_str(transaction.product_id),
+        _pack_str(transaction.event),
+        _pack_str(transaction.date),
+        _pack_hex(transaction.signature),
+        _pack_str(transaction.public_key),
+        _pack_hex(transaction.author),
+        _pack_str(transaction.scheme),
+    ))
+
+def _read_transaction(reader):
+    return Transaction(
+        product_id=reader.str(),
+        event=reader.str(),
+        date=reader.str(),
+        signature=reader.hex(),
+        public_key=reader.str(),
+        author=reader.hex(),
+        scheme=reader.str(),
+    )
+
+def decode_transaction(data):
+    return _read_transaction(_Reader(data))
+
+def encode_block(block):
+    parts = [
+        _BLOCK_HEADER.pack(block.index, block.nonce, block.difficulty, bytes.fromhex(block.previous_hash),
+                           bytes.fromhex(block.merkle_root)),
+        _pack_str(block.timestamp),
+        _pack_str(block.miner),
+        _U32.pack(len(block.transactions)),
+    ]
+    parts.extend(encode_transaction(t) for t in block.transactions)
+    return b''.join(parts)
+
+def decode_block(data):
+    reader = _Reader(data)
+    index, nonce, difficulty, previous_hash, merkle_root = reader.unpack(_BLOCK_HEADER)
+    timestamp = reader.str()
+    miner = reader.str()
+    (count,) = reader.unpack(_U32)
+    transactions = [_read_transaction(reader) for _ in range(count)]
+    return Block({
+        'index': index,
+        'timestamp': timestamp,
+        'transactions': transactions,
+        'previous_hash': previous_hash.hex(),
+        'merkle_root': merkle_root.hex(),
+        'nonce': nonce,
+        'difficulty': difficulty,
+        'miner': miner,
+    })
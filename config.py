@@ -4,5 +4,73 @@ Configuration file for the blockchain. Initialization of various parameters.
 
 blockdepth = 2
 blocksize = 2 ** blockdepth - 1  # Number of messages in a block
+max_blocksize = 1024  # Messages a block may grow to while the mempool backs up
+blocksize_pressure = 4  # A block takes 1/pressure of the pending messages, at least blocksize
+block_byte_budget = 2 ** 20  # Maximum canonical bytes of the messages in a block
 
-default_difficulty = 3
+default_difficulty = 16 ** 3  # Expected hashes per block, 16 ** 3 is three leading zero hex digits
+min_difficulty = 1
+retarget_interval = None  # Blocks between difficulty adjustments, None for a fixed difficulty
+target_block_interval = 10  # Seconds between blocks that retargeting aims for
+retarget_max_factor = 4  # Largest change of one adjustment, in either direction
+max_block_drift = 2 * 60 * 60  # Seconds a block timestamp may be ahead of the local clock
+
+mining_workers = 1  # Processes used by Block.mine, None for one per CPU
+mining_batch_size = 10000  # Nonces tried between cancellation checks
+
+key_cache_size = 4096  # Parsed verifying keys kept in memory
+verify_workers = None  # Processes used by verify_many, None for one per CPU
+verify_chunk_size = 256  # Transactions per verification task
+
+signature_scheme = 'ecdsa'  # 'ecdsa', 'ecdsa-p256' or 'ed25519', see signing.py
+
+mempool_capacity = None  # Maximum pending transactions, None for unbounded
+mempool_eviction = 'oldest'  # 'oldest' evicts the longest waiting, 'reject' refuses new ones
+mempool_author_quota = None  # Maximum pending transactions per author
+
+derived_key_cache_size = 64  # Password-derived encryption keys kept in memory
+cipher_cache_size = 64  # Fernet instances kept for reuse
+encryption_chunk_size = 2 ** 20  # Plaintext bytes per token of an encrypted stream
+
+store_segment_size = 64 * 2 ** 20  # Bytes per block store segment file
+store_sync_every = 64  # Blocks appended between fsyncs
+store_cache_size = 1024  # Decoded blocks kept in memory by a lazy chain
+store_index_buffer = 65536  # Hashes kept in memory before a block store index run is written
+
+snapshot_interval = 1000  # Blocks between product state snapshots
+snapshot_keep = 3  # Snapshot files kept on disk
+snapshot_range_size = 5000  # Blocks folded per task by a parallel rebuild
+
+ingest_batch_size = 1000  # Events per batch passed between ingest stages
+ingest_queue_size = 8  # Batches queued between two ingest stages
+ingest_progress_every = 100000  # Rows between ingest progress logs
+
+simulation_batch_size = 4096  # Random delays drawn per vectorized batch
+simulation_event_batch = 1000  # Events applied together through create_many / update_many
+simulation_mine_backlog = max_blocksize  # Pending transactions the simulation waits for before mining
+simulation_progress_every = 10000  # Events between simulation progress logs
+
+parallel_shards = 64  # Product shards of the parallel simulation
+parallel_chunk_size = 4096  # Merged events inserted into the mempool at a time
+
+metrics_enabled = False  # Collect hot-path metrics, see metrics.py
+
+network_tx_queue_size = 10000  # Inbound transactions a node queues before dropping
+network_tx_batch = 256  # Inbound transactions verified per batch
+
+chart_max_blocks = 500  # Most recent blocks drawn one by one by visualize_blockchain
+chart_overview_points = 2000  # Points of the whole-chain overview
+timeline_max_products = 2000  # Products drawn by generate_gantt_chart
+
+dashboard_products = 1000  # Products simulated behind the dashboard
+dashboard_step_events = 50  # Simulation events between dashboard updates
+dashboard_step_delay = 0.5  # Seconds the simulation pauses between steps
+dashboard_refresh_ms = 2000  # Browser polling interval
+dashboard_max_blocks = 500  # Most recent blocks drawn in the chain view
+
+analytics_chunk_rows = 2 ** 22  # Event rows folded into the metrics at a time
+analytics_export_rows = 2 ** 20  # Event rows per Arrow record batch or Parquet row group
+analytics_export_blocks = 1000  # Blocks per record batch of a chain export
+analytics_period = 86400  # Seconds per throughput period
+analytics_bottleneck_factor = 2.0  # Mean dwell over the status median that flags an entity
+analytics_bottleneck_min_events = 10  # Dwell samples an entity needs to be flagged
@@ -2,34 +2,166 @@
 
 import os
 import base64
+import hashlib
+import hmac
+import json
+import struct
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 from cryptography.fernet import Fernet
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+import config
+from signing import export_keys, import_keys
 
 default_salt = b'\xb1\xc7\xbb\x04K\xd4\n~uA\xbe\xa4\x1a\xaeV\xe3'
+iterations = 100000
+
+# Streams are length-prefixed Fernet tokens; each token holds a random
+# stream id, the chunk's position and whether it is the last one, so
+# reordered, dropped or truncated chunks, and chunks spliced in from another
+# stream under the same key, are detected.
+_LENGTH = struct.Struct('<I')
+_CHUNK_HEADER = struct.Struct('<16sQ?')
+_STREAM_ID_SIZE = 16
+_KEY_STORE_MAGIC = b'SCKS1'
+_SALT_SIZE = 16
+
+# Derived keys are cached under an HMAC of (salt, password) with a secret
+# of this process, so the cache holds no passwords nor plain hashes of them.
+_cache_secret = os.urandom(32)
+_derived = OrderedDict()
+_derived_lock = threading.Lock()
+
+class StreamError(Exception):
+    pass
 
 def generate_salt():
-    return os.urandom(16)
+    return os.urandom(_SALT_SIZE)
 
-def generate_private_key(password, salt=default_salt):
-    password = password.encode()
+def _derive(password, salt):
     kdf = PBKDF2HMAC(algorithm=hashes.SHA256(),
                      length=32,
                      salt=salt,
-                     iterations=100000,
+                     iterations=iterations,
                      backend=default_backend())
-    return base64.urlsafe_b64encode(kdf.derive(password))
+    return base64.urlsafe_b64encode(kdf.derive(password.encode()))
+
+def generate_private_key(password, salt=default_salt):
+    # Derived keys are cached per (password, salt), see config.derived_key_cache_size
+    salt = bytes(salt)
+    digest = hmac.new(_cache_secret, struct.pack('<I', len(salt)) + salt + password.encode(),
+                      hashlib.sha256).digest()
+    with _derived_lock:
+        key = _derived.get(digest)
+        if key is not None:
+            _derived.move_to_end(digest)
+            return key
+    key = _derive(password, salt)
+    with _derived_lock:
+        _derived[digest] = key
+        if len(_derived) > config.derived_key_cache_size:
+            _derived.popitem(last=False)
+    return key
+
+@lru_cache(maxsize=config.cipher_cache_size)
+def _fernet(key):
+    return Fernet(key)
 
 def encrypt(data, key):
-    fernet = Fernet(key)
-    data = fernet.encrypt(data)
-    return data
+    return _fernet(key).encrypt(data)
 
 def decrypt(data, key):
-    fernet = Fernet(key)
-    data = fernet.decrypt(data)
-    return data
+    return _fernet(key).decrypt(data)
+
+def encrypt_many(items, key):
+    fernet = _fernet(key)
+    return [fernet.encrypt(data) for data in items]
+
+def decrypt_many(items, key):
+    fernet = _fernet(key)
+    return [fernet.decrypt(data) for data in items]
+
+def encrypt_stream(source, target, key, chunk_size=config.encryption_chunk_size):
+    """Encrypt binary file object source into target one chunk at a time."""
+    fernet = _fernet(key)
+    stream_id = os.urandom(_STREAM_ID_SIZE)
+    position = 0
+    chunk = source.read(chunk_size)
+    while True:
+        following = source.read(chunk_size)
+        token = fernet.encrypt(_CHUNK_HEADER.pack(stream_id, position, not following) + chunk)
+        target.write(_LENGTH.pack(len(token)) + token)
+        if not following:
+            return position + 1
+        chunk = following
+        position += 1
+
+def decrypt_stream(source, target, key):
+    """Decrypt a stream written by encrypt_stream into target."""
+    fernet = _fernet(key)
+    stream_id = None
+    position = 0
+    while True:
+        prefix = source.read(_LENGTH.size)
+        if len(prefix) < _LENGTH.size:
+            raise StreamError("Stream ends before its last chunk")
+        (length,) = _LENGTH.unpack(prefix)
+        token = source.read(length)
+        if len(token) < length:
+            raise StreamError("Truncated chunk")
+        data = fernet.decrypt(token)
+        if len(data) < _CHUNK_HEADER.size:
+            raise StreamError("Chunk too short")
+        chunk_stream, index, last = _CHUNK_HEADER.unpack_from(data)
+        if stream_id is None:
+            stream_id = chunk_stream
+        elif chunk_stream != stream_id:
+            raise StreamError(f"Chunk {position} belongs to another stream")
+        if index != position:
+            raise StreamError(f"Expected chunk {position}, got {index}")
+        target.write(data[_CHUNK_HEADER.size:])
+        if last:
+            if source.read(1):
+                raise StreamError("Data after the last chunk")
+            return position + 1
+        position += 1
+
+def encrypt_file(source_path, target_path, key, chunk_size=config.encryption_chunk_size):
+    with open(source_path, 'rb') as source, open(target_path, 'wb') as target:
+        return encrypt_stream(source, target, key, chunk_size)
+
+def decrypt_file(source_path, target_path, key):
+    with open(source_path, 'rb') as source, open(target_path, 'wb') as target:
+        return decrypt_stream(source, target, key)
+
+def save_keys(path, entity_keys, password, salt=None):
+    """Write signing keys, e.g. SupplyChainManager.entity_keys, to path as
+    one token encrypted with a key derived from password. A fresh salt is
+    stored in the file unless one is given. The file is replaced atomically."""
+    salt = salt or generate_salt()
+    if len(salt) != _SALT_SIZE:
+        raise ValueError(f"Key store salt must be {_SALT_SIZE} bytes, got {len(salt)}")
+    exported = {entity: [scheme, pem.decode()] for entity, (scheme, pem) in export_keys(entity_keys).items()}
+    token = encrypt(json.dumps(exported, separators=(',', ':')).encode(), generate_private_key(password, salt))
+    with open(path + '.tmp', 'wb') as f:
+        f.write(_KEY_STORE_MAGIC + salt + token)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+def load_keys(path, password):
+    """Read the signing keys written by save_keys, as {entity: private key}."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(_KEY_STORE_MAGIC):
+        raise ValueError("Not a key store file")
+    salt = data[len(_KEY_STORE_MAGIC):len(_KEY_STORE_MAGIC) + _SALT_SIZE]
+    token = data[len(_KEY_STORE_MAGIC) + _SALT_SIZE:]
+    exported = json.loads(decrypt(token, generate_private_key(password, salt)))
+    return import_keys({entity: (scheme, pem.encode()) for entity, (scheme, pem) in exported.items()})
 
 def test():
     key = generate_private_key("password")
@@ -41,4 +173,4 @@ def test():
     print(f"Decrypted data : {data.decode()}")
 
 if __name__ == "__main__":
-    test()
\ No newline at end of file
+    test()
@@ -0,0 +1,188 @@
+# event_store.py
+#
+# History events of many products in shared, array-backed columns. Status
+# and entity values are interned to integer ids, products numbered in order
+# of creation and dates kept as epoch seconds, so an event costs 18 bytes
+# instead of a tuple of strings. A product's rows are chained through a
+# next-row column from its first row, and its last row is kept per product
+# number along with its origin, so the product itself only holds its number.
+
+import time
+from array import array
+from datetime import datetime
+from functools import lru_cache
+import numpy as np
+
+date_format = '%Y-%m-%d %H:%M:%S'
+_epoch = datetime(1970, 1, 1)
+
+class InvalidDate(ValueError):
+    pass
+
+@lru_cache(maxsize=16384)
+def format_date(seconds):
+    return time.strftime(date_format, time.gmtime(seconds))
+
+@lru_cache(maxsize=16384)
+def parse_date(date):
+    """Epoch seconds of a 'YYYY-MM-DD HH:MM:SS' UTC date from 1970 to 2106,
+    the range of the store's 32-bit date column. Other forms are rejected,
+    since the date is formatted back from the seconds: the history must read
+    the same as the chain's transactions."""
+    try:
+        seconds = int((datetime.strptime(date, date_format) - _epoch).total_seconds())
+    except (TypeError, ValueError):
+        seconds = None
+    if seconds is None or not 0 <= seconds < 2 ** 32 or format_date(seconds) != date:
+        raise InvalidDate(f"Invalid date {date!r}, expected YYYY-MM-DD HH:MM:SS from 1970 to 2106")
+    return seconds
+
+def valid_date(date):
+    try:
+        parse_date(date)
+    except InvalidDate:
+        return False
+    return True
+
+class Interner(object):
+    """Maps values to dense integer ids and back, at most limit of them."""
+
+    def __init__(self, limit=None):
+        self.ids = {}
+        self.values = []
+        self.limit = limit
+
+    def id(self, value):
+        key = self.ids.get(value)
+        if key is None:
+            if self.limit is not None and len(self.values) >= self.limit:
+                raise OverflowError(f"More than {self.limit} distinct values")
+            key = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return key
+
+    def __len__(self):
+        return len(self.values)
+
+def _now():
+    return int(time.time())
+
+class EventStore(object):
+    """Append-only columns of (product, status, entity, date) events."""
+
+    def __init__(self):
+        self.product_ids = []  # By product number
+        self.origins = Interner()
+        self.origin = array('i')  # Origin id of each product
+        self.first = array('q')  # First and last row of each product
+        self.last = array('q')
+        self.statuses = Interner(limit=2 ** 16)
+        self.entities = Interner()
+        self.product = array('i')
+        self.status = array('H')
+        self.entity = array('i')
+        self.date = array('I')  # Epoch seconds, see parse_date
+        self.next = array('I')  # Rows to the product's next event, 0 for none
+
+    def _append(self, number, status, entity, seconds):
+        # Values are resolved by the caller, so nothing here can fail half
+        # way. The date column is appended last: readers in other threads
+        # take its length as the number of complete rows.
+        row = len(self.date)
+        self.product.append(number)
+        self.status.append(status)
+        self.entity.append(entity)
+        self.next.append(0)
+        self.date.append(seconds)
+        return row
+
+    def add_product(self, product_id, status, entity, date=None, origin=None):
+        """Record a product's first event and return the product's number."""
+        seconds = _now() if date is None else parse_date(date)
+        status, entity = self.statuses.id(status), self.entities.id(entity)
+        number = len(self.product_ids)
+        self.product_ids.append(product_id)
+        self.origin.append(self.origins.id(origin))
+        row = self._append(number, status, entity, seconds)
+        self.first.append(row)
+        self.last.append(row)
+        return number
+
+    def append(self, number, status, entity, date=None):
+        """Record a later event of product number and return its row."""
+        seconds = _now() if date is None else parse_date(date)
+        status, entity = self.statuses.id(status), self.entities.id(entity)
+        # Linked before the row is complete, so a reader never sees the new
+        # row without the link to it
+        previous = self.last[number]
+        self.next[previous] = len(self.date) - previous
+        row = self._append(number, status, entity, seconds)
+        self.last[number] = row
+        return row
+
+    def extend(self, numbers, statuses, entities, dates):
+        """Record later events of many products at once, the i-th of product
+        number numbers[i], in order. All values are checked before anything
+        is recorded. Returns the row of the first event."""
+        now = _now()
+        seconds = array('I', [now if date is None else parse_date(date) for date in dates])
+        numbers = array('i', numbers)
+        statuses = array('H', map(self.statuses.id, statuses))
+        entities = array('i', map(self.entities.id, entities))
+        row = len(self.date)
+        self.product.extend(numbers)
+        self.status.extend(statuses)
+        self.entity.extend(entities)
+        self.next.extend(array('I', bytes(4 * len(seconds))))
+        # Linked before the rows are complete, as in append
+        following, last = self.next, self.last
+        latest = {}
+        for current, number in enumerate(numbers, row):
+            previous = latest.get(number)
+            if previous is None:
+                previous = last[number]
+            following[previous] = current - previous
+            latest[number] = current
+        self.date.extend(seconds)
+        for number, current in latest.items():
+            last[number] = current
+        return row
+
+    def rows(self, number):
+        row = self.first[number]
+        while True:
+            yield row
+            step = self.next[row]
+            if not step or row + step >= len(self.date):
+                return
+            row += step
+
+    def event(self, row):
+        """(status, entity, date) of a row, with the date formatted."""
+        return (self.statuses.values[self.status[row]], self.entities.values[self.entity[row]],
+                format_date(self.date[row]))
+
+    def columns(self, start=0, stop=None):
+        """Copies of the columns of rows start to stop as NumPy arrays. A view
+        would hold the arrays' buffers and block further appends. next is
+        the offset to the product's next row, 0 for its last one."""
+        return {
+            'product': np.frombuffer(self.product, dtype=np.int32)[start:stop].copy(),
+            'status': np.frombuffer(self.status, dtype=np.uint16)[start:stop].astype(np.int32),
+            'entity': np.frombuffer(self.entity, dtype=np.int32)[start:stop].copy(),
+            'date': np.frombuffer(self.date, dtype=np.uint32)[start:stop].astype(np.int64),
+            'next': np.frombuffer(self.next, dtype=np.uint32)[start:stop].copy(),
+        }
+
+    def product_origins(self, start=0, stop=None):
+        """Origin ids of products numbered start to stop, as a NumPy array."""
+        return np.frombuffer(self.origin, dtype=np.int32)[start:stop].copy()
+
+    def __len__(self):
+        return len(self.date)
+
+    def nbytes(self):
+        # Memory held by the columns, not counting the interned values
+        return sum(column.itemsize * len(column)
+                   for column in (self.product, self.status, self.entity, self.date, self.next,
+                                  self.origin, self.first, self.last))
@@ -0,0 +1,376 @@
+# ingest.py
+#
+# Streaming bulk ingest of supply chain events, e.g. a partner's history:
+#
+#     python ingest.py events.jsonl --roles roles.json --store chain/
+#
+# Events are read one line at a time from JSONL or CSV with the fields
+# product_id, status, entity, date and origin; a status of "Created" (or
+# none) creates the product. Reading, validation, signing and insertion run
+# as pipeline stages connected by bounded queues, so a slow stage holds back
+# the ones before it instead of letting batches pile up in memory.
+
+import argparse
+import csv
+import json
+import logging
+import queue
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime
+import config
+from blockchain import Blockchain
+from event_store import valid_date
+from product import Product
+from signing import export_keys, import_keys
+from snapshot import SnapshotStore
+from supply_chain import SupplyChainManager, status_roles, previous_status
+from transaction import Transaction, signer_of
+from verification import verify_many
+
+logger = logging.getLogger(__name__)
+
+IngestReport = namedtuple('IngestReport', ['rows', 'accepted', 'rejected', 'blocks', 'elapsed'])
+
+_END = object()
+
+def read_events(path, format=None):
+    """Yield the events of a JSONL or CSV file as dicts, without loading it.
+    A malformed JSONL line is logged and yielded as None, which the
+    pipeline counts as rejected."""
+    format = format or ('csv' if path.endswith('.csv') else 'jsonl')
+    with open(path, newline='') as f:
+        if format == 'csv':
+            yield from csv.DictReader(f)
+        else:
+            for number, line in enumerate(f, 1):
+                if line.strip():
+                    try:
+                        yield json.loads(line)
+                    except ValueError as e:
+                        logger.warning("Malformed line %d of %s: %s", number, path, e)
+                        yield None
+
+def _batches(events, size):
+    batch = []
+    for event in events:
+        batch.append(event)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _put(q, item, stop):
+    # Blocks while the queue is full, unless the pipeline is being stopped
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _items(q, stop):
+    while not stop.is_set():
+        try:
+            item = q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is _END:
+            return
+        yield item
+
+_signers = {}  # Entity -> (private key, signer_of(private key))
+
+def _signers_of(keys):
+    return {entity: (key, signer_of(key)) for entity, key in keys.items()}
+
+def _init_signer(exported_keys):
+    global _signers
+    _signers = _signers_of(import_keys(exported_keys))
+
+def _sign_batch(new_keys, items):
+    # Runs in a worker; keys of entities added after the pool started come
+    # along with the batches that use them
+    if new_keys:
+        _signers.update(_signers_of(import_keys(new_keys)))
+    return [_sign(_signers[entity], product_id, event, date)
+            for product_id, event, date, entity in items]
+
+def _sign(signer, product_id, event, date):
+    transaction = Transaction(product_id, event, date=date)
+    transaction.sign(*signer)
+    return transaction.signature
+
+class Ingest(object):
+    """One run of the ingest pipeline into a SupplyChainManager.
+
+    Events for entities without the role their status needs, unknown
+    products, duplicate creations, statuses out of lifecycle order and dates
+    not in YYYY-MM-DD HH:MM:SS form are rejected and counted. With
+    assign_roles, an unknown entity is given the role of its first event.
+    Signatures are trusted when inserting into the mempool unless verify is
+    set.
+    """
+
+    def __init__(self, scm, workers=None, batch_size=config.ingest_batch_size,
+                 queue_size=config.ingest_queue_size, assign_roles=False, mine=True, verify=False,
+                 progress_every=config.ingest_progress_every):
+        self.scm = scm
+        self.workers = workers
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.assign_roles = assign_roles
+        self.mine = mine
+        self.verify = verify
+        self.progress_every = progress_every
+        self.rows = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.blocks = 0
+        self._new_keys = {}  # Exported keys of entities added while running
+        self._signers = {}
+        self._stop = threading.Event()
+        self._errors = []
+        # Status of products after the validated events not yet inserted,
+        # shared by the validate stage and the inserting thread
+        self._planned = {}
+        self._planned_lock = threading.Lock()
+        # Rows are rejected both by the validate stage and when inserting
+        self._rejected_lock = threading.Lock()
+
+    def _stage(self, name, work, source, outbox):
+        # Applies work to every item from source, an iterable or the queue of
+        # the previous stage, until it ends or the pipeline is stopped
+        def run():
+            try:
+                items = _items(source, self._stop) if isinstance(source, queue.Queue) else source
+                for item in items:
+                    if not _put(outbox, work(item), self._stop):
+                        break
+            except BaseException as e:
+                self._errors.append(e)
+                self._stop.set()
+            finally:
+                _put(outbox, _END, self._stop)
+        return threading.Thread(target=run, name=f"ingest-{name}", daemon=True)
+
+    def _role_for(self, role, entity):
+        if self.scm.roles.has_role(role, entity):
+            return True
+        if not self.assign_roles or any(entity in members for members in self.scm.roles.roles.values()):
+            return False
+        self.scm.assign_role(role, entity)
+        self._new_keys.update(export_keys({entity: self.scm.entity_keys[entity]}))
+        return True
+
+    def _current(self, product_id):
+        # Status a new event of the product must follow, None if it does not exist
+        with self._planned_lock:
+            status = self._planned.get(product_id)
+        if status is None:
+            product = self.scm.products.get(product_id)
+            status = product.status if product is not None else None
+        return status
+
+    def _settle(self, product_id, status):
+        # The event setting status was inserted or rejected
+        with self._planned_lock:
+            if self._planned.get(product_id) == status:
+                del self._planned[product_id]
+
+    def _reject(self, count):
+        with self._rejected_lock:
+            self.rejected += count
+
+    def _signer(self, entity):
+        signer = self._signers.get(entity)
+        if signer is None:
+            key = self.scm.entity_keys[entity]
+            signer = self._signers[entity] = (key, signer_of(key))
+        return signer
+
+    def _validate(self, batch):
+        # Permissions are checked once per (role, entity) pair in the batch.
+        # Products are left alone; the events are checked against them again
+        # when inserted.
+        allowed = {}
+        items = []
+        rejected = 0
+        now = None
+        for row in batch:
+            if not isinstance(row, dict):
+                rejected += 1
+                continue
+            product_id = row.get('product_id')
+            status = row.get('status') or "Created"
+            entity = row.get('entity') or row.get('updated_by')
+            date = row.get('date')
+            if not date:
+                now = now or datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+                date = now
+            current = self._current(product_id) if product_id else None
+            if status == "Created":
+                role, event = 'supplier', "ProductCreated"
+                valid = product_id and current is None
+            else:
+                role, event = status_roles.get(status), f"StatusUpdated to {status}"
+                valid = role is not None and current is not None and current == previous_status[status]
+            if not entity or not valid_date(date):
+                valid = False
+            elif valid:
+                key = (role, entity)
+                if key not in allowed:
+                    allowed[key] = self._role_for(role, entity)
+                valid = allowed[key]
+            if not valid:
+                rejected += 1
+                continue
+            with self._planned_lock:
+                self._planned[product_id] = status
+            items.append((product_id, event, date, entity, status, row.get('origin')))
+        self._reject(rejected)
+        new_keys = {entity: self._new_keys[entity] for entity in {item[3] for item in items}
+                    if entity in self._new_keys}
+        return new_keys, items
+
+    def _insert(self, items, signatures):
+        transactions = []
+        for (product_id, event, date, entity, _, _), signature in zip(items, signatures):
+            _, (backend, public_key, author) = self._signer(entity)
+            transactions.append(Transaction(product_id, event, date=date, signature=signature,
+                                            public_key=public_key, author=author, scheme=backend.name))
+        blockchain = self.scm.blockchain
+        products = self.scm.products
+        valid = verify_many(transactions) if self.verify else [True] * len(transactions)
+        index = blockchain.transaction_index
+        rejected = 0
+        for (product_id, _, date, entity, status, origin), transaction, ok in zip(items, transactions, valid):
+            # Earlier events may have been rejected since this one was validated
+            product = products.get(product_id)
+            if status == "Created":
+                ok = ok and product is None
+            else:
+                ok = ok and product is not None and product.status == previous_status[status]
+            if ok and transaction.hash() not in index and blockchain.mempool.add(transaction):
+                if product is None:
+                    products[product_id] = Product(product_id, origin, entity, date=date,
+                                                   store=self.scm.events)
+                else:
+                    product.update_status(status, entity, date=date)
+                self.accepted += 1
+            else:
+                rejected += 1
+            self._settle(product_id, status)
+        self._reject(rejected)
+        if self.mine:
+            while len(blockchain.mempool) >= config.blocksize:
+                self._mine_block()
+
+    def _mine_block(self):
+        blockchain = self.scm.blockchain
+        block = blockchain.new_block()
+        block.mine()
+        blockchain.extend_chain(block, verify=False)
+        self.blocks += 1
+        self.scm.checkpoint()
+
+    def run(self, events):
+        started = time.perf_counter()
+        raw = queue.Queue(self.queue_size)
+        validated = queue.Queue(self.queue_size)
+        signed = queue.Queue(self.queue_size)
+        batches = _batches(events, self.batch_size)
+
+        def read(batch):
+            self.rows += len(batch)
+            return batch
+
+        executor = None
+        if self.workers != 1:
+            executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_signer,
+                                           initargs=(export_keys(self.scm.entity_keys),))
+
+        def sign(validated_batch):
+            new_keys, items = validated_batch
+            if executor is not None:
+                return items, executor.submit(_sign_batch, new_keys, [item[:4] for item in items])
+            future = Future()
+            future.set_result([_sign(self._signer(entity), product_id, event, date)
+                               for product_id, event, date, entity, _, _ in items])
+            return items, future
+
+        stages = [
+            self._stage('read', read, batches, raw),
+            self._stage('validate', self._validate, raw, validated),
+            self._stage('sign', sign, validated, signed),
+        ]
+        for stage in stages:
+            stage.start()
+        reported = 0
+        try:
+            for items, future in _items(signed, self._stop):
+                self._insert(items, future.result())
+                if self.progress_every and self.rows - reported >= self.progress_every:
+                    reported = self.rows
+                    elapsed = time.perf_counter() - started
+                    logger.info("%d rows, %.0f rows/s, %d accepted, %d rejected, %d blocks, mempool %d",
+                                self.rows, self.rows / elapsed, self.accepted, self.rejected,
+                                self.blocks, len(self.scm.blockchain.mempool))
+        except BaseException:
+            self._stop.set()
+            raise
+        finally:
+            for stage in stages:
+                stage.join()
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+        if self._errors:
+            raise self._errors[0]
+        if self.mine:
+            while self.scm.blockchain.mempool:
+                self._mine_block()
+        elapsed = time.perf_counter() - started
+        report = IngestReport(self.rows, self.accepted, self.rejected, self.blocks, elapsed)
+        logger.info("Ingested %d rows in %.1fs (%.0f rows/s): %d accepted, %d rejected, %d blocks",
+                    report.rows, elapsed, report.rows / elapsed if elapsed > 0 else 0,
+                    report.accepted, report.rejected, report.blocks)
+        return report
+
+def ingest(scm, events, **kwargs):
+    """Run events, an iterable of event dicts, through the pipeline; keyword
+    arguments are those of Ingest. Returns an IngestReport."""
+    return Ingest(scm, **kwargs).run(events)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk ingest supply chain events")
+    parser.add_argument('path', help="JSONL or CSV file of events")
+    parser.add_argument('--format', choices=('jsonl', 'csv'), help="Default from the file extension")
+    parser.add_argument('--roles', help="JSON file mapping each role to a list of entities")
+    parser.add_argument('--assign-roles', action='store_true', help="Give unknown entities the role of their first event")
+    parser.add_argument('--store', help="Block store directory, kept in memory if omitted")
+    parser.add_argument('--snapshots', help="Product state snapshot directory")
+    parser.add_argument('--workers', type=int, default=None, help="Signing processes, default one per CPU")
+    parser.add_argument('--batch-size', type=int, default=config.ingest_batch_size)
+    parser.add_argument('--verify', action='store_true', help="Verify signatures when inserting")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    blockchain = Blockchain.open(args.store) if args.store else Blockchain()
+    scm = SupplyChainManager(blockchain, SnapshotStore(args.snapshots) if args.snapshots else None)
+    if args.roles:
+        with open(args.roles) as f:
+            for role, entities in json.load(f).items():
+                for entity in entities:
+                    scm.assign_role(role, entity)
+    if len(blockchain.chain) > 1:
+        # Products of earlier runs, so their updates and ids are checked
+        scm.restore()
+    try:
+        ingest(scm, read_events(args.path, args.format), workers=args.workers,
+               batch_size=args.batch_size, assign_roles=args.assign_roles, verify=args.verify)
+    finally:
+        blockchain.close()
@@ -0,0 +1,98 @@
+# mempool.py
+
+import heapq
+from collections import defaultdict
+import config
+
+class Mempool(object):
+    """Pending transactions, deduplicated by hash and drained in date order.
+
+    With a capacity set, a full pool either evicts the transaction that has
+    waited longest ('oldest') or rejects the newcomer ('reject'). A newcomer
+    dated no later than the transaction it would evict is rejected too, as
+    is any newcomer to a pool with no room at all. An author
+    quota caps how many pending transactions a single author may hold.
+    """
+
+    def __init__(self, capacity=config.mempool_capacity, eviction=config.mempool_eviction,
+                 author_quota=config.mempool_author_quota):
+        if eviction not in ('oldest', 'reject'):
+            raise ValueError(f"Unknown eviction policy {eviction}")
+        self.capacity = capacity
+        self.eviction = eviction
+        self.author_quota = author_quota
+        self._transactions = {}  # hash -> transaction, in arrival order
+        self._heap = []  # transactions ordered by Transaction.__lt__, removals are lazy
+        self._author_counts = defaultdict(int)
+        self.evicted = 0
+
+    def add(self, transaction):
+        tx_hash = transaction.hash()
+        if tx_hash in self._transactions:
+            return False
+        if self.author_quota is not None and self._author_counts[transaction.author] >= self.author_quota:
+            return False
+        if self.capacity is not None and len(self._transactions) >= self.capacity:
+            if self.eviction == 'reject' or not self._transactions:
+                return False
+            candidate = next(iter(self._transactions.values()))
+            if not candidate < transaction:
+                return False
+            self.discard(candidate.hash())
+            self.evicted += 1
+        self._transactions[tx_hash] = transaction
+        self._author_counts[transaction.author] += 1
+        heapq.heappush(self._heap, transaction)
+        return True
+
+    def discard(self, tx_hash):
+        transaction = self._transactions.pop(tx_hash, None)
+        if transaction is None:
+            return None
+        self._author_counts[transaction.author] -= 1
+        if not self._author_counts[transaction.author]:
+            del self._author_counts[transaction.author]
+        # Heap entries of removed transactions are skipped when popped; compact
+        # once they outnumber the live ones.
+        if len(self._heap) > 2 * len(self._transactions) + 64:
+            self._heap = list(self._transactions.values())
+            heapq.heapify(self._heap)
+        return transaction
+
+    def pop(self, count, max_bytes=None):
+        """Remove and return up to count transactions, earliest date first.
+
+        With max_bytes set, stop before the canonical encodings would exceed
+        it; the first transaction is always taken.
+        """
+        transactions = []
+        size = 0
+        while self._heap and len(transactions) < count:
+            transaction = self._heap[0]
+            tx_hash = transaction.hash()
+            if self._transactions.get(tx_hash) is not transaction:
+                heapq.heappop(self._heap)
+                continue
+            if max_bytes is not None:
+                size += transaction.size()
+                if size > max_bytes and transactions:
+                    break
+            heapq.heappop(self._heap)
+            self.discard(tx_hash)
+            transactions.append(transaction)
+        return transactions
+
+    def copy(self):
+        other = Mempool(self.capacity, self.eviction, self.author_quota)
+        for transaction in self._transactions.values():
+            other.add(transaction)
+        return other
+
+    def __contains__(self, transaction):
+        return transaction.hash() in self._transactions
+
+    def __iter__(self):
+        return iter(list(self._transactions.values()))
+
+    def __len__(self):
+        return len(self._transactions)
@@ -0,0 +1,54 @@
+# merkle.py
+
+import hashlib
+
+empty_root = '0' * 64
+
+def _hash_pair(left, right):
+    return hashlib.sha256((left + right).encode()).hexdigest()
+
+def _next_level(level):
+    # An odd node is paired with itself, as in Bitcoin
+    if len(level) % 2:
+        level = level + [level[-1]]
+    return [_hash_pair(level[i], level[i + 1]) for i in range(0, len(level), 2)]
+
+def merkle_root(hashes):
+    level = list(hashes)
+    if not level:
+        return empty_root
+    while len(level) > 1:
+        level = _next_level(level)
+    return level[0]
+
+def merkle_proof(hashes, index):
+    """Return the inclusion proof for hashes[index].
+
+    The proof is a list of (sibling_hash, side) pairs from the leaf up to the
+    root, where side tells whether the sibling is on the 'left' or 'right'.
+    """
+    level = list(hashes)
+    if not 0 <= index < len(level):
+        raise IndexError("Leaf index out of range")
+    proof = []
+    while len(level) > 1:
+        if len(level) % 2:
+            level = level + [level[-1]]
+        if index % 2:
+            proof.append((level[index - 1], 'left'))
+        else:
+            proof.append((level[index + 1], 'right'))
+        level = _next_level(level)
+        index //= 2
+    return proof
+
+def verify_merkle_proof(leaf, proof, root):
+    current = leaf
+    for sibling, side in proof:
+        if side == 'left':
+            current = _hash_pair(sibling, current)
+        elif side == 'right':
+            current = _hash_pair(current, sibling)
+        else:
+            return False
+    return current == root
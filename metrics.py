@@ -0,0 +1,142 @@
+# metrics.py
+#
+# Low-overhead instrumentation of the hot paths. Operations decorated with
+# @timed count calls and errors and record latency histograms; other code
+# reports gauges and value histograms through the module registry. While
+# metrics are disabled (the default, see config.metrics_enabled) a timed
+# call costs one global lookup and a branch.
+
+import bisect
+import cProfile
+import functools
+import json
+import pstats
+from contextlib import contextmanager
+from time import perf_counter
+import config
+
+enabled = config.metrics_enabled
+prefix = 'supply_chain_'
+
+latency_buckets = (1e-6, 1e-5, 1e-4, 5e-4, 1e-3, 5e-3, 1e-2, 5e-2, 0.1, 0.5, 1.0, 5.0, 10.0)
+count_buckets = tuple(2 ** i for i in range(0, 33, 2))
+ratio_buckets = (0.1, 0.25, 0.5, 0.75, 0.9, 1.0)
+
+def enable():
+    global enabled
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+class Histogram(object):
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        return {
+            'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], self.counts)),
+            'sum': self.sum,
+            'count': self.count,
+        }
+
+class Registry(object):
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+
+    def observe(self, name, value, buckets=latency_buckets):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(buckets)
+        histogram.observe(value)
+
+    def reset(self):
+        self.counters.clear()
+        self.gauges.clear()
+        self.histograms.clear()
+
+    def snapshot(self):
+        return {
+            'counters': dict(self.counters),
+            'gauges': dict(self.gauges),
+            'histograms': {name: h.snapshot() for name, h in self.histograms.items()},
+        }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), sort_keys=True)
+
+    def to_prometheus(self):
+        """Snapshot in the Prometheus text exposition format."""
+        lines = []
+        for name in sorted(self.counters):
+            lines.append(f"# TYPE {prefix}{name} counter")
+            lines.append(f"{prefix}{name} {self.counters[name]}")
+        for name in sorted(self.gauges):
+            lines.append(f"# TYPE {prefix}{name} gauge")
+            lines.append(f"{prefix}{name} {self.gauges[name]}")
+        for name in sorted(self.histograms):
+            histogram = self.histograms[name]
+            lines.append(f"# TYPE {prefix}{name} histogram")
+            cumulative = 0
+            for bound, count in zip(list(histogram.buckets) + ['+Inf'], histogram.counts):
+                cumulative += count
+                lines.append(f'{prefix}{name}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f"{prefix}{name}_sum {histogram.sum}")
+            lines.append(f"{prefix}{name}_count {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+_profilers = {}
+
+def timed(name):
+    """Count calls, errors and latency of the decorated operation."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return fn(*args, **kwargs)
+            profiler = _profilers.get(name)
+            started = perf_counter()
+            try:
+                if profiler is not None:
+                    return profiler.runcall(fn, *args, **kwargs)
+                return fn(*args, **kwargs)
+            except Exception:
+                registry.inc(f"{name}_errors_total")
+                raise
+            finally:
+                registry.inc(f"{name}_total")
+                registry.observe(f"{name}_seconds", perf_counter() - started)
+        return wrapper
+    return decorator
+
+@contextmanager
+def profiling(name, sort='cumulative', limit=20):
+    """Run cProfile around every call of the named timed operation inside the
+    block, then print the collected stats. Only one operation should be
+    profiled at a time. Metrics must be enabled for the hook to fire."""
+    _profilers[name] = profiler = cProfile.Profile()
+    try:
+        yield profiler
+    finally:
+        del _profilers[name]
+        if profiler.getstats():
+            pstats.Stats(profiler).sort_stats(sort).print_stats(limit)
@@ -0,0 +1,109 @@
+# miner.py
+
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from collections import namedtuple
+import config
+
+MiningResult = namedtuple('MiningResult', ['nonce', 'hash', 'hashes', 'elapsed', 'hashrate'])
+
+_NONCE_FIELD = '"nonce": '
+
+max_target = 2 ** 256
+
+def target_for(difficulty):
+    # A hash meets the target with probability 1 / difficulty, so difficulty
+    # is the expected number of hashes per block. 16 ** n is the same as n
+    # leading zero hex digits.
+    return max_target // max(difficulty, 1)
+
+def header_parts(block):
+    # Split the canonical header serialization around the nonce, so that a
+    # candidate hash is prefix + str(nonce) + suffix, exactly as Block.hash().
+    data = block.header()
+    data['nonce'] = 0
+    block_string = json.dumps(data, sort_keys=True)
+    start = block_string.index(_NONCE_FIELD) + len(_NONCE_FIELD)
+    return block_string[:start].encode(), block_string[start + 1:].encode()
+
+def search(prefix, suffix, target, start=0, step=1, limit=None, stop=None,
+           batch_size=config.mining_batch_size):
+    """Scan nonces start, start + step, ... for a hash below target.
+
+    Returns (nonce, hash, hashes); nonce is None if the search was stopped
+    or ran out of nonces before a proof was found.
+    """
+    midstate = hashlib.sha256(prefix)
+    nonce = start
+    hashes = 0
+    while limit is None or hashes < limit:
+        for _ in range(batch_size):
+            h = midstate.copy()
+            h.update(str(nonce).encode())
+            h.update(suffix)
+            hashes += 1
+            if int.from_bytes(h.digest(), 'big') < target:
+                return nonce, h.hexdigest(), hashes
+            nonce += step
+        if stop is not None and stop.is_set():
+            break
+    return None, None, hashes
+
+def _worker(prefix, suffix, target, start, step, batch_size, stop, results):
+    nonce, digest, hashes = search(prefix, suffix, target, start=start, step=step,
+                                   stop=stop, batch_size=batch_size)
+    if nonce is not None:
+        stop.set()
+    results.put((nonce, digest, hashes))
+
+class Miner(object):
+    def __init__(self, workers=None, batch_size=config.mining_batch_size):
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+
+    def mine(self, block):
+        """Find a nonce meeting the block's difficulty, set it and return a
+        MiningResult."""
+        started = time.perf_counter()
+        prefix, suffix = header_parts(block)
+        target = target_for(block.difficulty)
+        if self.workers == 1:
+            nonce, digest, hashes = search(prefix, suffix, target, start=block.nonce,
+                                           batch_size=self.batch_size)
+        else:
+            nonce, digest, hashes = self._mine_parallel(prefix, suffix, target, block.nonce)
+        elapsed = time.perf_counter() - started
+        block.nonce = nonce
+        hashrate = hashes / elapsed if elapsed > 0 else float(hashes)
+        return MiningResult(nonce, digest, hashes, elapsed, hashrate)
+
+    def _mine_parallel(self, prefix, suffix, target, start):
+        # Worker i scans start + i, start + i + workers, ... so the nonce space
+        # is interleaved; the first worker to find a proof stops the others.
+        stop = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(
+                target=_worker,
+                args=(prefix, suffix, target, start + i, self.workers,
+                      self.batch_size, stop, results),
+                daemon=True)
+            for i in range(self.workers)
+        ]
+        for p in processes:
+            p.start()
+        found = []
+        hashes = 0
+        for _ in processes:
+            nonce, digest, count = results.get()
+            hashes += count
+            if nonce is not None:
+                found.append((nonce, digest))
+        for p in processes:
+            p.join()
+        # Several workers may finish in the same batch; keep the lowest nonce.
+        nonce, digest = min(found)
+        return nonce, digest, hashes
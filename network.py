@@ -0,0 +1,421 @@
+# network.py
+#
+# Asyncio node layer: Blockchain instances that gossip transactions and
+# blocks over an in-memory or localhost TCP transport, and a harness that
+# measures propagation latency and throughput. Run for instance
+#
+#     python network.py --nodes 50 --transport tcp
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import statistics
+import struct
+import time
+from collections import defaultdict
+import config
+from block import Block, InvalidBlock
+from blockchain import Blockchain, expected_difficulty
+from codec import DecodeError, encode_block, decode_block, encode_transaction, decode_transaction
+from signing import get_backend
+from transaction import Transaction
+from verification import verify_many
+
+logger = logging.getLogger(__name__)
+
+# Message kinds: a transaction, a block, or a request for a block by hash
+TX, BLOCK, GETBLOCK = 0, 1, 2
+
+class _ForkView(object):
+    """A chain made of our blocks up to a height followed by a side branch,
+    shaped like a Blockchain for Blockchain.merge."""
+
+    def __init__(self, blockchain, ancestor, branch):
+        self.main = blockchain.chain
+        self.ancestor = ancestor
+        self.branch = branch
+        self.chain = self
+        self.mempool = []
+
+    def __len__(self):
+        return self.ancestor + 1 + len(self.branch)
+
+    def __getitem__(self, height):
+        if isinstance(height, slice):
+            return [self[h] for h in range(*height.indices(len(self)))]
+        if height < 0:
+            height += len(self)
+        if height <= self.ancestor:
+            return self.main[height]
+        return self.branch[height - self.ancestor - 1]
+
+class Node(object):
+    """A peer holding one Blockchain.
+
+    Inbound blocks are relayed as soon as their proof of work checks out,
+    before the full validation, so propagation is pipelined across hops.
+    Blocks whose parent is unknown are parked and the parent is requested by
+    hash from the sender. Transactions from peers go through a bounded queue
+    and are dropped when it is full; local submissions wait for room instead.
+    """
+
+    def __init__(self, node_id, blockchain, transport, tx_queue_size=config.network_tx_queue_size):
+        self.node_id = node_id
+        self.blockchain = blockchain
+        self.transport = transport
+        self.peers = set()
+        self.tx_inbox = asyncio.Queue(maxsize=tx_queue_size)
+        self.block_inbox = asyncio.Queue()
+        self.known_blocks = {}  # Hash -> block, side branches included
+        self.orphans = defaultdict(list)  # Missing parent hash -> blocks
+        self.requested = set()
+        self.seen_transactions = set()
+        self.tx_arrivals = {}  # Hash -> loop time first seen
+        self.block_arrivals = {}  # Hash -> loop time joined our chain
+        self.dropped = 0
+        self.malformed = 0  # Payloads from peers that could not be decoded
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._block_loop()), asyncio.create_task(self._tx_loop())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def deliver(self, sender, kind, payload):
+        if kind == TX:
+            try:
+                self.tx_inbox.put_nowait((sender, payload))
+            except asyncio.QueueFull:
+                self.dropped += 1
+        else:
+            await self.block_inbox.put((sender, kind, payload))
+
+    async def submit(self, transaction):
+        """Submit a local transaction, waiting while the inbound queue is full."""
+        await self.tx_inbox.put((None, encode_transaction(transaction)))
+
+    async def broadcast(self, kind, payload, exclude=None):
+        await asyncio.gather(*(self.transport.send(self.node_id, peer, kind, payload)
+                               for peer in self.peers if peer != exclude))
+
+    async def mine(self):
+        """Mine the pending transactions into a block and announce it."""
+        block = self.blockchain.new_block()
+        block.miner = str(self.node_id)
+        block.mine()
+        self.blockchain.extend_chain(block, verify=False)
+        self.block_arrivals[block.hash()] = time.perf_counter()
+        await self.broadcast(BLOCK, encode_block(block))
+        return block
+
+    async def _tx_loop(self):
+        while True:
+            batch = [await self.tx_inbox.get()]
+            while len(batch) < config.network_tx_batch and not self.tx_inbox.empty():
+                batch.append(self.tx_inbox.get_nowait())
+            try:
+                await self._receive_transactions(batch)
+            except Exception:
+                # A payload no check anticipated must not stop the node
+                logger.exception("Node %s dropped a batch of %d transactions", self.node_id, len(batch))
+
+    async def _receive_transactions(self, batch):
+        fresh = []
+        now = time.perf_counter()
+        for sender, payload in batch:
+            try:
+                transaction = decode_transaction(payload)
+            except DecodeError as e:
+                self._malformed(sender, 'transaction', e)
+                continue
+            tx_hash = transaction.hash()
+            if tx_hash in self.seen_transactions:
+                continue
+            self.seen_transactions.add(tx_hash)
+            self.tx_arrivals[tx_hash] = now
+            fresh.append((sender, payload, transaction))
+        added = self.blockchain.add_transactions([t for _, _, t in fresh])
+        await asyncio.gather(*(self.broadcast(TX, payload, exclude=sender)
+                               for (sender, payload, _), ok in zip(fresh, added) if ok))
+
+    async def _block_loop(self):
+        while True:
+            sender, kind, payload = await self.block_inbox.get()
+            try:
+                if kind == GETBLOCK:
+                    await self._send_block(sender, payload)
+                else:
+                    await self._receive_block(sender, payload)
+            except Exception:
+                logger.exception("Node %s dropped a block message from %s", self.node_id, sender)
+
+    async def _send_block(self, sender, payload):
+        block_hash = payload.hex()
+        block = self.known_blocks.get(block_hash)
+        if block is None:
+            height = self.blockchain.height_of(block_hash)
+            block = self.blockchain.chain[height] if height is not None else None
+        if block is not None:
+            await self.transport.send(self.node_id, sender, BLOCK, encode_block(block))
+
+    def _malformed(self, sender, kind, error):
+        self.malformed += 1
+        logger.warning("Node %s dropped a malformed %s from %s: %s", self.node_id, kind, sender, error)
+
+    async def _receive_block(self, sender, payload):
+        try:
+            block = decode_block(payload)
+        except DecodeError as e:
+            self._malformed(sender, 'block', e)
+            return
+        block_hash = block.hash()
+        if block_hash in self.known_blocks or self.blockchain.height_of(block_hash) is not None:
+            return
+        if not self._expected_difficulty(block) or not block.valid_proof():
+            return
+        # Signatures are checked before relaying too; transactions we already
+        # hold were verified when they arrived
+        mempool = self.blockchain.mempool
+        if not all(verify_many([t for t in block.transactions if t not in mempool])):
+            return
+        self.known_blocks[block_hash] = block
+        await self.broadcast(BLOCK, payload, exclude=sender)
+        await self._connect(block, sender)
+
+    def _expected_difficulty(self, block):
+        # Checked before a block is relayed, so cheap low-difficulty blocks
+        # are not flooded. Exact when the parent is on our chain; a side
+        # branch may have retargeted at most once below our difficulty.
+        blockchain = self.blockchain
+        height = blockchain.height_of(block.previous_hash)
+        if height is not None:
+            return block.difficulty == expected_difficulty(blockchain.chain, height + 1)
+        if not config.retarget_interval:
+            return block.difficulty == blockchain.next_difficulty()
+        return block.difficulty * config.retarget_max_factor >= blockchain.next_difficulty()
+
+    async def _connect(self, block, sender):
+        parent = block.previous_hash
+        if self.blockchain.height_of(parent) is None and parent not in self.known_blocks:
+            self.orphans[parent].append(block)
+            if parent not in self.requested:
+                self.requested.add(parent)
+                await self.transport.send(self.node_id, sender, GETBLOCK, bytes.fromhex(parent))
+            return
+        self._adopt(block)
+        for child in self.orphans.pop(block.hash(), []):
+            await self._connect(child, sender)
+
+    def _adopt(self, block):
+        blockchain = self.blockchain
+        if block.previous_hash == blockchain.last_block.hash():
+            try:
+                # Verified in _receive_block
+                blockchain.extend_chain(block, verify=False)
+            except InvalidBlock:
+                return
+            self.block_arrivals[block.hash()] = time.perf_counter()
+            return
+        # A side branch: collect it back to our chain and let merge decide
+        branch = [block]
+        while blockchain.height_of(branch[-1].previous_hash) is None:
+            parent = self.known_blocks.get(branch[-1].previous_hash)
+            if parent is None:
+                return
+            branch.append(parent)
+        branch.reverse()
+        ancestor = blockchain.height_of(branch[0].previous_hash)
+        if blockchain.merge(_ForkView(blockchain, ancestor, branch)):
+            now = time.perf_counter()
+            for b in branch:
+                self.block_arrivals.setdefault(b.hash(), now)
+
+class MemoryTransport(object):
+    """Delivers messages by direct calls between nodes in one event loop."""
+
+    def __init__(self):
+        self.nodes = {}
+
+    def register(self, node):
+        self.nodes[node.node_id] = node
+
+    async def start(self):
+        pass
+
+    async def connect(self, a, b):
+        pass
+
+    async def send(self, sender, receiver, kind, payload):
+        await self.nodes[receiver].deliver(sender, kind, payload)
+
+    async def close(self):
+        pass
+
+# Frame header: payload length, message kind, sender id
+_FRAME = struct.Struct('<IBI')
+
+class TcpTransport(object):
+    """Length-prefixed frames over localhost TCP, one server per node."""
+
+    def __init__(self, host='127.0.0.1'):
+        self.host = host
+        self.nodes = {}
+        self.servers = {}
+        self.ports = {}
+        self.writers = {}  # (sender, receiver) -> StreamWriter
+
+    def register(self, node):
+        self.nodes[node.node_id] = node
+
+    async def start(self):
+        for node_id, node in self.nodes.items():
+            server = await asyncio.start_server(
+                lambda r, w, node=node: self._serve(node, r, w), self.host, 0)
+            self.servers[node_id] = server
+            self.ports[node_id] = server.sockets[0].getsockname()[1]
+
+    async def connect(self, a, b):
+        for sender, receiver in ((a, b), (b, a)):
+            if (sender, receiver) not in self.writers:
+                _, writer = await asyncio.open_connection(self.host, self.ports[receiver])
+                self.writers[(sender, receiver)] = writer
+
+    async def _serve(self, node, reader, writer):
+        try:
+            while True:
+                length, kind, sender = _FRAME.unpack(await reader.readexactly(_FRAME.size))
+                payload = await reader.readexactly(length)
+                await node.deliver(sender, kind, payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def send(self, sender, receiver, kind, payload):
+        writer = self.writers[(sender, receiver)]
+        writer.write(_FRAME.pack(len(payload), kind, sender) + payload)
+        await writer.drain()
+
+    async def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        for server in self.servers.values():
+            server.close()
+            await server.wait_closed()
+
+def _summary(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    return {
+        'mean_ms': statistics.fmean(values) * 1000,
+        'p50_ms': values[len(values) // 2] * 1000,
+        'p95_ms': values[int(len(values) * 0.95)] * 1000,
+        'max_ms': values[-1] * 1000,
+    }
+
+async def run_network(num_nodes=10, transport='memory', degree=4, transactions=1000,
+                      submit_rate=None, seed=0, timeout=60.0):
+    """Run a local network and return propagation and throughput statistics.
+
+    Transactions are submitted at random nodes (as fast as backpressure
+    allows, or at submit_rate per second), node 0 mines whenever it holds a
+    full block, and the run ends when every node has every transaction on
+    its chain or the timeout expires.
+    """
+    rng = random.Random(seed)
+    transport = MemoryTransport() if transport == 'memory' else TcpTransport()
+    genesis = Block()
+    nodes = [Node(i, Blockchain(genesis=genesis), transport) for i in range(num_nodes)]
+    for node in nodes:
+        transport.register(node)
+    await transport.start()
+    # A ring keeps the graph connected; random links bring the degree up
+    for i, node in enumerate(nodes):
+        links = {(i + 1) % num_nodes}
+        while len(links) < min(degree, num_nodes - 1):
+            links.add(rng.randrange(num_nodes))
+        links.discard(i)
+        for j in links:
+            node.peers.add(j)
+            nodes[j].peers.add(i)
+            await transport.connect(i, j)
+    for node in nodes:
+        node.start()
+
+    keys = [get_backend('ed25519').generate() for _ in range(8)]
+    submitted = {}
+    mined = {}
+    started = time.perf_counter()
+
+    async def submit_all():
+        for n in range(transactions):
+            transaction = Transaction(f"PROD{n:06d}", "ProductCreated")
+            transaction.sign(rng.choice(keys))
+            submitted[transaction.hash()] = time.perf_counter()
+            await nodes[rng.randrange(num_nodes)].submit(transaction)
+            await asyncio.sleep(1 / submit_rate if submit_rate else 0)
+
+    async def mine_all():
+        miner = nodes[0]
+        while True:
+            if len(miner.blockchain.mempool) >= config.blocksize or (submitter.done() and miner.blockchain.mempool):
+                block = await miner.mine()
+                mined[block.hash()] = miner.block_arrivals[block.hash()]
+                await asyncio.sleep(0)
+            else:
+                await asyncio.sleep(0.001)
+
+    def settled():
+        return submitter.done() and all(
+            len(node.blockchain.transaction_index) >= transactions for node in nodes)
+
+    submitter = asyncio.create_task(submit_all())
+    mining = asyncio.create_task(mine_all())
+    while not settled() and time.perf_counter() - started < timeout:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    mining.cancel()
+    submitter.cancel()
+    await asyncio.gather(mining, submitter, return_exceptions=True)
+    for node in nodes:
+        await node.stop()
+    await transport.close()
+
+    tx_latencies = [node.tx_arrivals[h] - t for h, t in submitted.items()
+                    for node in nodes if h in node.tx_arrivals]
+    block_latencies = [node.block_arrivals[h] - t for h, t in mined.items()
+                       for node in nodes[1:] if h in node.block_arrivals]
+    confirmed = min(len(node.blockchain.transaction_index) for node in nodes)
+    return {
+        'nodes': num_nodes,
+        'transport': type(transport).__name__,
+        'transactions': transactions,
+        'blocks': len(mined),
+        'elapsed_seconds': elapsed,
+        'confirmed_on_all_nodes': confirmed,
+        'throughput_tx_per_sec': confirmed / elapsed if elapsed > 0 else 0.0,
+        'tx_propagation': _summary(tx_latencies),
+        'block_propagation': _summary(block_latencies),
+        'dropped_transactions': sum(node.dropped for node in nodes),
+        'in_sync': len({node.blockchain.last_block.hash() for node in nodes}) == 1,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure gossip propagation on a local network")
+    parser.add_argument('--nodes', type=int, default=10)
+    parser.add_argument('--transport', choices=['memory', 'tcp'], default='memory')
+    parser.add_argument('--degree', type=int, default=4)
+    parser.add_argument('--transactions', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=None, help="Submissions per second")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    stats = asyncio.run(run_network(args.nodes, args.transport, args.degree, args.transactions,
+                                    args.rate, args.seed))
+    print(json.dumps(stats, indent=2))
@@ -0,0 +1,145 @@
+# parallel_simulation.py
+
+import heapq
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+import numpy as np
+import config
+from product import Product
+from signing import export_keys, import_keys
+from simulation import roles, entity_names, default_stages, default_origins
+from supply_chain import SupplyChainManager
+from transaction import Transaction, signer_of
+
+logger = logging.getLogger(__name__)
+
+# Fixed default clock start, so that a seed fully determines the events
+default_start_time = datetime(2024, 1, 1)
+
+_worker_signers = {}  # Entity -> (private key, signer_of(private key))
+
+def _init_worker(exported_keys):
+    global _worker_signers
+    _worker_signers = {entity: (key, signer_of(key)) for entity, key in import_keys(exported_keys).items()}
+
+def _event_name(stage, stages):
+    return "ProductCreated" if stage < 0 else f"StatusUpdated to {stages[stage][0]}"
+
+def _simulate_shard(job):
+    # Runs in a worker: lays out the lifecycles of one shard of products and
+    # signs their transactions. Events come back sorted by (hour, product,
+    # stage) as (hour, product, stage, entity, origin, signature) tuples.
+    shard_seed, products, arrivals, entities, origins, stages, start_time = job
+    rng = np.random.default_rng(shard_seed)
+    n = len(products)
+    hours = np.empty((n, len(stages) + 1), dtype=np.int64)
+    hours[:, 0] = arrivals
+    for stage, (_, _, (low, high)) in enumerate(stages):
+        hours[:, stage + 1] = hours[:, stage] + rng.integers(low, high + 1, size=n)
+    stage_roles = ['supplier'] + [role for _, role, _ in stages]
+    picks = np.column_stack([rng.integers(0, len(entities[role]), size=n) for role in stage_roles])
+    origin_picks = rng.integers(0, len(origins), size=n)
+
+    dates = {}
+    events = []
+    for i, product in enumerate(products.tolist()):
+        product_id = f"PROD{str(product).zfill(3)}"
+        for column, role in enumerate(stage_roles):
+            hour = int(hours[i, column])
+            date = dates.get(hour)
+            if date is None:
+                date = dates[hour] = (start_time + timedelta(hours=hour)).strftime('%Y-%m-%d %H:%M:%S')
+            entity = entities[role][picks[i, column]]
+            stage = column - 1
+            transaction = Transaction(product_id, _event_name(stage, stages), date=date)
+            transaction.sign(*_worker_signers[entity])
+            origin = origins[origin_picks[i]] if stage < 0 else None
+            events.append((hour, product, stage, entity, origin, transaction.signature))
+    events.sort()
+    return events
+
+def run_parallel_simulation(num_products=1000, workers=None, shards=None, seed=0, scm=None,
+                            entity_counts=None, origins=None, stages=None, arrival_hours=(6, 24),
+                            start_time=None, mine=True, verify=False,
+                            chunk_size=config.parallel_chunk_size):
+    """Simulate product lifecycles sharded across worker processes.
+
+    Products are dealt round-robin to a fixed number of shards, each with its
+    own seed, so the merged event stream depends only on seed and shards, not
+    on the number of workers. Workers sign with keys exported from the parent
+    manager; the parent merges the shard streams in date order, replays them
+    into the products and mempool and mines as blocks fill. Signatures are
+    trusted unless verify is set. Stage delays must be (min, max) ranges.
+    """
+    scm = scm if scm is not None else SupplyChainManager()
+    origins = origins or default_origins
+    stages = stages or default_stages
+    start_time = start_time or default_start_time
+    shards = shards or config.parallel_shards
+    entity_counts = entity_counts or {}
+    entities = {}
+    for role, prefix in roles.items():
+        entities[role] = entity_names(prefix, entity_counts.get(role, 2))
+        for entity in entities[role]:
+            scm.assign_role(role, entity)
+
+    # Arrival times for all products from the parent seed, then one child
+    # seed per shard for the lifecycles
+    children = np.random.SeedSequence(seed).spawn(shards + 1)
+    arrival_seed, shard_seeds = children[0], children[1:]
+    low, high = arrival_hours
+    gaps = np.random.default_rng(arrival_seed).integers(low, high + 1, size=num_products)
+    gaps[0] = 0
+    arrivals = np.cumsum(gaps)
+    product_numbers = np.arange(1, num_products + 1)
+    jobs = [
+        (shard_seeds[k], product_numbers[k::shards], arrivals[k::shards], entities, origins, stages, start_time)
+        for k in range(shards)
+    ]
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(export_keys(scm.entity_keys),)) as executor:
+        streams = list(executor.map(_simulate_shard, jobs))
+
+    signers = {entity: signer_of(key) for entity, key in scm.entity_keys.items()}
+
+    blockchain = scm.blockchain
+    batch = []
+    dates = {}
+    for count, (hour, product, stage, entity, origin, signature) in enumerate(heapq.merge(*streams), 1):
+        product_id = f"PROD{str(product).zfill(3)}"
+        date = dates.get(hour)
+        if date is None:
+            date = dates[hour] = (start_time + timedelta(hours=hour)).strftime('%Y-%m-%d %H:%M:%S')
+        if stage < 0:
+            scm.products[product_id] = Product(product_id, origin, entity, date=date, store=scm.events)
+        else:
+            scm.products[product_id].update_status(stages[stage][0], entity, date=date)
+        backend, public_key, author = signers[entity]
+        batch.append(Transaction(product_id, _event_name(stage, stages), date=date, signature=signature,
+                                 public_key=public_key, author=author, scheme=backend.name))
+        if len(batch) >= chunk_size:
+            _flush(blockchain, batch, verify, mine)
+            batch = []
+            logger.info("%d events merged, %d blocks", count, len(blockchain))
+    _flush(blockchain, batch, verify, mine)
+    if mine:
+        while blockchain.mempool:
+            _mine_block(blockchain)
+    return scm
+
+def _flush(blockchain, batch, verify, mine):
+    if verify:
+        blockchain.add_transactions(batch)
+    else:
+        for transaction in batch:
+            blockchain.mempool.add(transaction)
+    if mine:
+        while len(blockchain.mempool) >= config.blocksize:
+            _mine_block(blockchain)
+
+def _mine_block(blockchain):
+    new_block = blockchain.new_block()
+    new_block.mine()
+    blockchain.extend_chain(new_block, verify=False)
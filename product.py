@@ -1,30 +1,110 @@
 # product.py
 
-from datetime import datetime
+from collections import namedtuple
+from event_store import EventStore
+
+class HistoryEvent(namedtuple('HistoryEvent', ['status', 'updated_by', 'date'])):
+    """A history entry as a compact tuple that can still be read like a dict."""
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key not in self._fields:
+                raise KeyError(key)
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self._fields else default
+
+    def keys(self):
+        return self._fields
+
+    def to_dict(self):
+        return dict(zip(self._fields, self))
+
+class History(object):
+    """Read-only view of a product's events in its EventStore, yielding
+    HistoryEvents; to_dicts() gives the dict-shaped history."""
+    __slots__ = ('store', 'number')
+
+    def __init__(self, store, number):
+        self.store = store
+        self.number = number
+
+    def __len__(self):
+        return sum(1 for _ in self.store.rows(self.number))
+
+    def __iter__(self):
+        store = self.store
+        for row in store.rows(self.number):
+            yield HistoryEvent(*store.event(row))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        if index == -1:
+            return HistoryEvent(*self.store.event(self.store.last[self.number]))
+        events = list(self)
+        return events[index]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return f"History({list(self)!r})"
+
+    def to_dicts(self):
+        return [event.to_dict() for event in self]
 
 class Product:
-    def __init__(self, product_id, origin, creator, date=None):
+    """A product whose history lives in an EventStore, usually shared by the
+    products of a SupplyChainManager. A product created without one gets its
+    own."""
+    __slots__ = ('product_id', 'store', '_number')
+
+    def __init__(self, product_id, origin, creator, date=None, store=None):
         self.product_id = product_id
-        self.origin = origin
-        self.current_holder = creator
-        self.status = "Created"
-        self.history = []
+        self.store = store if store is not None else EventStore()
 
         # Record the creation event
-        self.history.append({
-            'status': self.status,
-            'updated_by': creator,
-            'date': date or datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
-        })
+        self._number = self.store.add_product(product_id, "Created", creator, date, origin)
+
+    @classmethod
+    def from_history(cls, product_id, origin, history, store=None):
+        """Product with the given (status, updated_by, date) events, which
+        need not start with the creation."""
+        product = cls.__new__(cls)
+        product.product_id = product_id
+        product.store = store if store is not None else EventStore()
+        product._number = product.store.add_product(product_id, *history[0], origin=origin)
+        for status, updated_by, date in history[1:]:
+            product.update_status(status, updated_by, date=date)
+        return product
+
+    @property
+    def number(self):
+        # Position of the product in its store, see EventStore.extend
+        return self._number
+
+    @property
+    def origin(self):
+        return self.store.origins.values[self.store.origin[self._number]]
+
+    @property
+    def status(self):
+        return self.store.statuses.values[self.store.status[self.store.last[self._number]]]
+
+    @property
+    def current_holder(self):
+        return self.store.entities.values[self.store.entity[self.store.last[self._number]]]
+
+    @property
+    def history(self):
+        return History(self.store, self._number)
 
     def update_status(self, status, updater, date=None):
-        self.status = status
-        self.current_holder = updater
-        self.history.append({
-            'status': status,
-            'updated_by': updater,
-            'date': date or datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
-        })
+        self.store.append(self._number, status, updater, date)
 
     def get_history(self):
-        return self.history
\ No newline at end of file
+        return History(self.store, self._number)
@@ -0,0 +1,141 @@
+# signing.py
+
+from ecdsa import SigningKey, VerifyingKey, BadSignatureError
+from cryptography.exceptions import InvalidSignature, UnsupportedAlgorithm
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519
+
+class UnknownScheme(Exception):
+    pass
+
+class EcdsaBackend(object):
+    """Pure-Python ecdsa (NIST192p), the original signing scheme."""
+    name = 'ecdsa'
+
+    def generate(self):
+        return SigningKey.generate()
+
+    def owns(self, private_key):
+        return isinstance(private_key, SigningKey)
+
+    def public_pem(self, private_key):
+        return private_key.verifying_key.to_pem().decode()
+
+    def sign(self, private_key, message):
+        # RFC 6979 nonces, so signing the same message twice gives the same
+        # signature; verification is unchanged
+        return private_key.sign_deterministic(message)
+
+    def private_pem(self, private_key):
+        return private_key.to_pem()
+
+    def load_private_key(self, pem):
+        return SigningKey.from_pem(pem)
+
+    def load_public_key(self, pem):
+        # Keys come from peers; ecdsa raises its own errors for malformed DER
+        try:
+            return VerifyingKey.from_pem(pem.encode())
+        except Exception as e:
+            raise ValueError(f"Malformed ecdsa public key: {e}") from e
+
+    def verify(self, public_key, signature, message):
+        try:
+            return public_key.verify(signature, message)
+        except BadSignatureError:
+            return False
+
+class _CryptographyBackend(object):
+    def private_pem(self, private_key):
+        return private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption())
+
+    def load_private_key(self, pem):
+        return serialization.load_pem_private_key(pem, password=None)
+
+    def public_pem(self, private_key):
+        return private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo).decode()
+
+    def load_public_key(self, pem):
+        try:
+            public_key = serialization.load_pem_public_key(pem.encode())
+        except UnsupportedAlgorithm as e:
+            raise ValueError(f"Unsupported public key: {e}") from e
+        if not isinstance(public_key, self.public_type):
+            raise ValueError(f"Public key is not a {self.name} key")
+        return public_key
+
+    def verify(self, public_key, signature, message):
+        try:
+            self._verify(public_key, signature, message)
+            return True
+        except InvalidSignature:
+            return False
+
+class CryptographyEcdsaBackend(_CryptographyBackend):
+    """OpenSSL-backed ECDSA over P-256 with SHA-256."""
+    name = 'ecdsa-p256'
+    public_type = ec.EllipticCurvePublicKey
+
+    def generate(self):
+        return ec.generate_private_key(ec.SECP256R1())
+
+    def owns(self, private_key):
+        return isinstance(private_key, ec.EllipticCurvePrivateKey)
+
+    def sign(self, private_key, message):
+        return private_key.sign(message, ec.ECDSA(hashes.SHA256()))
+
+    def _verify(self, public_key, signature, message):
+        public_key.verify(signature, message, ec.ECDSA(hashes.SHA256()))
+
+class Ed25519Backend(_CryptographyBackend):
+    """OpenSSL-backed Ed25519."""
+    name = 'ed25519'
+    public_type = ed25519.Ed25519PublicKey
+
+    def generate(self):
+        return ed25519.Ed25519PrivateKey.generate()
+
+    def owns(self, private_key):
+        return isinstance(private_key, ed25519.Ed25519PrivateKey)
+
+    def sign(self, private_key, message):
+        return private_key.sign(message)
+
+    def _verify(self, public_key, signature, message):
+        public_key.verify(signature, message)
+
+backends = {
+    backend.name: backend
+    for backend in (EcdsaBackend(), CryptographyEcdsaBackend(), Ed25519Backend())
+}
+
+def get_backend(scheme):
+    try:
+        return backends[scheme]
+    except KeyError:
+        raise UnknownScheme(f"Unknown signature scheme {scheme}")
+
+def backend_for_key(private_key):
+    for backend in backends.values():
+        if backend.owns(private_key):
+            return backend
+    raise UnknownScheme(f"No signature scheme for key type {type(private_key).__name__}")
+
+def export_keys(entity_keys):
+    """Serialize signing keys as {entity: (scheme, private PEM bytes)}, e.g.
+    to send them to worker processes or store them encrypted."""
+    exported = {}
+    for entity, key in entity_keys.items():
+        backend = backend_for_key(key)
+        exported[entity] = (backend.name, backend.private_pem(key))
+    return exported
+
+def import_keys(exported):
+    return {entity: get_backend(scheme).load_private_key(pem)
+            for entity, (scheme, pem) in exported.items()}
@@ -1,118 +1,223 @@
 # simulation.py
 
+import argparse
+import heapq
+import logging
+import string
+from datetime import datetime, timedelta
+import numpy as np
+import config
+from signing import backends
 from supply_chain import SupplyChainManager
-import random
-from utils import TimeSimulator
-
-def run_simulation():
-    scm = SupplyChainManager()
-    time_simulator = TimeSimulator()
-
-    # Define entities
-    suppliers = ['SupplierA', 'SupplierB']
-    manufacturers = ['ManufacturerA', 'ManufacturerB']
-    logistics_providers = ['LogisticsA', 'LogisticsB']
-    retailers = ['RetailerA', 'RetailerB']
-    consumers = ['ConsumerA', 'ConsumerB']
-
-    # Assign roles to entities
-    for supplier in suppliers:
-        scm.assign_role('supplier', supplier)
-    for manufacturer in manufacturers:
-        scm.assign_role('manufacturer', manufacturer)
-    for logistics in logistics_providers:
-        scm.assign_role('logistics', logistics)
-    for retailer in retailers:
-        scm.assign_role('retailer', retailer)
-    for consumer in consumers:
-        scm.assign_role('consumer', consumer)
-
-    # Define possible origins
-    origins = ['New York', 'Los Angeles', 'Chicago', 'Houston', 'Phoenix']
-
-    # Number of products to simulate
-    num_products = 10
-
-    # Create multiple products
-    product_ids = [f"PROD{str(i).zfill(3)}" for i in range(1, num_products + 1)]
-
-    for product_id in product_ids:
-        # Randomly select a supplier and origin
-        supplier = random.choice(suppliers)
-        origin = random.choice(origins)
-
-        # Supplier creates a product
-        try:
-            current_time = time_simulator.get_time_str()
-            product = scm.create_product(product_id, origin, supplier, date=current_time)
-            print(f"Product created: {product.product_id} at {product.origin} by {supplier} at {current_time}")
-        except Exception as e:
-            print(f"Error creating product {product_id}: {e}")
-            continue
-
-        # Advance time after creation
-        time_simulator.advance_time(min_hours=1, max_hours=12)
-
-        # Manufacturer updates product status to 'Manufactured'
-        manufacturer = random.choice(manufacturers)
-        try:
-            current_time = time_simulator.get_time_str()
-            scm.update_product_status(product_id, 'Manufactured', manufacturer, date=current_time)
-            print(f"Product {product_id} status updated to 'Manufactured' by {manufacturer} at {current_time}")
-        except Exception as e:
-            print(f"Error updating product {product_id} to 'Manufactured': {e}")
-            continue
-
-        # Advance time after manufacturing
-        time_simulator.advance_time(min_hours=12, max_hours=48)
-
-        # Logistics updates product status to 'In Transit'
-        logistics = random.choice(logistics_providers)
-        try:
-            current_time = time_simulator.get_time_str()
-            scm.update_product_status(product_id, 'In Transit', logistics, date=current_time)
-            print(f"Product {product_id} status updated to 'In Transit' by {logistics} at {current_time}")
-        except Exception as e:
-            print(f"Error updating product {product_id} to 'In Transit': {e}")
-            continue
-
-        # Advance time during transit
-        time_simulator.advance_time(min_hours=24, max_hours=72)
 
-        # Retailer updates product status to 'Available for Sale'
-        retailer = random.choice(retailers)
+logger = logging.getLogger(__name__)
+
+# Roles and the prefix of the entity names generated for them
+roles = {
+    'supplier': 'Supplier',
+    'manufacturer': 'Manufacturer',
+    'logistics': 'Logistics',
+    'retailer': 'Retailer',
+    'consumer': 'Consumer',
+}
+
+# Lifecycle after creation: status, role performing it, and the delay in
+# hours since the previous event, as a (min, max) uniform range or a
+# callable (rng, n) -> array of n delays.
+default_stages = [
+    ('Manufactured', 'manufacturer', (1, 12)),
+    ('In Transit', 'logistics', (12, 48)),
+    ('Available for Sale', 'retailer', (24, 72)),
+    ('Purchased', 'consumer', (1, 72)),
+]
+
+default_origins = ['New York', 'Los Angeles', 'Chicago', 'Houston', 'Phoenix']
+
+def entity_names(prefix, count):
+    # SupplierA, SupplierB, ..., SupplierZ, SupplierAA, ...
+    names = []
+    for i in range(count):
+        suffix = ''
+        i += 1
+        while i:
+            i, r = divmod(i - 1, 26)
+            suffix = string.ascii_uppercase[r] + suffix
+        names.append(prefix + suffix)
+    return names
+
+class _Batched(object):
+    """Draws random values from a vectorized sampler in batches."""
+
+    def __init__(self, sample, batch_size):
+        self.sample = sample
+        self.batch_size = batch_size
+        self._values = []
+
+    def next(self):
+        if not self._values:
+            # Reversed so values can be popped from the end in draw order
+            self._values = self.sample(self.batch_size).tolist()[::-1]
+        return self._values.pop()
+
+def _uniform_hours(rng, delay, batch_size):
+    if callable(delay):
+        return _Batched(lambda n: np.asarray(delay(rng, n), dtype=np.int64), batch_size)
+    low, high = delay
+    return _Batched(lambda n: rng.integers(low, high + 1, size=n), batch_size)
+
+class EventSimulation(object):
+    """Heap-scheduled discrete-event simulation of many product lifecycles.
+
+    Products arrive at random intervals and each lifecycle stage is scheduled
+    on a simulated clock in whole hours, so lifecycles interleave. Events are
+    taken from the clock in batches of event_batch and applied through
+    create_many and update_many, so their transactions are signed together.
+    Blocks are mined once mine_backlog transactions are pending, each taking
+    the chain's adaptive block size.
+    """
+
+    def __init__(self, scm=None, num_products=10, entity_counts=None, origins=None,
+                 stages=None, arrival_hours=(6, 24), start_time=None, seed=None,
+                 batch_size=config.simulation_batch_size, mine=True,
+                 event_batch=config.simulation_event_batch, mine_backlog=config.simulation_mine_backlog):
+        self.scm = scm if scm is not None else SupplyChainManager()
+        self.num_products = num_products
+        self.origins = origins or default_origins
+        self.stages = stages or default_stages
+        self.start_time = (start_time or datetime.utcnow()).replace(microsecond=0)
+        self.mine = mine
+        self.event_batch = event_batch
+        self.mine_backlog = mine_backlog
+        self.rng = np.random.default_rng(seed)
+
+        entity_counts = entity_counts or {}
+        self.entities = {}
+        for role, prefix in roles.items():
+            self.entities[role] = entity_names(prefix, entity_counts.get(role, 2))
+            for entity in self.entities[role]:
+                self.scm.assign_role(role, entity)
+
+        self._arrivals = _uniform_hours(self.rng, arrival_hours, batch_size)
+        self._delays = [_uniform_hours(self.rng, delay, batch_size) for _, _, delay in self.stages]
+        self._choices = {
+            role: _Batched(lambda n, k=len(names): self.rng.integers(0, k, size=n), batch_size)
+            for role, names in self.entities.items()
+        }
+        self._origin_choice = _Batched(lambda n: self.rng.integers(0, len(self.origins), size=n),
+                                       batch_size)
+        self._date_cache = (None, None)  # (hour, date) of the last event
+        # Events are (hour, sequence, product number, stage); stage -1 creates
+        # the product and schedules the next arrival.
+        self._queue = [(0, 0, 1, -1)] if num_products > 0 else []
+        self._sequence = 1
+        self.events = 0
+        self.errors = 0
+        self.blocks = 0
+
+    @property
+    def done(self):
+        return not self._queue
+
+    def _date(self, hour):
+        cached, date = self._date_cache
+        if cached != hour:
+            date = (self.start_time + timedelta(hours=hour)).strftime('%Y-%m-%d %H:%M:%S')
+            self._date_cache = (hour, date)
+        return date
+
+    def _pick(self, role):
+        return self.entities[role][self._choices[role].next()]
+
+    def _schedule(self, hour, product, stage):
+        heapq.heappush(self._queue, (hour, self._sequence, product, stage))
+        self._sequence += 1
+
+    def step(self, max_events=None):
+        """Process the next batch of events, at most max_events of them.
+        Returns the number processed, 0 once the simulation is over."""
+        limit = self.event_batch if max_events is None else min(max_events, self.event_batch)
+        creations, created = [], []
+        updates, updated = [], []
+        while self._queue and len(created) + len(updated) < limit:
+            hour, _, product, stage = heapq.heappop(self._queue)
+            product_id = f"PROD{str(product).zfill(3)}"
+            date = self._date(hour)
+            if stage < 0:
+                if product < self.num_products:
+                    self._schedule(hour + self._arrivals.next(), product + 1, -1)
+                origin = self.origins[self._origin_choice.next()]
+                creations.append((product_id, origin, self._pick('supplier'), date))
+                created.append((hour, product, stage))
+            else:
+                status, role, _ = self.stages[stage]
+                updates.append((product_id, status, self._pick(role), date))
+                updated.append((hour, product, stage))
+        # A product has at most one event per batch: its next stage is only
+        # scheduled once this one is applied.
+        self._apply(self.scm.create_many, creations, created)
+        self._apply(self.scm.update_many, updates, updated)
+        processed = len(created) + len(updated)
+        self.events += processed
+        if self.mine:
+            while len(self.scm.blockchain.mempool) >= self.mine_backlog:
+                self._mine_block()
+        return processed
+
+    def _apply(self, apply, batch, scheduled):
         try:
-            current_time = time_simulator.get_time_str()
-            scm.update_product_status(product_id, 'Available for Sale', retailer, date=current_time)
-            print(f"Product {product_id} status updated to 'Available for Sale' by {retailer} at {current_time}")
+            rejected = apply(batch, strict=False)
         except Exception as e:
-            print(f"Error updating product {product_id} to 'Available for Sale': {e}")
-            continue
-
-        # Advance time before purchase
-        time_simulator.advance_time(min_hours=1, max_hours=72)
-
-        # Consumer purchases the product
-        consumer = random.choice(consumers)
-        try:
-            current_time = time_simulator.get_time_str()
-            scm.update_product_status(product_id, 'Purchased', consumer, date=current_time)
-            print(f"Product {product_id} status updated to 'Purchased' by {consumer} at {current_time}")
-        except Exception as e:
-            print(f"Error updating product {product_id} to 'Purchased': {e}")
-            continue
-
-        # Advance time before the next product
-        time_simulator.advance_time(min_hours=6, max_hours=24)
-
-    # Mine pending transactions into blocks
-    while scm.blockchain.mempool:
-        new_block = scm.blockchain.new_block()
+            rejected = [(index, e) for index in range(len(batch))]
+        failed = set()
+        for index, error in rejected:
+            # The rest of this product's lifecycle is dropped
+            failed.add(index)
+            self.errors += 1
+            logger.warning("Error processing %s at stage %d: %s", batch[index][0], scheduled[index][2], error)
+        for index, (hour, product, stage) in enumerate(scheduled):
+            if index not in failed and stage + 1 < len(self.stages):
+                self._schedule(hour + self._delays[stage + 1].next(), product, stage + 1)
+
+    def _mine_block(self):
+        new_block = self.scm.blockchain.new_block()
         new_block.mine()
-        scm.blockchain.extend_chain(new_block)
-        print(f"New block mined and added to the blockchain. Block index: {new_block.index}")
-
-    return scm
+        self.scm.blockchain.extend_chain(new_block, verify=False)
+        self.blocks += 1
+        self.scm.checkpoint()
+
+    def run(self, max_events=None, progress_every=config.simulation_progress_every):
+        """Process up to max_events events (all if None), then mine what is left
+        once the simulation is over. Returns the number of events processed."""
+        processed = 0
+        logged = self.events
+        while max_events is None or processed < max_events:
+            count = self.step(None if max_events is None else max_events - processed)
+            if not count:
+                break
+            processed += count
+            if progress_every and self.events - logged >= progress_every:
+                logged = self.events
+                logger.info("%d events, %d blocks, mempool %d", self.events, self.blocks,
+                            len(self.scm.blockchain.mempool))
+        if self.done and self.mine:
+            while self.scm.blockchain.mempool:
+                self._mine_block()
+        return processed
+
+def run_simulation(num_products=10, **kwargs):
+    simulation = EventSimulation(num_products=num_products, **kwargs)
+    simulation.run()
+    logger.info("Simulated %d products: %d events, %d errors, %d blocks", num_products,
+                simulation.events, simulation.errors, simulation.blocks)
+    return simulation.scm
 
 if __name__ == "__main__":
-    scm = run_simulation()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Run the supply chain simulation")
+    parser.add_argument('--products', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--scheme', choices=sorted(backends), default=config.signature_scheme,
+                        help="Signature scheme of the simulated entities")
+    args = parser.parse_args()
+    config.signature_scheme = args.scheme
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    scm = run_simulation(num_products=args.products, seed=args.seed)
@@ -0,0 +1,183 @@
+# snapshot.py
+#
+# Product state derived from the chain. The state after a block is a dict
+# of product id -> [origin, history]; a snapshot stores it gzipped next to
+# the height and hash of that block, so a restart loads the latest snapshot
+# still on the chain and replays only the blocks after it. The origin is not
+# recorded on the chain: it is taken from the manager when a snapshot is
+# written and is None for products created after the last snapshot.
+
+import gzip
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import config
+from block_store import read_blocks
+from event_store import EventStore, valid_date
+from product import Product, HistoryEvent
+
+logger = logging.getLogger(__name__)
+
+_CREATED = "ProductCreated"
+_UPDATED = "StatusUpdated to "
+
+def fold(blocks, entity_authors=None, state=None):
+    """Apply the transactions of blocks, in chain order, to a state. Authors
+    are recorded as entity names where entity_authors knows them."""
+    state = {} if state is None else state
+    entity_authors = entity_authors or {}
+    skipped = 0
+    for block in blocks:
+        for t in block.transactions:
+            if t.event == _CREATED:
+                status = "Created"
+            elif t.event.startswith(_UPDATED):
+                status = t.event[len(_UPDATED):]
+            else:
+                continue
+            if not valid_date(t.date):
+                # Signed by another node; the event store cannot hold it
+                skipped += 1
+                continue
+            entry = state.get(t.product_id)
+            if entry is None:
+                entry = state[t.product_id] = [None, []]
+            updated_by = entity_authors.get(t.author, t.author)
+            entry[1].append(HistoryEvent(sys.intern(status), sys.intern(updated_by), t.date))
+    if skipped:
+        logger.warning("Skipped %d events with malformed dates", skipped)
+    return state
+
+def merge(state, later):
+    """Append the state folded from a later height range to state."""
+    for product_id, (origin, history) in later.items():
+        entry = state.get(product_id)
+        if entry is None:
+            state[product_id] = [origin, history]
+        else:
+            entry[1].extend(history)
+            if entry[0] is None:
+                entry[0] = origin
+    return state
+
+def _fold_range(job):
+    directory, start, stop, entity_authors = job
+    return fold(read_blocks(directory, start, stop), entity_authors)
+
+def rebuild(blockchain, start=1, entity_authors=None, state=None, workers=None,
+            range_size=config.snapshot_range_size):
+    """Fold the blocks from height start to the tip onto state, the state
+    after block start - 1. Stored chains longer than range_size are split
+    into height ranges folded in worker processes, then merged in order."""
+    state = {} if state is None else state
+    stop = len(blockchain.chain)
+    if blockchain.store is None or workers == 1 or stop - start <= range_size:
+        return fold((blockchain.chain[h] for h in range(start, stop)), entity_authors, state)
+    blockchain.store.flush()
+    jobs = [(blockchain.store.directory, lo, min(lo + range_size, stop), entity_authors)
+            for lo in range(start, stop, range_size)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for part in executor.map(_fold_range, jobs):
+            merge(state, part)
+    return state
+
+class SnapshotStore(object):
+    """Product state snapshots in a directory, one snapshot-<height>.json.gz
+    per height. Files are written atomically and only the newest keep are
+    kept."""
+
+    def __init__(self, directory, interval=config.snapshot_interval, keep=config.snapshot_keep):
+        self.directory = directory
+        self.interval = interval
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+        self.height = 0  # Chain height of the last snapshot written or restored
+
+    def _path(self, height):
+        return os.path.join(self.directory, f'snapshot-{height:010d}.json.gz')
+
+    def heights(self):
+        return sorted(int(name[9:19]) for name in os.listdir(self.directory)
+                      if name.startswith('snapshot-') and name.endswith('.json.gz'))
+
+    def save(self, height, block_hash, state):
+        data = {
+            'height': height,
+            'hash': block_hash,
+            'products': {product_id: [origin, [list(event) for event in history]]
+                         for product_id, (origin, history) in state.items()},
+        }
+        path = self._path(height)
+        with open(path + '.tmp', 'wb') as f:
+            with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6) as z:
+                z.write(json.dumps(data, separators=(',', ':')).encode())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        for old in self.heights()[:-self.keep]:
+            os.remove(self._path(old))
+
+    def load(self, height):
+        """Return (block hash, state) of the snapshot at height."""
+        with gzip.open(self._path(height), 'rb') as f:
+            data = json.loads(f.read())
+        state = {product_id: [origin, [HistoryEvent(*map(sys.intern, event)) for event in history]]
+                 for product_id, (origin, history) in data['products'].items()}
+        return data['hash'], state
+
+    def latest(self, blockchain):
+        """(height, state) of the newest snapshot whose block is still on the
+        chain, or (0, {}) if there is none."""
+        for height in reversed(self.heights()):
+            if height >= len(blockchain.chain):
+                continue
+            try:
+                block_hash, state = self.load(height)
+            except (OSError, ValueError, EOFError) as e:
+                logger.warning("Skipping unreadable snapshot at height %d: %s", height, e)
+                continue
+            if blockchain.chain[height].hash() == block_hash:
+                return height, state
+        return 0, {}
+
+    def checkpoint(self, scm):
+        """Write a snapshot of the state at the chain tip if interval blocks
+        were added since the last one. Returns the height written, or None.
+
+        The state is folded from the latest snapshot and the blocks after it
+        rather than kept in memory between checkpoints, so only one copy of
+        the product state, scm.events, lives on."""
+        chain = scm.blockchain.chain
+        tip = len(chain) - 1
+        if tip - self.height < self.interval:
+            return None
+        height, state = self.latest(scm.blockchain)
+        state = rebuild(scm.blockchain, height + 1, scm.entity_authors, state, workers=1)
+        for product_id, entry in state.items():
+            if entry[0] is None and product_id in scm.products:
+                entry[0] = scm.products[product_id].origin
+        self.save(tip, chain[tip].hash(), state)
+        self.height = tip
+        return tip
+
+def restore(scm, snapshots=None, workers=None):
+    """Rebuild scm.products from the chain, starting from the latest usable
+    snapshot. Returns the height of the snapshot used, 0 if none was.
+
+    Events are attributed to entity names through scm.entity_authors, so
+    only the keys scm holds are recognised; events signed with other keys,
+    e.g. keys generated before a restart and not reloaded, keep the author
+    hash as their holder."""
+    blockchain = scm.blockchain
+    height, state = snapshots.latest(blockchain) if snapshots is not None else (0, {})
+    state = rebuild(blockchain, height + 1, scm.entity_authors, state, workers)
+    scm.events = EventStore()
+    scm.products = {product_id: Product.from_history(product_id, origin, history, scm.events)
+                    for product_id, (origin, history) in state.items()}
+    if snapshots is not None:
+        snapshots.height = len(blockchain.chain) - 1
+    logger.info("Restored %d products from snapshot %d and %d later blocks", len(state),
+                height, len(blockchain.chain) - 1 - height)
+    return height
@@ -2,32 +2,97 @@
 
 from roles import Roles
 from product import Product
-from transaction import Transaction
+from event_store import EventStore, InvalidDate, parse_date
+from transaction import Transaction, signer_of
+from verification import verify_many
 from blockchain import Blockchain
-from ecdsa import SigningKey
+import snapshot
+import hashlib
+from datetime import datetime
+from signing import get_backend, backend_for_key
+import encrypt_data
+import config
+import metrics
+
+# Product lifecycle: each status follows the one before it and is set by the
+# role next to it. Products are created by suppliers.
+lifecycle = (
+    ("Created", "supplier"),
+    ("Manufactured", "manufacturer"),
+    ("In Transit", "logistics"),
+    ("Available for Sale", "retailer"),
+    ("Purchased", "consumer"),
+)
+status_roles = dict(lifecycle[1:])
+previous_status = {status: lifecycle[i][0] for i, (status, _) in enumerate(lifecycle[1:])}
+
+def _date_error(date):
+    try:
+        parse_date(date)
+    except InvalidDate as e:
+        return e
+    return None
 
 class SupplyChainManager:
-    def __init__(self):
+    def __init__(self, blockchain=None, snapshots=None):
         self.roles = Roles()
         self.products = {}
-        self.blockchain = Blockchain()
+        self.events = EventStore()  # History of all products, see Product
+        # Pass Blockchain.open(directory) to keep the chain across restarts
+        self.blockchain = blockchain if blockchain is not None else Blockchain()
         self.entity_keys = {}  # Store private keys for entities
+        self.entity_authors = {}  # Author hash of each entity's public key
+        self.snapshots = snapshots  # A snapshot.SnapshotStore, see checkpoint
 
     def assign_role(self, role, entity):
         self.roles.assign_role(role, entity)
-        # Generate a private key for the entity
-        sk = SigningKey.generate()
+        # Generate a private key for the entity, unless it has one already
+        if entity not in self.entity_keys:
+            self._add_key(entity, get_backend(config.signature_scheme).generate())
+
+    def _add_key(self, entity, sk):
         self.entity_keys[entity] = sk
+        public_key = backend_for_key(sk).public_pem(sk)
+        self.entity_authors[hashlib.sha256(public_key.encode()).hexdigest()] = entity
+
+    def save_keys(self, path, password):
+        """Write the entities' private keys to an encrypted key store."""
+        encrypt_data.save_keys(path, self.entity_keys, password)
+
+    def load_keys(self, path, password):
+        """Use the private keys of a key store written by save_keys, so events
+        signed before a restart are attributed to their entities. Roles still
+        have to be assigned; they keep the loaded keys."""
+        for entity, sk in encrypt_data.load_keys(path, password).items():
+            self._add_key(entity, sk)
+
+    def checkpoint(self):
+        # Called after blocks are added; snapshots every snapshots.interval blocks
+        if self.snapshots is not None:
+            return self.snapshots.checkpoint(self)
+        return None
+
+    def restore(self, workers=None, keys=None, password=None):
+        """Rebuild the products from the chain after a restart. Holders are
+        shown by entity name only for the keys this manager holds: pass the
+        key store written by save_keys as keys, or call load_keys first, or
+        they are shown by author hash."""
+        if keys is not None:
+            self.load_keys(keys, password)
+        return snapshot.restore(self, self.snapshots, workers)
 
     def get_entity_private_key(self, entity):
         return self.entity_keys.get(entity)
 
+    @metrics.timed('create_product')
     def create_product(self, product_id, origin, creator, date=None):
         if not self.roles.has_role('supplier', creator):
             raise PermissionError("Creator does not have supplier role")
         if product_id in self.products:
             raise ValueError("Product already exists")
-        product = Product(product_id, origin, creator, date=date)
+        # The same date string goes to the history and the chain
+        date = date or datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        product = Product(product_id, origin, creator, date=date, store=self.events)
         self.products[product_id] = product
         # Create a transaction for product creation
         transaction = Transaction(
@@ -41,6 +106,7 @@ class SupplyChainManager:
         self.blockchain.add_transaction(transaction)
         return product
 
+    @metrics.timed('update_product_status')
     def update_product_status(self, product_id, status, updater, date=None):
         product = self.products.get(product_id)
         if not product:
@@ -51,6 +117,9 @@ class SupplyChainManager:
             raise ValueError(f"No role associated with status '{status}'")
         if not self.roles.has_role(role_required, updater):
             raise PermissionError(f"Updater does not have {role_required} role")
+        if previous_status[status] != product.status:
+            raise ValueError(f"Product {product_id} cannot go from '{product.status}' to '{status}'")
+        date = date or datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
         product.update_status(status, updater, date=date)
         # Create a transaction for status update
         transaction = Transaction(
@@ -73,12 +142,139 @@ class SupplyChainManager:
         product = self.get_product_details(product_id)
         return product.get_history()
 
+    def get_chain_history(self, product_id):
+        # Unlike get_product_history, this reads the signed, validated chain
+        self.blockchain.validity()
+        return [{
+            'event': t.event,
+            'date': t.date,
+            'updated_by': self.entity_authors.get(t.author, t.author),
+        } for t in self.blockchain.product_transactions(product_id)]
+
     def get_role_for_status(self, status):
-        status_role_map = {
-            "Manufactured": "manufacturer",
-            "In Transit": "logistics",
-            "Available for Sale": "retailer",
-            "Purchased": "consumer",
-            # Add more statuses as needed
-        }
-        return status_role_map.get(status, None)
\ No newline at end of file
+        return status_roles.get(status)
+
+    def _sign_many(self, events):
+        # Signs (product_id, event, date, entity) tuples, deriving each
+        # entity's public key and author hash once for the whole batch
+        signers = {}
+        transactions = []
+        for product_id, event, date, entity in events:
+            key = self.entity_keys[entity]
+            signer = signers.get(entity)
+            if signer is None:
+                signer = signers[entity] = signer_of(key)
+            transaction = Transaction(product_id, event, date=date)
+            transaction.sign(key, signer)
+            transactions.append(transaction)
+        return transactions
+
+    def _apply_many(self, apply, events, strict, verify):
+        # events are (position, error or None, arguments, transaction fields)
+        # tuples, arguments starting with the product id; nothing is applied
+        # if a strict batch has an error. apply gets the arguments of the
+        # events whose transaction entered the mempool, all at once. Once a
+        # product's transaction is refused its later events are skipped, so
+        # the product never runs ahead of or behind its transactions.
+        rejected = [(index, error) for index, error, _, _ in events if error is not None]
+        if strict and rejected:
+            raise rejected[0][1]
+        accepted = [(index, arguments, fields) for index, error, arguments, fields in events if error is None]
+        transactions = self._sign_many([fields for _, _, fields in accepted])
+        valid = verify_many(transactions) if verify else [True] * len(transactions)
+        known = self.blockchain.transaction_index
+        mempool = self.blockchain.mempool
+        refused = set()
+        applied = []
+        for (index, arguments, _), transaction, ok in zip(accepted, transactions, valid):
+            product_id = arguments[0]
+            if ok and product_id not in refused and transaction.hash() not in known and mempool.add(transaction):
+                applied.append(arguments)
+            else:
+                refused.add(product_id)
+                rejected.append((index, ValueError(f"Transaction for product {product_id} was not added")))
+        apply(applied)
+        return sorted(rejected, key=lambda item: item[0])
+
+    @metrics.timed('create_many')
+    def create_many(self, creations, strict=True, verify=False):
+        """Create products from (product_id, origin, creator, date) tuples.
+
+        The whole batch is validated before anything is applied: with strict,
+        the first invalid creation is raised and nothing is created; otherwise
+        invalid ones are skipped. Transactions are signed together and added
+        to the mempool, trusting the fresh signatures unless verify is set;
+        only those the mempool takes are applied. Returns the (position,
+        error) of skipped and refused creations.
+        """
+        now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        products = self.products
+        suppliers = self.roles.roles['supplier']
+        pending = set()
+        events = []
+        for index, (product_id, origin, creator, date) in enumerate(creations):
+            date = date or now
+            error = None
+            if creator not in suppliers:
+                error = PermissionError("Creator does not have supplier role")
+            elif product_id in products or product_id in pending:
+                error = ValueError("Product already exists")
+            else:
+                error = _date_error(date)
+                if error is None:
+                    pending.add(product_id)
+            events.append((index, error, (product_id, origin, creator, date),
+                           (product_id, "ProductCreated", date, creator)))
+
+        def create(accepted):
+            for product_id, origin, creator, date in accepted:
+                products[product_id] = Product(product_id, origin, creator, date=date, store=self.events)
+        return self._apply_many(create, events, strict, verify)
+
+    @metrics.timed('update_many')
+    def update_many(self, updates, strict=True, verify=False):
+        """Apply (product_id, status, updater, date) status updates in order.
+
+        Each status must follow the product's current one in the lifecycle,
+        counting earlier updates of the batch, and the updater must hold the
+        status's role; roles are looked up once per (role, updater) pair.
+        Validation, signing and mempool insertion work as in create_many.
+        """
+        now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        products = self.products
+        allowed = {}
+        statuses = {}  # Status of each product after the earlier updates of the batch
+        events = []
+        for index, (product_id, status, updater, date) in enumerate(updates):
+            date = date or now
+            error = None
+            role = status_roles.get(status)
+            current = statuses.get(product_id)
+            if current is None and product_id in products:
+                current = products[product_id].status
+            if current is None:
+                error = ValueError("Product does not exist")
+            elif role is None:
+                error = ValueError(f"No role associated with status '{status}'")
+            elif previous_status[status] != current:
+                error = ValueError(f"Product {product_id} cannot go from '{current}' to '{status}'")
+            else:
+                key = (role, updater)
+                if key not in allowed:
+                    allowed[key] = self.roles.has_role(role, updater)
+                if not allowed[key]:
+                    error = PermissionError(f"Updater does not have {role} role")
+                else:
+                    error = _date_error(date)
+                    if error is None:
+                        statuses[product_id] = status
+            events.append((index, error, (product_id, status, updater, date),
+                           (product_id, f"StatusUpdated to {status}", date, updater)))
+
+        def update(accepted):
+            # One bulk append to the event store for the whole batch
+            self.events.extend([products[product_id].number for product_id, _, _, _ in accepted],
+                               [status for _, status, _, _ in accepted],
+                               [updater for _, _, updater, _ in accepted],
+                               [date for _, _, _, date in accepted])
+        return self._apply_many(update, events, strict, verify)
\ No newline at end of file
@@ -0,0 +1,147 @@
+# test_block_store.py
+
+import glob
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from block import Block
+from block_store import BlockStore, HashIndex
+from transaction import Transaction
+
+def _blocks(count, per_block=3):
+    # Unmined, unsigned blocks: the store does not validate what it holds
+    blocks = [Block()]
+    for height in range(1, count):
+        transactions = [Transaction(f'P{(height * per_block + i) % 5}', 'E', f'2024-01-01 00:{height:02d}:{i:02d}')
+                        for i in range(per_block)]
+        blocks.append(blocks[-1].next(transactions, 1))
+    return blocks
+
+def _key(i):
+    return hashlib.sha256(str(i).encode()).digest()
+
+class BlockStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.blocks = _blocks(6)
+        store = BlockStore(self.directory)
+        for block in self.blocks:
+            store.append(block)
+        store.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def test_reopen_reads_blocks_back(self):
+        store = BlockStore(self.directory)
+        self.assertEqual(len(store), 6)
+        self.assertEqual(store.read(3).hash(), self.blocks[3].hash())
+        self.assertEqual(store.height_of(self.blocks[4].hash()), 4)
+        self.assertTrue(store.has_transaction(self.blocks[5].transactions[2].hash()))
+        store.close()
+
+    def test_torn_index_record_is_dropped(self):
+        with open(self._path('index.dat'), 'ab') as f:
+            f.write(b'\0' * 10)
+        store = BlockStore(self.directory)
+        self.assertEqual(len(store), 6)
+        self.assertEqual(store.read(-1).hash(), self.blocks[-1].hash())
+        store.close()
+
+    def test_block_cut_short_is_dropped(self):
+        segment = self._path('blocks-00000.dat')
+        os.truncate(segment, os.path.getsize(segment) - 1)
+        store = BlockStore(self.directory)
+        self.assertEqual(len(store), 5)
+        self.assertIsNone(store.height_of(self.blocks[5].hash()))
+        self.assertFalse(store.has_transaction(self.blocks[5].transactions[0].hash()))
+        self.assertEqual(store.transaction_count, 12)
+        store.append(self.blocks[5])
+        self.assertEqual(store.read(5).hash(), self.blocks[5].hash())
+        store.close()
+
+    def test_lost_index_runs_are_rebuilt(self):
+        for path in glob.glob(self._path('*.meta')) + glob.glob(self._path('*.idx')):
+            os.remove(path)
+        store = BlockStore(self.directory)
+        self.assertEqual(store.height_of(self.blocks[2].hash()), 2)
+        self.assertTrue(store.has_transaction(self.blocks[1].transactions[0].hash()))
+        self.assertEqual(store.transactions_with('product', 'P0'), [(1, 2), (3, 1), (5, 0)])
+        store.close()
+
+    def test_truncate_drops_later_blocks_from_the_indexes(self):
+        store = BlockStore(self.directory)
+        store.truncate(3)
+        store.close()
+        store = BlockStore(self.directory)
+        self.assertEqual(len(store), 3)
+        self.assertIsNone(store.height_of(self.blocks[4].hash()))
+        self.assertFalse(store.has_transaction(self.blocks[3].transactions[0].hash()))
+        self.assertEqual(store.transactions_with('product', 'P0'), [(1, 2)])
+        self.assertEqual(store.transactions_dated('2024-01-01 00:02:00'), [(2, 0), (2, 1), (2, 2)])
+        store.close()
+
+class HashIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _open(self, unique=True):
+        return HashIndex(self.directory, 'test', lambda start, stop: iter(self.log[start:stop]),
+                         len(self.log), unique=unique, buffer_size=4)
+
+    def _append(self, index, *keys):
+        # Like a store, which checkpoints as it flushes
+        self.log.append(keys)
+        index.append(*keys)
+        index.checkpoint()
+
+    def test_positions_survive_runs_and_reopen(self):
+        index = self._open()
+        for i in range(20):
+            self._append(index, _key(i))
+        index.close()
+        index = self._open()
+        self.assertEqual(index.covered, 20)
+        self.assertEqual([index.get(_key(i)) for i in range(20)], list(range(20)))
+        self.assertIsNone(index.get(_key(20)))
+        index.close()
+
+    def test_truncate_below_runs_hides_their_entries(self):
+        index = self._open()
+        for i in range(12):
+            self._append(index, _key(i))
+        index.truncate(5)
+        del self.log[5:]
+        self._append(index, _key(8))
+        index.close()
+        index = self._open()
+        self.assertEqual(index.get(_key(8)), 5)
+        self.assertIsNone(index.get(_key(9)))
+        index.close()
+
+    def test_keys_with_many_positions(self):
+        index = self._open(unique=False)
+        for i in range(15):
+            self._append(index, _key(i % 3), _key(100 + i))
+        index.truncate(10)
+        del self.log[10:]
+        index.close()
+        index = self._open(unique=False)
+        self.assertEqual(index.positions(_key(1)), [1, 4, 7])
+        low, high = sorted((_key(0), _key(2)))
+        expected = sorted((key, position) for position, keys in enumerate(self.log)
+                          for key in keys if low <= key <= high)
+        self.assertEqual(index.between(low, high), expected)
+        index.close()
+
+if __name__ == "__main__":
+    unittest.main()
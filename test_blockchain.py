@@ -0,0 +1,162 @@
+# test_blockchain.py
+
+import shutil
+import tempfile
+import unittest
+from block import Block, InvalidBlock
+from blockchain import Blockchain
+from block_store import BlockStore
+from signing import get_backend
+from transaction import Transaction
+
+def _genesis(timestamp):
+    return Block({'index': 0, 'timestamp': timestamp, 'transactions': [],
+                  'previous_hash': '0' * 64, 'nonce': 0})
+
+def _mine(blockchain, blocks):
+    for _ in range(blocks):
+        block = blockchain.new_block()
+        block.mine()
+        blockchain.extend_chain(block)
+
+_key = get_backend('ed25519').generate()
+
+def _signed(product_id, event='ProductCreated', date='2024-01-01 00:00:00'):
+    transaction = Transaction(product_id, event, date)
+    transaction.sign(_key)
+    return transaction
+
+def _hashes(transactions):
+    return [t.hash() for t in transactions]
+
+class MergeTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_stored_chain_keeps_its_genesis(self):
+        ours = Blockchain(BlockStore(self.directory + '/ours'), genesis=_genesis('2024-01-01 00:00:00'))
+        theirs = Blockchain(BlockStore(self.directory + '/theirs'), genesis=_genesis('2024-01-02 00:00:00'))
+        _mine(ours, 1)
+        _mine(theirs, 3)
+        tip = ours.last_block.hash()
+        indexed = set(ours.transaction_index)
+
+        self.assertFalse(ours.merge(theirs))
+        self.assertEqual(len(ours.chain), 2)
+        self.assertEqual(ours.last_block.hash(), tip)
+        self.assertEqual(set(ours.transaction_index), indexed)
+        self.assertEqual(ours.index.height, 1)
+        self.assertTrue(ours.validity())
+        ours.close()
+        theirs.close()
+
+    def _fork(self, ours):
+        # Ours mines P1 in one block; theirs mines P2 and P3 in two
+        genesis = ours.chain[0]
+        theirs = Blockchain(genesis=genesis)
+        ours.add_transaction(_signed('P1'))
+        _mine(ours, 1)
+        theirs.add_transaction(_signed('P2'))
+        _mine(theirs, 1)
+        theirs.add_transaction(_signed('P3'))
+        _mine(theirs, 1)
+        return theirs
+
+    def test_heavier_fork_is_adopted(self):
+        ours = Blockchain(genesis=_genesis('2024-01-01 00:00:00'))
+        theirs = self._fork(ours)
+        abandoned = ours.last_block.transactions[0]
+
+        self.assertTrue(ours.merge(theirs))
+        self.assertEqual(ours.last_block.hash(), theirs.last_block.hash())
+        self.assertIn(abandoned, ours.mempool)
+        self.assertNotIn(abandoned.hash(), ours.transaction_index)
+        self.assertEqual(ours.product_transactions('P1'), [])
+        self.assertEqual(_hashes(ours.product_transactions('P3')), _hashes(theirs.product_transactions('P3')))
+        self.assertTrue(ours.validity(full=True))
+
+    def test_stored_chain_switches_fork(self):
+        path = self.directory + '/ours'
+        ours = Blockchain(BlockStore(path), genesis=_genesis('2024-01-01 00:00:00'))
+        theirs = self._fork(ours)
+
+        self.assertTrue(ours.merge(theirs))
+        ours.close()
+        ours = Blockchain.open(path)
+        self.assertEqual(ours.last_block.hash(), theirs.last_block.hash())
+        self.assertEqual(ours.product_transactions('P1'), [])
+        self.assertEqual(_hashes(ours.product_transactions('P2')), _hashes(theirs.product_transactions('P2')))
+        self.assertEqual(_hashes(ours.transactions_between()), _hashes(theirs.transactions_between()))
+        ours.close()
+
+    def test_lighter_fork_is_ignored(self):
+        theirs = Blockchain(genesis=_genesis('2024-01-01 00:00:00'))
+        ours = self._fork(theirs)
+        tip = ours.last_block.hash()
+
+        self.assertFalse(ours.merge(theirs))
+        self.assertEqual(ours.last_block.hash(), tip)
+
+class TimestampTest(unittest.TestCase):
+    def setUp(self):
+        self.blockchain = Blockchain()
+
+    def _extend(self, timestamp):
+        block = self.blockchain.new_block()
+        block.timestamp = timestamp
+        block.mine()
+        self.blockchain.extend_chain(block)
+
+    def test_unparsable_timestamp_is_rejected(self):
+        with self.assertRaises(InvalidBlock):
+            self._extend('not a date')
+
+    def test_far_future_timestamp_is_rejected(self):
+        with self.assertRaises(InvalidBlock):
+            self._extend('2999-01-01 00:00:00')
+
+    def test_timestamp_before_parent_is_rejected(self):
+        with self.assertRaises(InvalidBlock):
+            self._extend('2000-01-01 00:00:00')
+        self.assertEqual(len(self.blockchain), 1)
+
+    def test_current_timestamp_is_accepted(self):
+        _mine(self.blockchain, 2)
+        self.assertEqual(len(self.blockchain), 3)
+        self.assertTrue(self.blockchain.validity(full=True))
+
+class IndexTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_reopened_store_answers_like_memory(self):
+        genesis = _genesis('2024-01-01 00:00:00')
+        stored = Blockchain(BlockStore(self.directory), genesis=genesis)
+        memory = Blockchain(genesis=genesis)
+        for day in range(1, 4):
+            for product in ('P1', 'P2'):
+                transaction = _signed(product, f'Event {day}', f'2024-01-0{day} 00:00:00')
+                stored.add_transaction(transaction)
+            block = stored.new_block()
+            block.mine()
+            stored.extend_chain(block)
+            memory.extend_chain(block)
+        stored.close()
+        stored = Blockchain.open(self.directory)
+
+        self.assertEqual(len(stored.product_transactions('P1')), 3)
+        for query in (lambda c: c.product_transactions('P2'),
+                      lambda c: c.event_transactions('Event 2'),
+                      lambda c: c.author_transactions(_signed('P1').author),
+                      lambda c: c.transactions_between('2024-01-02', '2024-01-03 00:00:00')):
+            self.assertEqual(_hashes(query(stored)), _hashes(query(memory)))
+        stored.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+# test_codec.py
+
+import unittest
+from block import Block
+from codec import DecodeError, decode_block, decode_transaction, encode_block, encode_transaction
+from signing import get_backend
+from transaction import Transaction
+
+class CodecTest(unittest.TestCase):
+    def test_signed_transaction_round_trips(self):
+        for scheme in ('ecdsa', 'ed25519'):
+            transaction = Transaction('P1', 'StatusUpdated to Shipped', '2024-01-01 00:00:00')
+            transaction.sign(get_backend(scheme).generate())
+            decoded = decode_transaction(encode_transaction(transaction))
+            self.assertEqual(decoded.data, transaction.data)
+            self.assertEqual(decoded.hash(), transaction.hash())
+            self.assertTrue(decoded.verify())
+
+    def test_unsigned_transaction_round_trips(self):
+        transaction = Transaction('P1', 'ProductCreated', '2024-01-01 00:00:00')
+        self.assertEqual(decode_transaction(encode_transaction(transaction)).data, transaction.data)
+
+    def test_block_round_trips(self):
+        transactions = [Transaction(f'P{i}', 'ProductCreated', '2024-01-01 00:00:00') for i in range(3)]
+        block = Block().next(transactions, 16)
+        block.miner = '7'
+        block.mine()
+        decoded = decode_block(encode_block(block))
+        self.assertEqual(decoded.hash(), block.hash())
+        self.assertEqual(decoded.merkle_root, block.merkle_root)
+        self.assertEqual(decoded.transaction_hashes(), block.transaction_hashes())
+        self.assertTrue(decoded.valid_proof())
+
+    def test_truncated_payload_is_rejected(self):
+        transaction = Transaction('P1', 'ProductCreated', '2024-01-01 00:00:00')
+        payload = encode_transaction(transaction)
+        with self.assertRaises(DecodeError):
+            decode_transaction(payload[:-3])
+        payload = encode_block(Block().next([transaction], 16))
+        with self.assertRaises(DecodeError):
+            decode_block(payload[:-1])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+# test_encrypt_data.py
+
+import io
+import unittest
+from encrypt_data import StreamError, decrypt_stream, encrypt_stream, generate_private_key
+
+class StreamTest(unittest.TestCase):
+    def setUp(self):
+        self.key = generate_private_key("password")
+
+    def _encrypt(self, data, chunk_size=4):
+        target = io.BytesIO()
+        encrypt_stream(io.BytesIO(data), target, self.key, chunk_size)
+        return target.getvalue()
+
+    def _decrypt(self, data):
+        target = io.BytesIO()
+        decrypt_stream(io.BytesIO(data), target, self.key)
+        return target.getvalue()
+
+    def _chunks(self, data):
+        # Raw length-prefixed tokens of an encrypted stream
+        chunks = []
+        while data:
+            length = int.from_bytes(data[:4], 'little') + 4
+            chunks.append(data[:length])
+            data = data[length:]
+        return chunks
+
+    def test_round_trip(self):
+        for data in (b'', b'abc', b'0123456789abcdef'):
+            self.assertEqual(self._decrypt(self._encrypt(data)), data)
+
+    def test_chunk_from_another_stream_is_rejected(self):
+        ours = self._chunks(self._encrypt(b'aaaabbbbcccc'))
+        theirs = self._chunks(self._encrypt(b'xxxxyyyyzzzz'))
+        with self.assertRaises(StreamError):
+            self._decrypt(b''.join([ours[0], theirs[1], ours[2]]))
+
+    def test_reordered_or_truncated_stream_is_rejected(self):
+        chunks = self._chunks(self._encrypt(b'aaaabbbbcccc'))
+        for broken in ([chunks[1], chunks[0], chunks[2]], chunks[:2], chunks + chunks[-1:]):
+            with self.assertRaises(StreamError):
+                self._decrypt(b''.join(broken))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+# test_mempool.py
+
+import unittest
+from mempool import Mempool
+from transaction import Transaction
+
+def _transaction(product_id, date):
+    return Transaction(product_id, 'ProductCreated', f'2024-01-{date:02d} 00:00:00')
+
+class MempoolTest(unittest.TestCase):
+    def test_zero_capacity_refuses_everything(self):
+        for eviction in ('oldest', 'reject'):
+            mempool = Mempool(capacity=0, eviction=eviction)
+            self.assertFalse(mempool.add(_transaction('P1', 1)))
+            self.assertEqual(len(mempool), 0)
+
+    def test_full_pool_evicts_the_longest_waiting(self):
+        mempool = Mempool(capacity=2)
+        for product_id, date in (('P1', 2), ('P2', 3)):
+            mempool.add(_transaction(product_id, date))
+        self.assertTrue(mempool.add(_transaction('P3', 4)))
+        self.assertEqual([t.product_id for t in mempool], ['P2', 'P3'])
+        self.assertEqual(mempool.evicted, 1)
+
+    def test_full_pool_refuses_a_newcomer_no_later_than_the_candidate(self):
+        mempool = Mempool(capacity=2)
+        for product_id, date in (('P1', 2), ('P2', 3)):
+            mempool.add(_transaction(product_id, date))
+        self.assertFalse(mempool.add(_transaction('P3', 1)))
+        self.assertFalse(mempool.add(_transaction('P4', 2)))
+        self.assertEqual([t.product_id for t in mempool], ['P1', 'P2'])
+        self.assertEqual(mempool.evicted, 0)
+
+    def test_pop_drains_in_date_order(self):
+        mempool = Mempool()
+        for product_id, date in (('P1', 3), ('P2', 1), ('P3', 2)):
+            mempool.add(_transaction(product_id, date))
+        mempool.discard(_transaction('P3', 2).hash())
+        self.assertEqual([t.product_id for t in mempool.pop(5)], ['P2', 'P1'])
+        self.assertEqual(len(mempool), 0)
+
+if __name__ == "__main__":
+    unittest.main()
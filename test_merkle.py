@@ -0,0 +1,33 @@
+# test_merkle.py
+
+import hashlib
+import unittest
+from merkle import empty_root, merkle_proof, merkle_root, verify_merkle_proof
+
+def _leaves(count):
+    return [hashlib.sha256(str(i).encode()).hexdigest() for i in range(count)]
+
+class MerkleTest(unittest.TestCase):
+    def test_every_leaf_has_a_valid_proof(self):
+        # Odd levels pair their last node with itself
+        for count in (1, 2, 3, 5, 8, 13):
+            leaves = _leaves(count)
+            root = merkle_root(leaves)
+            for index, leaf in enumerate(leaves):
+                self.assertTrue(verify_merkle_proof(leaf, merkle_proof(leaves, index), root))
+
+    def test_proof_does_not_verify_another_leaf_or_root(self):
+        leaves = _leaves(5)
+        root = merkle_root(leaves)
+        proof = merkle_proof(leaves, 2)
+        self.assertFalse(verify_merkle_proof(leaves[3], proof, root))
+        self.assertFalse(verify_merkle_proof(leaves[2], proof, merkle_root(_leaves(6))))
+        self.assertFalse(verify_merkle_proof(leaves[2], [(proof[0][0], 'up')] + proof[1:], root))
+
+    def test_empty_and_out_of_range(self):
+        self.assertEqual(merkle_root([]), empty_root)
+        with self.assertRaises(IndexError):
+            merkle_proof(_leaves(3), 3)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+# test_network.py
+
+import asyncio
+import hashlib
+import logging
+import unittest
+from block import Block
+from blockchain import Blockchain
+from codec import encode_block, encode_transaction
+from network import BLOCK, TX, MemoryTransport, Node
+from signing import get_backend
+from transaction import Transaction
+
+_genesis = Block({'index': 0, 'timestamp': '2024-01-01 00:00:00', 'transactions': [],
+                  'previous_hash': '0' * 64, 'nonce': 0})
+
+def _signed(product_id):
+    transaction = Transaction(product_id, 'ProductCreated', '2024-01-01 00:00:00')
+    transaction.sign(get_backend('ed25519').generate())
+    return transaction
+
+def _mined(blockchain, transactions, difficulty=None):
+    block = blockchain.last_block.next(transactions, difficulty or blockchain.next_difficulty())
+    block.mine()
+    return block
+
+class NodeTest(unittest.TestCase):
+    """Node 1 receives from a peer (3) outside the test and relays to node 2."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def _run(self, scenario):
+        async def main():
+            transport = MemoryTransport()
+            first = Node(1, Blockchain(genesis=_genesis), transport)
+            second = Node(2, Blockchain(genesis=_genesis), transport)
+            for node in (first, second):
+                transport.register(node)
+                node.start()
+            first.peers.add(2)
+            second.peers.add(1)
+            try:
+                await scenario(first, second)
+            finally:
+                for node in (first, second):
+                    await node.stop()
+        asyncio.run(main())
+
+    def test_block_with_forged_signature_is_neither_adopted_nor_relayed(self):
+        async def scenario(first, second):
+            good = _signed('P0')
+            forged = Transaction('P1', 'ProductCreated', '2024-01-01 00:00:00', signature=good.signature,
+                                 public_key=good.public_key, author=good.author, scheme=good.scheme)
+            block = _mined(first.blockchain, [forged])
+            await first.deliver(3, BLOCK, encode_block(block))
+            await asyncio.sleep(0.05)
+            self.assertEqual(len(first.blockchain), 1)
+            self.assertNotIn(block.hash(), second.known_blocks)
+        self._run(scenario)
+
+    def test_block_below_difficulty_is_not_relayed(self):
+        async def scenario(first, second):
+            block = _mined(first.blockchain, [_signed('P0')], difficulty=1)
+            await first.deliver(3, BLOCK, encode_block(block))
+            await asyncio.sleep(0.05)
+            self.assertNotIn(block.hash(), first.known_blocks)
+            self.assertNotIn(block.hash(), second.known_blocks)
+        self._run(scenario)
+
+    def test_valid_block_is_adopted_and_relayed(self):
+        async def scenario(first, second):
+            block = _mined(first.blockchain, [_signed('P0')])
+            await first.deliver(3, BLOCK, encode_block(block))
+            await asyncio.sleep(0.05)
+            self.assertEqual(first.blockchain.last_block.hash(), block.hash())
+            self.assertEqual(second.blockchain.last_block.hash(), block.hash())
+        self._run(scenario)
+
+    def test_malformed_public_key_does_not_stop_the_transaction_loop(self):
+        async def scenario(first, second):
+            pem = "-----BEGIN PUBLIC KEY-----\nAAAA\n-----END PUBLIC KEY-----\n"
+            bad = Transaction('P0', 'ProductCreated', '2024-01-01 00:00:00', signature='00' * 48,
+                              public_key=pem, author=hashlib.sha256(pem.encode()).hexdigest(), scheme='ecdsa')
+            self.assertFalse(bad.verify())
+            good = _signed('P1')
+            await first.deliver(2, TX, encode_transaction(bad))
+            await asyncio.sleep(0.05)
+            await first.deliver(2, TX, encode_transaction(good))
+            await asyncio.sleep(0.05)
+            self.assertNotIn(bad, first.blockchain.mempool)
+            self.assertIn(good, first.blockchain.mempool)
+        self._run(scenario)
+
+if __name__ == "__main__":
+    unittest.main()
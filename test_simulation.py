@@ -0,0 +1,23 @@
+# test_simulation.py
+
+import unittest
+from simulation import EventSimulation
+
+class SimulationTest(unittest.TestCase):
+    def test_no_products_is_a_no_op(self):
+        simulation = EventSimulation(num_products=0)
+        self.assertTrue(simulation.done)
+        self.assertEqual(simulation.run(), 0)
+        self.assertEqual(len(simulation.scm.products), 0)
+        self.assertEqual(len(simulation.scm.blockchain), 1)
+
+    def test_products_go_through_their_lifecycle(self):
+        simulation = EventSimulation(num_products=3, seed=1)
+        simulation.run()
+        self.assertTrue(simulation.done)
+        self.assertEqual(simulation.errors, 0)
+        self.assertEqual(len(simulation.scm.products), 3)
+        self.assertTrue(simulation.scm.blockchain.validity(full=True))
+
+if __name__ == "__main__":
+    unittest.main()
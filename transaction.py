@@ -2,20 +2,52 @@
 
 import json
 import hashlib
+import sys
 from datetime import datetime
-from ecdsa import VerifyingKey, BadSignatureError
+from signing import backend_for_key, get_backend, UnknownScheme
+from verification import key_cache
+import metrics
 
 class IncompleteTransaction(Exception):
     pass
 
+def signer_of(private_key):
+    """(backend, public key PEM, author hash) of a private key, for signing
+    many transactions with it through Transaction.sign."""
+    backend = backend_for_key(private_key)
+    public_key = sys.intern(backend.public_pem(private_key))
+    return backend, public_key, sys.intern(hashlib.sha256(public_key.encode()).hexdigest())
+
+def _shared(value):
+    # Keys, authors, events and schemes repeat across many transactions
+    return sys.intern(value) if type(value) is str else value
+
 class Transaction(object):
-    def __init__(self, product_id, event, date=None, signature=None, public_key=None, author=None):
-        self.product_id = product_id
-        self.event = event  # E.g., "ProductCreated", "StatusUpdated to Manufactured"
-        self.date = date or datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
-        self.signature = signature
-        self.public_key = public_key
-        self.author = author
+    fields = ('product_id', 'event', 'date', 'signature', 'public_key', 'author', 'scheme')
+    __slots__ = fields + ('_digest',)
+
+    def __init__(self, product_id, event, date=None, signature=None, public_key=None, author=None,
+                 scheme='ecdsa'):
+        # Fields are set directly since a transaction built from signed data
+        # is immutable from the start
+        set_field = object.__setattr__
+        set_field(self, 'product_id', product_id)
+        set_field(self, 'event', _shared(event))  # E.g., "ProductCreated", "StatusUpdated to Manufactured"
+        set_field(self, 'date', date or datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'))
+        set_field(self, 'signature', signature)
+        set_field(self, 'public_key', _shared(public_key))
+        set_field(self, 'author', _shared(author))
+        set_field(self, 'scheme', _shared(scheme))  # Signature scheme, see signing.backends
+        # Once signed: raw sha256 of the canonical form, then its length in 4 bytes
+        set_field(self, '_digest', None)
+
+    def __setattr__(self, name, value):
+        if self.signature is not None:
+            raise AttributeError("Signed transactions are immutable")
+        object.__setattr__(self, name, value)
+
+    def __reduce__(self):
+        return (Transaction, tuple(getattr(self, f) for f in self.fields))
 
     @property
     def data(self):
@@ -26,26 +58,40 @@ class Transaction(object):
             "signature": self.signature,
             "public_key": self.public_key,
             "author": self.author,
+            "scheme": self.scheme,
         }
 
+    def canonical(self):
+        # Canonical JSON encoding; not cached, it would double the memory of
+        # a transaction
+        return json.dumps(self.data, sort_keys=True).encode()
+
     def json_dumps(self):
-        return json.dumps(self.data, sort_keys=True)
+        return self.canonical().decode()
+
+    def message(self):
+        # The signed part of the transaction
+        return f"{self.product_id}{self.event}{self.date}".encode()
 
-    def sign(self, private_key):
-        self.public_key = private_key.verifying_key.to_pem().decode()
-        self.author = hashlib.sha256(self.public_key.encode()).hexdigest()
-        message = f"{self.product_id}{self.event}{self.date}".encode()
-        self.signature = private_key.sign(message).hex()
+    @metrics.timed('transaction_sign')
+    def sign(self, private_key, signer=None):
+        # signer is signer_of(private_key), when the caller already has it
+        backend, public_key, author = signer or signer_of(private_key)
+        self.scheme = backend.name
+        self.public_key = public_key
+        self.author = author
+        self.signature = backend.sign(private_key, self.message()).hex()
 
     def verify(self):
         if not self.signature or not self.public_key:
             return False
+        author = self.author or hashlib.sha256(self.public_key.encode()).hexdigest()
         try:
-            vk = VerifyingKey.from_pem(self.public_key.encode())
-            message = f"{self.product_id}{self.event}{self.date}".encode()
-            vk.verify(bytes.fromhex(self.signature), message)
-            return True
-        except BadSignatureError:
+            vk = key_cache.get(author, self.public_key, self.scheme)
+            if vk is None:
+                return False
+            return get_backend(self.scheme).verify(vk, bytes.fromhex(self.signature), self.message())
+        except (ValueError, UnknownScheme):
             return False
 
     def __str__(self):
@@ -54,6 +100,18 @@ class Transaction(object):
     def __lt__(self, other):
         return self.date < other.date
 
+    def _summary(self):
+        if self._digest is not None:
+            return self._digest
+        canonical = self.canonical()
+        summary = hashlib.sha256(canonical).digest() + len(canonical).to_bytes(4, 'little')
+        if self.signature is not None:
+            object.__setattr__(self, '_digest', summary)
+        return summary
+
     def hash(self):
-        transaction_string = json.dumps(self.data, sort_keys=True)
-        return hashlib.sha256(transaction_string.encode()).hexdigest()
\ No newline at end of file
+        return self._summary()[:32].hex()
+
+    def size(self):
+        """Length of the canonical encoding, without building it again."""
+        return int.from_bytes(self._summary()[32:], 'little')
\ No newline at end of file
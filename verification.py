@@ -0,0 +1,93 @@
+# verification.py
+
+import atexit
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from signing import get_backend
+import config
+
+class KeyCache(object):
+    """LRU cache of parsed verifying keys, keyed by author hash."""
+
+    def __init__(self, capacity=config.key_cache_size):
+        self.capacity = capacity
+        self._keys = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, author, public_key, scheme='ecdsa'):
+        entry = self._keys.get(author)
+        if entry is not None and entry[0] == public_key and entry[1] == scheme:
+            self._keys.move_to_end(author)
+            self.hits += 1
+            return entry[2]
+        self.misses += 1
+        # The author field is only trusted when it is the hash of the key,
+        # so one entity's entry can never be replaced by someone else's key.
+        if hashlib.sha256(public_key.encode()).hexdigest() != author:
+            return None
+        vk = get_backend(scheme).load_public_key(public_key)
+        self._keys[author] = (public_key, scheme, vk)
+        if len(self._keys) > self.capacity:
+            self._keys.popitem(last=False)
+        return vk
+
+    def clear(self):
+        self._keys.clear()
+
+    def __len__(self):
+        return len(self._keys)
+
+key_cache = KeyCache()
+
+def _verify_chunk(transactions):
+    return [t.verify() for t in transactions]
+
+# One pool for the life of the process, so its workers and their key caches
+# are reused from one batch to the next. Recreated after a fork or when a
+# different worker count is asked for.
+_pool = None
+_pool_key = None
+_pool_lock = threading.Lock()
+
+def _get_pool(workers):
+    global _pool, _pool_key
+    with _pool_lock:
+        key = (os.getpid(), workers)
+        if _pool is None or _pool_key != key:
+            if _pool is not None and _pool_key[0] == key[0]:
+                _pool.shutdown(wait=False)
+            _pool = ProcessPoolExecutor(max_workers=workers)
+            _pool_key = key
+        return _pool
+
+def shutdown():
+    """Stop the verification workers; called at exit."""
+    global _pool, _pool_key
+    with _pool_lock:
+        if _pool is not None and _pool_key[0] == os.getpid():
+            _pool.shutdown()
+        _pool = _pool_key = None
+
+atexit.register(shutdown)
+
+def verify_many(transactions, workers=config.verify_workers, chunk_size=config.verify_chunk_size):
+    """Verify the signatures of many transactions, in a process pool for large batches.
+
+    Returns a list of booleans in the same order as the transactions.
+    """
+    transactions = list(transactions)
+    if workers == 1 or len(transactions) <= chunk_size:
+        return _verify_chunk(transactions)
+    chunks = [transactions[i:i + chunk_size] for i in range(0, len(transactions), chunk_size)]
+    try:
+        parts = list(_get_pool(workers).map(_verify_chunk, chunks))
+    except BrokenProcessPool:
+        # A worker died; start a fresh pool next time and verify here
+        shutdown()
+        return _verify_chunk(transactions)
+    return [ok for part in parts for ok in part]
@@ -4,116 +4,270 @@
 # In[ ]:
 
 
-import plotly.figure_factory as ff
+from collections import namedtuple
+import numpy as np
 import plotly.graph_objects as go
+from plotly.subplots import make_subplots
 import networkx as nx
+import config
+from event_store import Interner, parse_date
 
 
-def generate_gantt_chart(products):
-    df = []
-    for product in products.values():
-        for event in product.get_history():
-            df.append({
-                'Task': product.product_id,
-                'Start': event['date'],
-                'Finish': event['date'],
-                'Resource': event['status']
-            })
-    fig = ff.create_gantt(df, index_col='Resource', show_colorbar=True, group_tasks=True)
-    return fig
+Intervals = namedtuple('Intervals', ['product_ids', 'statuses', 'product', 'status', 'start', 'end'])
 
 
-def visualize_blockchain(blockchain):
-    G = nx.DiGraph()
-    for block in blockchain.chain:
-        G.add_node(block.index, label=f"Block {block.index}\nHash: {block.hash()[:6]}...")
-        if block.index > 0:
-            G.add_edge(block.index - 1, block.index)
+EventColumns = namedtuple('EventColumns', ['product_ids', 'statuses', 'entities', 'product', 'status',
+                                           'entity', 'date'])
 
-    pos = nx.spring_layout(G)
-    edge_x = []
-    edge_y = []
 
-    for edge in G.edges():
-        x0, y0 = pos[edge[0]]
-        x1, y1 = pos[edge[1]]
-        edge_x.extend([x0, x1, None])
-        edge_y.extend([y0, y1, None])
+def _shared_store(products):
+    # The EventStore holding exactly these products, if there is one
+    store = None
+    for product in products:
+        if store is None:
+            store = product.store
+        elif product.store is not store:
+            return None
+    if store is None or len(store.product_ids) != len(products):
+        return None
+    return store
 
-    edge_trace = go.Scatter(
-        x=edge_x, y=edge_y,
-        line=dict(width=1, color='lightblue'),
-        hoverinfo='none',
-        mode='lines')
 
-    node_x = []
-    node_y = []
-    node_labels = []
+def event_columns(products):
+    """All history events of products as NumPy columns grouped by product,
+    in event order. product, status and entity index the value lists;
+    dates are epoch seconds. Read straight from the products' EventStore
+    when they have one to themselves."""
+    products = list(products.values()) if hasattr(products, 'values') else list(products)
+    store = _shared_store(products)
+    if store is not None:
+        columns = store.columns()
+        order = np.argsort(columns['product'], kind='stable')
+        return EventColumns(store.product_ids, store.statuses.values, store.entities.values,
+                            columns['product'][order], columns['status'][order],
+                            columns['entity'][order], columns['date'][order])
+    product_ids = []
+    statuses = Interner()
+    entities = Interner()
+    owners = []
+    status_codes = []
+    entity_codes = []
+    dates = []
+    for position, product in enumerate(products):
+        history = product.get_history()
+        product_ids.append(product.product_id)
+        owners.extend([position] * len(history))
+        for status, updated_by, date in history:
+            status_codes.append(statuses.id(status))
+            entity_codes.append(entities.id(updated_by))
+            dates.append(parse_date(date))
+    return EventColumns(product_ids, statuses.values, entities.values,
+                        np.asarray(owners, dtype=np.int64), np.asarray(status_codes, dtype=np.int64),
+                        np.asarray(entity_codes, dtype=np.int64), np.asarray(dates, dtype=np.int64))
 
-    for node in G.nodes():
-        x, y = pos[node]
-        node_x.append(x)
-        node_y.append(y)
-        node_labels.append(G.nodes[node]['label'])
 
-    node_trace = go.Scatter(
-        x=node_x, y=node_y,
-        mode='markers+text',
-        text=node_labels,
-        textposition="top center",
+def stage_intervals(products):
+    """Columnar stage intervals: each status lasts from its event to the
+    product's next event. product and status index product_ids and
+    statuses; start and end are epoch seconds. Last statuses are open and
+    left out."""
+    events = event_columns(products)
+    has_next = events.product[:-1] == events.product[1:]
+    return Intervals(events.product_ids, events.statuses, events.product[:-1][has_next],
+                     events.status[:-1][has_next], events.date[:-1][has_next], events.date[1:][has_next])
+
+
+def generate_gantt_chart(products, max_products=config.timeline_max_products):
+    """Stage timeline of up to max_products products, evenly sampled, with
+    one bar trace per status."""
+    products = list(products.values()) if hasattr(products, 'values') else list(products)
+    if len(products) > max_products:
+        step = len(products) / max_products
+        products = [products[int(i * step)] for i in range(max_products)]
+    intervals = stage_intervals(products)
+    names = np.asarray(intervals.product_ids, dtype=object)
+    fig = go.Figure()
+    for code, status in enumerate(intervals.statuses):
+        mask = intervals.status == code
+        if not mask.any():
+            continue
+        start = intervals.start[mask]
+        fig.add_trace(go.Bar(
+            name=status,
+            orientation='h',
+            y=names[intervals.product[mask]],
+            base=np.datetime_as_string(start.astype('datetime64[s]')),
+            x=(intervals.end[mask] - start) * 1000,  # Milliseconds on a date axis
+            hovertemplate=f'{status}<br>%{{y}}<br>%{{base}}<extra></extra>'))
+    fig.update_layout(title='Product Timeline', barmode='overlay', xaxis=dict(type='date'),
+                      yaxis=dict(autorange='reversed'))
+    return fig
+
+
+def _block_labels(blockchain, heights, counts):
+    return [f"Block {h}<br>Hash: {blockchain.block_hash(h)[:6]}...<br>{count} transactions"
+            for h, count in zip(heights, counts)]
+
+
+def visualize_blockchain(blockchain, max_blocks=config.chart_max_blocks,
+                         overview_points=config.chart_overview_points):
+    """The last max_blocks blocks on a line, above a zoomable overview of the
+    transactions per block along the whole chain."""
+    counts = np.asarray(blockchain.transaction_counts(), dtype=np.int64)
+    length = len(counts)
+    start = max(0, length - max_blocks)
+    heights = np.arange(start, length)
+    labels = _block_labels(blockchain, heights.tolist(), counts[start:].tolist())
+
+    # Overview buckets of equal height ranges, summing their transactions
+    bucket = max(1, -(-length // overview_points))
+    bucket_starts = np.arange(0, length, bucket)
+    bucket_counts = np.add.reduceat(counts, bucket_starts) if length else counts
+
+    fig = make_subplots(rows=2, cols=1, row_heights=[0.7, 0.3], vertical_spacing=0.12,
+                        subplot_titles=(f'Last {len(heights)} blocks', 'Whole chain'))
+    fig.add_trace(go.Scatter(
+        x=heights, y=np.zeros(len(heights)),
+        mode='lines+markers',
+        line=dict(width=1, color='lightblue'),
+        text=labels,
         hoverinfo='text',
         marker=dict(
             size=10,
-            color='blue'))
-
-    fig = go.Figure(data=[edge_trace, node_trace],
-                    layout=go.Layout(
-                        title='Blockchain Structure',
-                        showlegend=False))
+            color='blue')), row=1, col=1)
+    fig.add_trace(go.Scatter(
+        x=bucket_starts, y=bucket_counts,
+        mode='lines',
+        line=dict(width=1, color='grey'),
+        hovertemplate=f'Blocks %{{x}}+{bucket}: %{{y}} transactions<extra></extra>'), row=2, col=1)
+    if length:
+        fig.add_vrect(x0=start, x1=length - 1, fillcolor='lightblue', opacity=0.3, line_width=0,
+                      row=2, col=1)
+    fig.update_yaxes(visible=False, row=1, col=1)
+    fig.update_layout(title='Blockchain Structure', showlegend=False)
     return fig
 
 
-def visualize_entity_network(products):
+
+def blockchain_extension(blockchain, height, max_blocks=config.chart_max_blocks,
+                         overview_points=config.chart_overview_points):
+    """extendData for a visualize_blockchain figure of the chain's first
+    height blocks, or None if no block was added since. The overview only
+    grows while it has a point per block, up to overview_points blocks."""
+    length = len(blockchain.chain)
+    if height >= length:
+        return None
+    start = max(height, length - max_blocks)
+    first = height if length <= overview_points else start
+    counts = [len(blockchain.chain[h].transactions) for h in range(first, length)]
+    heights = list(range(start, length))
+    recent = counts[start - first:]
+    overview_x, overview_y = (list(range(first, length)), counts) if length <= overview_points else ([], [])
+    update = {'x': [heights, overview_x], 'y': [[0] * len(heights), overview_y],
+              'text': [_block_labels(blockchain, heights, recent), []]}
+    limit = {'x': [max_blocks, overview_points], 'y': [max_blocks, overview_points],
+             'text': [max_blocks, overview_points]}
+    return update, [0, 1], limit
+
+Handoffs = namedtuple('Handoffs', ['entities', 'sources', 'targets', 'counts', 'samples'])
+
+
+def aggregate_handoffs(products, samples=3):
+    """Hand-offs between consecutive holders of each product, aggregated
+    into weighted edges. sources and targets index entities, counts holds
+    the hand-offs per edge and samples up to `samples` product ids each."""
+    events = event_columns(products)
+    ids, owners, entities = events.entity, events.product, events.entities
+
+    # Consecutive events of the same product are a hand-off
+    same = owners[1:] == owners[:-1]
+    pair_owners = owners[:-1][same]
+    width = max(len(entities), 1)
+    codes = ids[:-1][same].astype(np.int64) * width + ids[1:][same]
+    edges, inverse, counts = np.unique(codes, return_inverse=True, return_counts=True)
+    order = np.argsort(inverse, kind='stable')
+    starts = np.cumsum(counts) - counts
+    edge_samples = [[events.product_ids[p] for p in pair_owners[order[start:start + samples]]]
+                    for start in starts]
+    return Handoffs(list(entities), edges // width, edges % width, counts, edge_samples)
+
+
+def _handoff_text(handoffs, source, target, count, samples):
+    return (f"{handoffs.entities[source]} → {handoffs.entities[target]}: {count} hand-offs"
+            f"<br>e.g. {', '.join(samples)}")
+
+
+def entity_network_figure(handoffs, title='Network of Entities'):
+    """One trace for all edges, one for their hover labels at the midpoints
+    and one for the entities; the size depends on the entities only."""
     G = nx.DiGraph()
-    for product in products.values():
-        history = product.get_history()
-        for i in range(len(history) - 1):
-            G.add_edge(history[i]['updated_by'], history[i + 1]['updated_by'], product=product.product_id)
+    G.add_nodes_from(range(len(handoffs.entities)))
+    G.add_weighted_edges_from(zip(handoffs.sources.tolist(), handoffs.targets.tolist(),
+                                  handoffs.counts.tolist()))
+    pos = nx.spring_layout(G, seed=0)
+    xy = np.array([pos[node] for node in range(len(handoffs.entities))]).reshape(-1, 2)
 
-    pos = nx.spring_layout(G)
+    start, end = xy[handoffs.sources], xy[handoffs.targets]
+    gaps = np.full(len(start), np.nan)
+    edge_x = np.column_stack([start[:, 0], end[:, 0], gaps]).ravel()
+    edge_y = np.column_stack([start[:, 1], end[:, 1], gaps]).ravel()
     edge_trace = go.Scatter(
-        x=[],
-        y=[],
+        x=edge_x, y=edge_y,
         line=dict(width=1, color='grey'),
         hoverinfo='none',
         mode='lines')
 
-    for edge in G.edges():
-        x0, y0 = pos[edge[0]]
-        x1, y1 = pos[edge[1]]
-        edge_trace['x'] += [x0, x1, None]
-        edge_trace['y'] += [y0, y1, None]
+    middle = (start + end) / 2
+    counts = handoffs.counts
+    label_trace = go.Scatter(
+        x=middle[:, 0], y=middle[:, 1],
+        mode='markers',
+        hoverinfo='text',
+        text=[_handoff_text(handoffs, *edge) for edge in zip(handoffs.sources, handoffs.targets, counts,
+                                                             handoffs.samples)],
+        marker=dict(
+            color='grey',
+            size=4 + 12 * np.sqrt(counts / counts.max()) if len(counts) else 4,
+            opacity=0.6))
 
     node_trace = go.Scatter(
-        x=[],
-        y=[],
-        text=[],
+        x=xy[:, 0], y=xy[:, 1],
+        text=handoffs.entities,
         mode='markers+text',
+        textposition='top center',
         hoverinfo='text',
         marker=dict(
             color='lightgreen',
             size=10,
             line_width=2))
 
-    for node in G.nodes():
-        x, y = pos[node]
-        node_trace['x'] += [x]
-        node_trace['y'] += [y]
-        node_trace['text'] += [node]
-
-    fig = go.Figure(data=[edge_trace, node_trace],
+    fig = go.Figure(data=[edge_trace, label_trace, node_trace],
                     layout=go.Layout(
-                        title='Entity Interaction Network',
-                        showlegend=False))
+                        title=title,
+                        showlegend=False,
+                        hovermode='closest'))
     return fig
 
+
+def product_flow_figure(handoffs, title='Product Flow Through Entities'):
+    """Sankey diagram with one link per (source, target) pair, weighted by
+    the number of hand-offs."""
+    fig = go.Figure(data=[go.Sankey(
+        node=dict(
+            pad=15,
+            thickness=20,
+            label=handoffs.entities,
+            color="blue"),
+        link=dict(
+            source=handoffs.sources,
+            target=handoffs.targets,
+            value=handoffs.counts,
+            customdata=[', '.join(samples) for samples in handoffs.samples],
+            hovertemplate='%{value} hand-offs<br>e.g. %{customdata}<extra></extra>',
+            color="lightblue"))])
+    fig.update_layout(title_text=title, font_size=10)
+    return fig
+
+
+def visualize_entity_network(products):
+    return entity_network_figure(aggregate_handoffs(products), title='Entity Interaction Network')